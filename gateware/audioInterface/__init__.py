@@ -1,19 +1,17 @@
 # SPDX-License-Identifier: BSD-3-Clause
-from subprocess import CalledProcessError
-from .platform import AudioInterfacePlatform
-from .interface import AudioInterface
+from contextlib import contextmanager
 
 __all__ = (
 	'cli',
 )
 
+# Only what the CLI needs to parse its arguments is imported up front. Each action imports what it
+# needs for itself, so the likes of `--help` don't wait on torii, the USB stack and rich being imported
 def cli():
 	from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
+	from pathlib import Path
 	import logging
 
-	# Configure basic logging so it's ready to go from right at the start
-	configureLogging()
-
 	# Build the command line parser
 	parser = ArgumentParser(formatter_class = ArgumentDefaultsHelpFormatter,
 		description = 'Headphone Amp+DAC audio interface')
@@ -21,14 +19,42 @@ def cli():
 
 	actions = parser.add_subparsers(dest = 'action', required = True)
 	buildAction = actions.add_parser('build', help = 'Build the Headphone Amp+DAC audio interface gateware')
-	actions.add_parser('sim', help = 'Simulate and test the gateware components')
+	simAction = actions.add_parser('sim', help = 'Simulate and test the gateware components')
+	personaliseAction = actions.add_parser('personalise',
+		help = 'Make a bitstream per unit from a finished build, each with its own serial number')
 
 	# Allow the user to pick a seed if their toolchain is not giving good nextpnr runs
 	buildAction.add_argument('--seed', action = 'store', type = int, default = 0,
 		help = 'The nextpnr seed to use for the gateware build (default 0)')
+	buildAction.add_argument('--volume', action = 'store', choices = ('dac', 'gateware'), default = 'dac',
+		help = 'Whether the host\'s volume settings are applied by the DAC or in the gateware playback path')
+	buildAction.add_argument('--oversample', action = 'store', type = int, choices = (1, 2, 4), default = 1,
+		help = 'How much to oversample the audio by ahead of the DAC')
+	buildAction.add_argument('--interpolation-filter', action = 'store', choices = ('short', 'long'), default = 'long',
+		help = 'Which oversampling filter response to use, short has less latency but more passband ripple')
+	# The flash holds a golden image and an update image, put together with
+	# icemulti -a16 -p0 -o flash.bin audioInterfaceGolden.bin audioInterface.bin
+	buildAction.add_argument('--image', action = 'store', choices = ('update', 'golden'), default = 'update',
+		help = 'Whether to build the image DFU updates are made with, or the golden image the flash boots into first')
+
+	# Report where elaboration's time goes, so it stays measurable as the design grows
+	for action in (buildAction, simAction):
+		action.add_argument('--profile-elab', action = 'store_true',
+			help = 'Report the time spent in each elaborate() in the design\'s hierarchy')
+
+	personaliseAction.add_argument('--bitstream', action = 'store', type = Path, default = Path('build/audioInterface.asc'),
+		help = 'The placed and routed build (.asc) to patch the serial numbers into')
+	personaliseAction.add_argument('--output', action = 'store', type = Path, default = Path('build/units'),
+		help = 'Where to write the bitstreams made')
+	personaliseAction.add_argument('--product', action = 'store', default = None,
+		help = 'Replace the product string as well')
+	personaliseAction.add_argument('--serials-from', action = 'store', type = Path, default = None,
+		help = 'A file listing serial numbers, one per line, to make bitstreams for')
+	personaliseAction.add_argument('serials', nargs = '*', help = 'The serial numbers to make bitstreams for')
 
-	# Parse the command line and, if `-v` is specified, bump up the logging level
+	# Parse the command line, configure logging, and if `-v` is specified, bump up the logging level
 	args = parser.parse_args()
+	configureLogging()
 	if args.verbose:
 		from logging import root, DEBUG
 		root.setLevel(DEBUG)
@@ -42,16 +68,55 @@ def cli():
 		tests = loader.discover(start_dir = 'audioInterface.sim', pattern = '*.py')
 
 		runner = TextTestRunner()
-		runner.run(tests)
+		with profileElab(args.profile_elab):
+			runner.run(tests)
 		return 0
 	elif args.action == 'build':
+		from subprocess import CalledProcessError
+		from .platform import AudioInterfacePlatform
+		from .interface import AudioInterface
+
 		platform = AudioInterfacePlatform()
 		try:
-			platform.build(AudioInterface(), name = 'audioInterface', pnrSeed = args.seed)
+			golden = args.image == 'golden'
+			with profileElab(args.profile_elab):
+				platform.build(AudioInterface(volumeInDAC = args.volume == 'dac', oversample = args.oversample,
+					interpolationFilter = args.interpolation_filter, golden = golden),
+					name = 'audioInterfaceGolden' if golden else 'audioInterface', pnrSeed = args.seed)
 		except CalledProcessError:
 			logging.error('Synthesising gateware and building bitstream failed, see build logs for details')
 			return 1
 		return 0
+	elif args.action == 'personalise':
+		from subprocess import CalledProcessError
+		from .personalise import personalise
+
+		serials = list(args.serials)
+		if args.serials_from is not None:
+			serials.extend(line.strip() for line in args.serials_from.read_text().splitlines() if line.strip())
+		try:
+			personalise(bitstream = args.bitstream, serials = serials, product = args.product, outputDir = args.output)
+		except ValueError as error:
+			logging.error(error)
+			return 1
+		except CalledProcessError:
+			logging.error('Patching the descriptor ROM into the bitstream failed, was it built from this gateware?')
+			return 1
+		return 0
+
+@contextmanager
+def profileElab(enabled : bool):
+	''' Profile the elaboration done in this context if asked to, reporting it at the end '''
+	if not enabled:
+		yield
+		return
+
+	from .profiling import profileElaboration
+	with profileElaboration() as profile:
+		try:
+			yield
+		finally:
+			profile.report()
 
 def configureLogging():
 	from rich.logging import RichHandler
@@ -1,9 +1,20 @@
-from torii.hdl import Elaboratable, Module, Signal, Array, Cat
+from torii.hdl import Elaboratable, Module, Signal, Array, Cat, Const, Mux, EnableInserter, ResetInserter
 from torii.lib.fifo import AsyncFIFO
-from torii.lib.cdc import FFSynchronizer
+from torii.lib.cdc import FFSynchronizer, PulseSynchronizer
 
 from ..usb import USBInterface
+from ..usb.control import PerformanceCounters
+from .multiplier import SerialMultiplier
 from .i2s import *
+from .clocking import *
+from .arbiter import *
+from .asrc import *
+from .crossfade import *
+from .deemphasis import *
+from .equaliser import *
+from .volume import *
+from .interpolator import *
+from .dither import *
 from .spdif import *
 from .endpoint import *
 
@@ -12,57 +23,293 @@ __all__ = (
 )
 
 class AudioStream(Elaboratable):
-	def __init__(self, usb : USBInterface):
+	def __init__(self, usb : USBInterface, *, applyVolume = True, oversample = 1, interpolationFilter = 'long'):
 		self._requestHandler = usb.audioRequestHandler
+		self._vendorRequestHandler = usb.vendorRequestHandler
+		self._counterRequestHandler = usb.counterRequestHandler
+		self._notificationEndpoint = usb.notificationEndpoint
+		# Whether the host's volume settings are applied here, or left to the DAC
+		self._applyVolume = applyVolume
+		# How much to oversample by ahead of the DAC, and with which interpolation filter response
+		self._oversample = oversample
+		self._interpolationFilter = interpolationFilter
 		self._endpoint = AudioEndpoint(1)
 		usb.addEndpoint(self._endpoint)
 
 		self._needSample = Signal()
+		# The bit depth of the audio being played, which sets the I²S engine's slot width
+		self.sampleBits = Signal(range(25))
+		self._primed = Signal()
 
 	def elaborate(self, platform):
 		m = Module()
+		requestHandler = self._requestHandler
+		# Power domain states D2 and deeper stop the playback path, by holding the clock enable low for its
+		# stages on the audio domain and parking the S/PDIF receiver in reset. Coming back out of either is
+		# immediate bar the S/PDIF receiver relocking, which takes a block, well within the recovery times
+		# promised in the power domain descriptor
+		playing = Signal(reset = 1)
+		parked = Signal()
+		m.submodules += FFSynchronizer(requestHandler.powerState < 2, playing, o_domain = 'sync', reset = 1)
+		m.d.comb += parked.eq(requestHandler.powerState >= 2)
+		gate = EnableInserter({'sync': playing})
+
 		# m.d.sync is the audio domain.
-		m.submodules.audioFIFO = fifo = AsyncFIFO(width = 48, depth = 256, r_domain = 'sync', w_domain = 'usb')
-		m.submodules.i2s = i2s = I2S()
-		m.submodules.spdif = spdif = SPDIF()
+		m.submodules.audioFIFO = fifo = gate(
+			AsyncFIFO(width = 50, depth = 256, r_domain = 'sync', w_domain = 'usb')
+		)
+		m.submodules.i2s = i2s = gate(I2S())
+		m.submodules.spdif = spdif = ResetInserter({'usb': parked})(SPDIF())
+		m.submodules.clockGen = clockGen = gate(AudioClockGen())
+		m.submodules.arbiter = arbiter = SourceArbiter()
+		m.submodules.asrc = asrc = gate(ASRC(fifoDepth = fifo.depth))
+		m.submodules.crossfade = crossfade = gate(Crossfade())
+		m.submodules.deemphasis = deemphasis = gate(DeEmphasis())
+		m.submodules.equaliser = equaliser = gate(Equaliser(bands = self._vendorRequestHandler.eqBands))
+		if self._applyVolume:
+			m.submodules.volume = volume = gate(VolumeControl())
+		if self._oversample > 1:
+			m.submodules.interpolator = interpolator = gate(Interpolator(
+				factor = self._oversample, response = self._interpolationFilter
+			))
+		m.submodules.requantiser = requantiser = gate(Requantiser())
 
 		endpoint = self._endpoint
-		requestHandler = self._requestHandler
+		vendorRequestHandler = self._vendorRequestHandler
 		channel = Signal()
 		sampleBytes = Array(Signal(8, name = f'sampleByte{i}') for i in range(3))
 		sampleSubByte = Signal(range(3))
 		sample = Array((Signal(24, name = 'sampleL'), Signal(24, name = 'sampleR')))
 		latchSample = Signal()
 		writeSample = Signal()
-		sampleBits = Signal(range(25))
+		sampleBits = self.sampleBits
+		sampleRate = Signal.like(spdif.sampleRate)
+		spdifActive = Signal()
+		emphasis = Signal()
+		realign = Signal()
+		frameStart = Signal()
+
+		# Pick which source gets to play
+		m.d.comb += [
+			arbiter.policy.eq(vendorRequestHandler.sourcePolicy),
+			arbiter.hostSource.eq(vendorRequestHandler.hostSource),
+			arbiter.usbActive.eq(requestHandler.altModes[1] != 0),
+			arbiter.spdifActive.eq(spdif.available),
+			vendorRequestHandler.source.eq(arbiter.source),
+			vendorRequestHandler.sourceActive.eq(arbiter.active),
+			self._notificationEndpoint.spdifAvailable.eq(spdif.available),
+		]
 
-		with m.If(requestHandler.altModes[1] == 1):
-			m.d.comb += sampleBits.eq(16)
-		with m.Elif(spdif.available):
-			m.d.comb += sampleBits.eq(spdif.bitDepth)
+		with m.If(arbiter.active & (arbiter.source == Source.usb)):
+			m.d.comb += [
+				sampleBits.eq(16),
+				sampleRate.eq(48000),
+			]
+		with m.Elif(arbiter.active & (arbiter.source == Source.spdif)):
+			m.d.comb += [
+				sampleBits.eq(spdif.bitDepth),
+				sampleRate.eq(spdif.sampleRate),
+				spdifActive.eq(1),
+				emphasis.eq(spdif.emphasis),
+			]
 		with m.Else():
-			m.d.comb += sampleBits.eq(1)
+			m.d.comb += [
+				sampleBits.eq(1),
+				sampleRate.eq(48000),
+			]
 
-		# I²S control
-		with m.If(i2s.needSample):
-			with m.If(fifo.r_rdy):
-				m.d.sync += Cat(i2s.sample).eq(fifo.r_data)
+		# I²S control - the samples are left justified into 24 bits for processing, and the processing
+		# stages compute the next sample while the current one is played out
+		playing16Bit = Signal()
+		m.d.comb += playing16Bit.eq(i2s.sampleBits == 15)
+		for idx in range(2):
+			fifoSample = fifo.r_data.word_select(idx, 24)
+			with m.If(playing16Bit):
+				m.d.comb += asrc.sampleIn[idx].eq(Cat(Const(0, 8), fifoSample[0:16]))
 			with m.Else():
+				m.d.comb += asrc.sampleIn[idx].eq(fifoSample)
+
+		# Which source each sample came from travels through the FIFO alongside it. When the source changes, the
+		# ASRC's output is faded down to silence, any samples left over from the old source are flushed out of
+		# the FIFO, and then the new source's samples are faded back up
+		targetSource = Signal()
+		currentSource = Signal()
+		playingSource = Signal()
+		fifoSource = fifo.r_data[49]
+		flushing = Signal()
+		m.submodules += FFSynchronizer(arbiter.source, targetSource, o_domain = 'sync')
+		with m.If(crossfade.silent):
+			m.d.sync += currentSource.eq(targetSource)
+		m.d.comb += [
+			flushing.eq(crossfade.silent & fifo.r_rdy & (fifoSource != currentSource)),
+			crossfade.fadeOut.eq((targetSource != currentSource) | (playingSource != currentSource)),
+			crossfade.start.eq(asrc.done),
+			crossfade.sampleIn[0].eq(asrc.sampleOut[0]),
+			crossfade.sampleIn[1].eq(asrc.sampleOut[1]),
+		]
+
+		# Whether the source has marked its audio as pre-emphasised also travels through the FIFO, so the
+		# de-emphasis filter switches in and out with the first sample that needs it. That filter only
+		# ever applies to S/PDIF sources, and runs on each sample as soon as it's been through the crossfade
+		inputRate = Signal.like(sampleRate)
+		emphasisActive = Signal()
+		with m.If(asrc.consume):
+			m.d.sync += [
+				emphasisActive.eq(fifo.r_data[48]),
+				playingSource.eq(fifoSource),
+			]
+		m.d.comb += [
+			deemphasis.enable.eq(emphasisActive & asrc.enable),
+			deemphasis.sampleRate.eq(inputRate),
+			deemphasis.start.eq(crossfade.done),
+			deemphasis.sampleIn[0].eq(crossfade.sampleOut[0]),
+			deemphasis.sampleIn[1].eq(crossfade.sampleOut[1]),
+		]
+
+		# The equaliser works on the previous de-emphasised output while the ASRC computes the next, so each has a
+		# whole sample period. It only has the time to run at up to 96kHz, so is passed through above that
+		equaliserEnable = Signal()
+		m.submodules += [
+			FFSynchronizer(sampleRate, inputRate, o_domain = 'sync'),
+			FFSynchronizer(vendorRequestHandler.eqEnable, equaliserEnable, o_domain = 'sync'),
+			FFSynchronizer(vendorRequestHandler.eqBank, equaliser.bank, o_domain = 'sync'),
+		]
+		m.d.comb += [
+			equaliser.enable.eq(equaliserEnable & (inputRate <= 96000)),
+			equaliser.start.eq(asrc.start),
+			equaliser.sampleIn[0].eq(deemphasis.sampleOut[0]),
+			equaliser.sampleIn[1].eq(deemphasis.sampleOut[1]),
+			equaliser.writeBank.eq(vendorRequestHandler.eqBank),
+			equaliser.writeBand.eq(vendorRequestHandler.eqWriteBand),
+			equaliser.writeIndex.eq(vendorRequestHandler.eqWriteIndex),
+			equaliser.writeData.eq(vendorRequestHandler.eqWriteData),
+			equaliser.writeEnable.eq(vendorRequestHandler.eqWrite),
+		]
+
+		# Apply the host's volume and mute settings to the equalised samples if we're asked to
+		if self._applyVolume:
+			for idx in range(3):
+				m.submodules += FFSynchronizer(requestHandler.volumeStates[idx], volume.volumes[idx], o_domain = 'sync')
+				m.submodules += FFSynchronizer(requestHandler.muteStates[idx], volume.mutes[idx], o_domain = 'sync')
+			m.d.comb += [
+				volume.start.eq(equaliser.done),
+				volume.sampleIn[0].eq(equaliser.sampleOut[0]),
+				volume.sampleIn[1].eq(equaliser.sampleOut[1]),
+			]
+			playbackSample = volume.sampleOut
+			playbackDone = volume.done
+		else:
+			playbackSample = equaliser.sampleOut
+			playbackDone = equaliser.done
+
+		# If we're oversampling, the interpolator runs at the I²S rate and pulls samples from the stages before
+		# it once every `factor` output samples, with the I²S clock running that much faster than the source
+		if self._oversample > 1:
+			# Oversample by as much as we can without going past the fastest rate the I²S clock can be run at
+			maxRate = AudioClockGen.sampleRates[-1]
+			m.d.comb += interpolator.factorShift.eq(0)
+			for shift in range(1, (self._oversample - 1).bit_length() + 1):
+				with m.If(inputRate <= (maxRate >> shift)):
+					m.d.comb += interpolator.factorShift.eq(shift)
+			m.d.comb += [
+				clockGen.sampleRate.eq(inputRate << interpolator.factorShift),
+				interpolator.start.eq(i2s.needSample),
+				interpolator.sampleIn[0].eq(playbackSample[0]),
+				interpolator.sampleIn[1].eq(playbackSample[1]),
+				asrc.start.eq(interpolator.consume),
+			]
+			outputSample = interpolator.sampleOut
+			outputDone = interpolator.done
+		else:
+			m.d.comb += [
+				clockGen.sampleRate.eq(inputRate),
+				asrc.start.eq(i2s.needSample),
+			]
+			outputSample = playbackSample
+			outputDone = playbackDone
+
+		# When playing out at 16-bit, requantise the processed samples down to that with dither rather than truncating.
+		# That's decided for the stream, by whether any of the stages are changing the samples, so an unprocessed
+		# 16-bit source stays bit-perfect without the dither coming and going with the signal
+		processing = Signal()
+		m.d.comb += processing.eq(asrc.enable | deemphasis.enable | equaliser.enable | ~crossfade.unity)
+		if self._applyVolume:
+			with m.If(~volume.unity):
+				m.d.comb += processing.eq(1)
+		if self._oversample > 1:
+			with m.If(interpolator.factorShift != 0):
+				m.d.comb += processing.eq(1)
+		m.submodules += [
+			FFSynchronizer(vendorRequestHandler.dither, requantiser.dither, o_domain = 'sync'),
+			FFSynchronizer(vendorRequestHandler.noiseShaping, requantiser.shaping, o_domain = 'sync'),
+		]
+		m.d.comb += [
+			requantiser.enable.eq(playing16Bit & processing),
+			requantiser.start.eq(outputDone),
+			requantiser.sampleIn[0].eq(outputSample[0]),
+			requantiser.sampleIn[1].eq(outputSample[1]),
+		]
+
+		with m.If(i2s.needSample):
+			# While the audio clock is being switched over, play silence
+			with m.If(clockGen.mute):
 				m.d.sync += Cat(i2s.sample).eq(0)
+			with m.Elif(playing16Bit):
+				m.d.sync += [sample.eq(requantiser.sampleOut[idx][8:]) for idx, sample in enumerate(i2s.sample)]
+			with m.Else():
+				m.d.sync += [sample.eq(requantiser.sampleOut[idx]) for idx, sample in enumerate(i2s.sample)]
 
 		# Compute `sampleBits - 1` by manually doing subtract-with-borrow, which turns `- 1` into `+ ((2 ** width) - 1)`
 		# - subtraction is expensive on the iCE40, due to architecture.
 		m.submodules += FFSynchronizer(sampleBits + ((2 ** sampleBits.width) - 1), i2s.sampleBits, o_domain = 'sync')
+		# S/PDIF sources are clocked remotely, so must be resampled onto our local clock
+		m.submodules += FFSynchronizer(spdifActive, asrc.enable, o_domain = 'sync')
+
+		# USB audio arrives in bursts, a packet per service interval, so the FIFO is primed to a packet and a
+		# half before starting to play, and primed again should it ever run dry. The low latency alt mode
+		# (2) has much smaller, more frequent, packets, so runs the FIFO much shallower
+		lowLatency = Signal()
+		primeLevel = Signal(range(fifo.depth + 1))
+		primed = self._primed
+		m.submodules += FFSynchronizer(requestHandler.altModes[1] == 2, lowLatency, o_domain = 'sync')
+		m.d.comb += primeLevel.eq(Mux(lowLatency, 12, 64))
+		with m.If(asrc.enable | (fifo.r_level >= primeLevel)):
+			m.d.sync += primed.eq(1)
+		with m.Elif(asrc.underrun):
+			m.d.sync += primed.eq(0)
+
 		m.d.comb += [
-			i2s.clkDivider.eq(5),
-			fifo.r_en.eq(i2s.needSample),
+			clockGen.sampleBits.eq(i2s.sampleBits),
+			clockGen.clkEdge.eq(i2s.clkEdge),
+			clockGen.needSample.eq(i2s.needSample),
+			i2s.clkDivider.eq(clockGen.clkDivider),
+			asrc.sampleInValid.eq(fifo.r_rdy & primed),
+			asrc.fillLevel.eq(fifo.r_level),
+			fifo.r_en.eq(asrc.consume | flushing),
 			self._needSample.eq(i2s.needSample)
 		]
 
 		# endpoint control
 		m.d.usb += writeSample.eq(latchSample & ~channel)
 
-		with m.If(endpoint.valid):
+		# After a change of source, wait for the new one to start a fresh frame - a new packet for USB, or a
+		# new block for S/PDIF - so the left and right channels stay aligned
+		with m.If(arbiter.source == Source.usb):
+			m.d.comb += frameStart.eq(endpoint.valid & (endpoint.address == 0))
+		with m.Else():
+			m.d.comb += frameStart.eq(~spdif.sampleValid)
+		with m.If(frameStart):
+			m.d.usb += realign.eq(0)
+
+		with m.If(arbiter.switched):
+			# Drop anything part way through being collected from the old source
+			m.d.usb += [
+				sampleSubByte.eq(0),
+				channel.eq(0),
+				latchSample.eq(0),
+				realign.eq(1),
+			]
+		with m.Elif(endpoint.valid & (arbiter.source == Source.usb) & (~realign | frameStart)):
 			m.d.usb += sampleBytes[sampleSubByte].eq(endpoint.value)
 			# If we've collected enough bytes
 			with m.If(sampleSubByte == (sampleBits[3:5] - 1)):
@@ -76,7 +323,7 @@ class AudioStream(Elaboratable):
 					sampleSubByte.eq(sampleSubByte + 1),
 					latchSample.eq(0),
 				]
-		with m.Elif(spdif.sampleValid):
+		with m.Elif(spdif.sampleValid & (arbiter.source == Source.spdif) & ~realign):
 			m.d.usb += [
 				sample[channel].eq(spdif.sample),
 				channel.eq(~channel),
@@ -89,7 +336,58 @@ class AudioStream(Elaboratable):
 			m.d.usb += sample[~channel].eq(Cat(sampleBytes))
 
 		m.d.comb += [
-			fifo.w_data.eq(Cat(sample)),
+			fifo.w_data.eq(Cat(sample[0], sample[1], emphasis, arbiter.source)),
 			fifo.w_en.eq(writeSample),
 		]
+
+		# Let the host know what rate is being played
+		m.d.comb += requestHandler.sampleRate.eq(sampleRate)
+
+		# Work out the latency from USB through to the DAC for the host. Samples wait in the FIFO, then for the
+		# ASRC's and interpolator's filters if they're in use, and then take a sample period to go through the
+		# processing stages, another as the equaliser works a sample behind the ASRC, and a third to be played out
+		latencySamples = Signal(range(fifo.depth + 32))
+		samplePeriod = Signal(16)
+		m.submodules.latencyMultiplier = latencyMultiplier = SerialMultiplier(
+			aWidth = latencySamples.width + 1, bWidth = samplePeriod.width + 1, domain = 'usb'
+		)
+		stageLatency = 3 + (interpolator.latency if self._oversample > 1 else 0)
+		with m.If(spdifActive):
+			m.d.comb += latencySamples.eq(fifo.w_level + asrc.latency + stageLatency)
+		with m.Else():
+			m.d.comb += latencySamples.eq(fifo.w_level + stageLatency)
+		# The period of the input sample rate, in ns
+		with m.Switch(sampleRate):
+			for rate in AudioClockGen.sampleRates:
+				with m.Case(rate):
+					m.d.comb += samplePeriod.eq(round(1e9 / rate))
+		# Keep the multiplier running continuously to keep the latency up to date
+		m.d.comb += [
+			latencyMultiplier.a.eq(latencySamples),
+			latencyMultiplier.b.eq(samplePeriod),
+			latencyMultiplier.start.eq(~latencyMultiplier.busy),
+		]
+		with m.If(latencyMultiplier.done):
+			m.d.usb += requestHandler.latency.eq(latencyMultiplier.product)
+
+		# Feed the performance counters. Underruns are only counted while a source should be playing, and not
+		# while the FIFO is being primed
+		counterRequestHandler = self._counterRequestHandler
+		events = counterRequestHandler.events
+		m.submodules.underrunSync = underrunSync = PulseSynchronizer(i_domain = 'sync', o_domain = 'usb')
+		m.d.comb += [
+			underrunSync.i.eq(asrc.underrun & primed),
+			events[PerformanceCounters.fifoUnderruns].eq(underrunSync.o & arbiter.active),
+			events[PerformanceCounters.fifoOverruns].eq(writeSample & ~fifo.w_rdy),
+			counterRequestHandler.fillLevel.eq(fifo.w_level),
+			counterRequestHandler.fillLevelValid.eq(arbiter.active),
+			events[PerformanceCounters.packetsReceived].eq(endpoint.packetReceived),
+			events[PerformanceCounters.packetsRejected].eq(endpoint.packetRejected),
+			events[PerformanceCounters.blocksAccepted].eq(spdif.blockAccepted),
+			events[PerformanceCounters.blocksDroppedParity].eq(spdif.blockDroppedParity),
+			events[PerformanceCounters.blocksDroppedInvalid].eq(spdif.blockDroppedInvalid),
+			events[PerformanceCounters.blocksDroppedFormat].eq(spdif.blockDroppedFormat),
+			events[PerformanceCounters.blocksDroppedLength].eq(spdif.blockDroppedLength),
+			events[PerformanceCounters.spdifResyncs].eq(spdif.resync),
+		]
 		return m
@@ -0,0 +1,71 @@
+from enum import IntEnum, unique
+from torii.hdl import Elaboratable, Module, Signal, Mux
+from torii.build import Platform
+
+__all__ = (
+	'Source',
+	'SourcePolicy',
+	'SourceArbiter',
+)
+
+@unique
+class Source(IntEnum):
+	usb = 0
+	spdif = 1
+
+@unique
+class SourcePolicy(IntEnum):
+	# USB wins whenever the host is streaming, otherwise S/PDIF plays if it's available
+	priority = 0
+	# Stick with whichever source is playing until it goes away, and only then switch to the other
+	lastActive = 1
+	# Only play the source the host has picked
+	hostSelected = 2
+
+class SourceArbiter(Elaboratable):
+	'''
+	This picks which of the USB and S/PDIF sources gets to play, according to policy. It runs in the usb
+	domain alongside the sources themselves.
+
+	source holds the source picked, and active is high while that source is actually delivering audio.
+	switched pulses for a cycle when source changes so the write side of the audio FIFO can realign
+	itself to the new source's frames.
+	'''
+
+	def __init__(self):
+		self.policy = Signal(range(len(SourcePolicy)))
+		self.hostSource = Signal()
+		self.usbActive = Signal()
+		self.spdifActive = Signal()
+
+		self.source = Signal()
+		self.active = Signal()
+		self.switched = Signal()
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+
+		nextSource = Signal()
+
+		m.d.comb += nextSource.eq(self.source)
+		with m.Switch(self.policy):
+			with m.Case(SourcePolicy.priority):
+				with m.If(self.usbActive):
+					m.d.comb += nextSource.eq(Source.usb)
+				with m.Elif(self.spdifActive):
+					m.d.comb += nextSource.eq(Source.spdif)
+			with m.Case(SourcePolicy.lastActive):
+				with m.If((self.source == Source.usb) & ~self.usbActive & self.spdifActive):
+					m.d.comb += nextSource.eq(Source.spdif)
+				with m.Elif((self.source == Source.spdif) & ~self.spdifActive & self.usbActive):
+					m.d.comb += nextSource.eq(Source.usb)
+			with m.Case(SourcePolicy.hostSelected):
+				m.d.comb += nextSource.eq(self.hostSource)
+
+		m.d.comb += [
+			self.active.eq(Mux(self.source == Source.spdif, self.spdifActive, self.usbActive)),
+			self.switched.eq(nextSource != self.source),
+		]
+		m.d.usb += self.source.eq(nextSource)
+
+		return m
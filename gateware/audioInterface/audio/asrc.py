@@ -0,0 +1,223 @@
+from math import pi, sin, cos
+from torii.hdl import Elaboratable, Module, Signal, Array, Memory, Cat, signed
+from torii.build import Platform
+
+from .multiplier import SerialMultiplier
+
+__all__ = (
+	'ASRC',
+)
+
+class ASRC(Elaboratable):
+	'''
+	This implements a polyphase asynchronous sample rate converter that sits on the read side of the
+	audio FIFO. S/PDIF sources are clocked by the remote end and so, even once we're generating the
+	right nominal rate locally, the two clocks drift and the FIFO slowly fills or drains.
+
+	The converter continuously estimates the ratio between the input and output rates by servoing the
+	(heavily low-pass filtered, as S/PDIF arrives in 192 sample bursts) FIFO fill level onto a target
+	with a PI loop. The loop output is a step in input samples per output sample, accumulated into a
+	fractional phase. The phase selects one of `phases` sets of `taps` windowed-sinc coefficients held
+	in EBR which are applied to the sample history, for both channels in parallel, with shift-add
+	multipliers. Latency is therefore bounded at the FIFO target level plus half the filter length.
+
+	When not enabled, each output request just moves one sample straight through, which is what the
+	USB path needs as the host paces that for us.
+	'''
+
+	def __init__(self, *, fifoDepth = 256, taps = 8, phases = 64):
+		assert taps & (taps - 1) == 0, 'The number of taps must be a power of 2'
+		assert phases & (phases - 1) == 0, 'The number of phases must be a power of 2'
+		self._fifoDepth = fifoDepth
+		self._taps = taps
+		self._phases = phases
+		# The filter's group delay, in input samples
+		self.latency = taps // 2
+
+		self.enable = Signal()
+		self.start = Signal()
+
+		self.sampleIn = Array((Signal(signed(24), name = 'sampleInL'), Signal(signed(24), name = 'sampleInR')))
+		self.sampleInValid = Signal()
+		self.consume = Signal()
+		self.fillLevel = Signal(range(fifoDepth + 1))
+
+		self.sampleOut = Array((Signal(signed(24), name = 'sampleOutL'), Signal(signed(24), name = 'sampleOutR')))
+		self.done = Signal()
+		# Pulses each time a sample was wanted but the FIFO had run dry
+		self.underrun = Signal()
+
+	coefficientBits = 14
+	# Number of fractional bits in the resampling phase and step
+	phaseBits = 16
+	# Time constant of the fill level low-pass filter and PI loop gains, as shifts
+	levelShift = 12
+	proportionalShift = 10
+	integralShift = 21
+	# Limit on how far from 1:1 the loop may pull the conversion ratio, in units of 2^-phaseBits
+	maxStep = 512
+
+	def generateCoefficients(self):
+		''' Generates the Blackman windowed-sinc interpolation filter, one set of taps per phase '''
+		taps = self._taps
+		phases = self._phases
+		coefficients = []
+		for phase in range(phases):
+			offset = phase / phases
+			values = []
+			for tap in range(taps):
+				# Time of this tap relative to the output sample, which sits between the middle two taps
+				time = tap - (taps // 2 - 1) - offset
+				sinc = 1.0 if time == 0 else sin(pi * time) / (pi * time)
+				window = (time + taps / 2) / taps
+				blackman = 0.42 - 0.5 * cos(2 * pi * window) + 0.08 * cos(4 * pi * window)
+				values.append(sinc * blackman)
+			# Normalise each phase to unity gain at DC so switching phases doesn't modulate the level
+			total = sum(values)
+			scale = 1 << self.coefficientBits
+			coefficients.extend(round(value / total * scale) & 0xffff for value in values)
+		return coefficients
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+
+		taps = self._taps
+		tapBits = (taps - 1).bit_length()
+		phaseIndexBits = (self._phases - 1).bit_length()
+
+		rom = Memory(width = 16, depth = taps * self._phases, init = self.generateCoefficients())
+		m.submodules.coefficients = readPort = rom.read_port(transparent = False)
+		multipliers = []
+		for channel in range(2):
+			multiplier = SerialMultiplier(aWidth = 24, bWidth = 16)
+			m.submodules[f'multiplier{channel}'] = multiplier
+			multipliers.append(multiplier)
+
+		history = [
+			Array(Signal(signed(24), name = f'history{channel}_{tap}') for tap in range(taps))
+			for channel in range(2)
+		]
+		accumulators = [Signal(signed(24 + 16 + tapBits), name = f'accumulator{channel}') for channel in range(2)]
+		tap = Signal(range(taps + 1))
+		phase = Signal(self.phaseBits)
+		nextPhase = Signal(self.phaseBits + 2)
+		step = Signal(signed(self.phaseBits + 2))
+		popsRemaining = Signal(2)
+
+		levelBits = self._fifoDepth.bit_length()
+		target = self._fifoDepth // 2
+		levelAverage = Signal(levelBits + self.levelShift, reset = target << self.levelShift)
+		levelError = Signal(signed(levelBits + self.levelShift + 1))
+		integral = Signal(signed(32))
+		correction = Signal(signed(32))
+
+		m.d.comb += [
+			readPort.addr.eq(Cat(tap[:tapBits], phase[self.phaseBits - phaseIndexBits:])),
+			self.consume.eq(0),
+			self.underrun.eq(0),
+		]
+		m.d.sync += self.done.eq(0)
+		for channel, multiplier in enumerate(multipliers):
+			m.d.comb += [
+				multiplier.a.eq(history[channel][tap[:tapBits]]),
+				multiplier.b.eq(readPort.data),
+			]
+
+		# Low-pass the fill level, and compute how far away it is from the target
+		m.d.comb += [
+			levelError.eq(levelAverage - (target << self.levelShift)),
+			correction.eq(levelError.shift_right(self.proportionalShift) + integral.shift_right(self.integralShift)),
+		]
+		with m.If(correction > self.maxStep):
+			m.d.comb += step.eq((1 << self.phaseBits) + self.maxStep)
+		with m.Elif(correction < -self.maxStep):
+			m.d.comb += step.eq((1 << self.phaseBits) - self.maxStep)
+		with m.Else():
+			m.d.comb += step.eq((1 << self.phaseBits) + correction)
+		m.d.comb += nextPhase.eq(phase + step)
+
+		with m.FSM(name = 'asrcFSM'):
+			with m.State('IDLE'):
+				m.d.sync += tap.eq(0)
+				with m.If(self.start):
+					with m.If(self.enable):
+						m.d.sync += [accumulator.eq(0) for accumulator in accumulators]
+						m.next = 'TAP-START'
+					# When not resampling, move the next sample straight through
+					with m.Else():
+						m.d.sync += [
+							levelAverage.eq(levelAverage.reset),
+							integral.eq(0),
+						]
+						with m.If(self.sampleInValid):
+							m.d.comb += self.consume.eq(1)
+							m.d.sync += [sampleOut.eq(sample) for sampleOut, sample in zip(self.sampleOut, self.sampleIn)]
+						with m.Else():
+							m.d.comb += self.underrun.eq(1)
+							m.d.sync += [sampleOut.eq(0) for sampleOut in self.sampleOut]
+						m.d.sync += self.done.eq(1)
+
+			# Kick off the multiplies for the next tap and move the coefficient read on to the tap after
+			with m.State('TAP-START'):
+				m.d.comb += [multiplier.start.eq(1) for multiplier in multipliers]
+				m.d.sync += tap.eq(tap + 1)
+				m.next = 'TAP-WAIT'
+
+			with m.State('TAP-WAIT'):
+				with m.If(multipliers[0].done):
+					m.d.sync += [
+						accumulator.eq(accumulator + multiplier.product)
+						for accumulator, multiplier in zip(accumulators, multipliers)
+					]
+					with m.If(tap == taps):
+						m.next = 'OUTPUT'
+					with m.Else():
+						m.next = 'TAP-START'
+
+			# Scale the result back down and saturate it into the output
+			with m.State('OUTPUT'):
+				for accumulator, sampleOut in zip(accumulators, self.sampleOut):
+					result = accumulator.shift_right(self.coefficientBits)
+					with m.If(result > 0x7fffff):
+						m.d.sync += sampleOut.eq(0x7fffff)
+					with m.Elif(result < -0x800000):
+						m.d.sync += sampleOut.eq(-0x800000)
+					with m.Else():
+						m.d.sync += sampleOut.eq(result)
+
+				# Advance the phase by the current step, working out how many input samples that consumes,
+				# and run the servo loop
+				m.d.sync += [
+					phase.eq(nextPhase[:self.phaseBits]),
+					popsRemaining.eq(nextPhase[self.phaseBits:]),
+					levelAverage.eq(levelAverage + self.fillLevel - levelAverage.shift_right(self.levelShift)),
+					self.done.eq(1),
+				]
+				# Only integrate while the step isn't being clamped, so the loop doesn't wind up
+				windingUp = (
+					((correction >= self.maxStep) & (levelError > 0)) |
+					((correction <= -self.maxStep) & (levelError < 0))
+				)
+				with m.If(~windingUp):
+					m.d.sync += integral.eq(integral + levelError.shift_right(4))
+				m.next = 'POP'
+
+			# Shift as many new samples into the history as the phase step consumed
+			with m.State('POP'):
+				with m.If(popsRemaining == 0):
+					m.next = 'IDLE'
+				with m.Else():
+					m.d.sync += popsRemaining.eq(popsRemaining - 1)
+					for channel in range(2):
+						m.d.sync += [history[channel][idx].eq(history[channel][idx + 1]) for idx in range(taps - 1)]
+						# If the FIFO ran dry, fill with silence rather than stalling
+						with m.If(self.sampleInValid):
+							m.d.sync += history[channel][taps - 1].eq(self.sampleIn[channel])
+						with m.Else():
+							m.d.sync += history[channel][taps - 1].eq(0)
+					m.d.comb += [
+						self.consume.eq(self.sampleInValid),
+						self.underrun.eq(~self.sampleInValid),
+					]
+
+		return m
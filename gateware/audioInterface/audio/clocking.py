@@ -0,0 +1,145 @@
+from fractions import Fraction
+from torii.hdl import Elaboratable, Module, Signal, Array, Const, Cat
+from torii.build import Platform
+
+__all__ = (
+	'AudioClockGen',
+)
+
+class AudioClockGen(Elaboratable):
+	'''
+	This generates the I²S audio clock divider for the currently active sample rate and bit depth.
+
+	The system clock is a 36.864MHz (48kHz family) crystal, and the iCE40's PLL cannot synthesise a
+	44.1kHz family clock from it exactly (the 49/80 ratio needed forces the PFD below its 10MHz minimum),
+	so instead this implements a dual-modulus fractional divider. Each half of the audio clock is either
+	`n` or `n + 1` system clocks long, picked by a Bresenham accumulator so the average rate is exact.
+	For the 48kHz family the fraction is 0 and this degenerates to a plain integer divider.
+
+	That does mean the 44.1kHz family's bit clock is not clean: each edge lands up to one system clock
+	(about 27ns) either side of where it ideally would, a deterministic jitter pattern that repeats every
+	denominator half-clocks. This is an accepted trade-off against needing a second crystal for the
+	44.1kHz family, and the 48kHz family, which has no such jitter, remains the one for the cleanest output.
+
+	The divider is only ever retuned on a half-clock edge from the I²S engine, and when the requested
+	rate changes the output is muted for a couple of frames either side of the switch so no partially
+	clocked samples make it to the DAC.
+	'''
+
+	# As well as the source rates, this includes the rates 32kHz audio is oversampled to
+	sampleRates = (32000, 44100, 48000, 64000, 88200, 96000, 128000, 176400, 192000)
+	sampleWidths = (16, 24)
+
+	def __init__(self, *, clkFrequency = 36.864e6, muteFrames = 2):
+		self._clkFrequency = int(clkFrequency)
+		self._muteFrames = muteFrames
+
+		self.sampleRate = Signal(range(192000))
+		# This is `sampleBits - 1`, the same encoding the I²S engine uses
+		self.sampleBits = Signal(range(24))
+		self.clkEdge = Signal()
+		self.needSample = Signal()
+
+		# Start out on the divider for 48kHz 16-bit audio so the I²S engine can get going straight away
+		self.clkDivider = Signal(range(18), reset = self._dividerFor(48000, 16)[0] - 1)
+		self.mute = Signal()
+
+	def _dividerFor(self, sampleRate : int, sampleWidth : int):
+		# The audio clock has to clock out 2 channels of sampleWidth bits per sample, and we toggle it twice per bit
+		halfPeriod = Fraction(self._clkFrequency, 4 * sampleRate * sampleWidth)
+		whole = halfPeriod.numerator // halfPeriod.denominator
+		fraction = halfPeriod - whole
+		return whole, fraction.numerator, fraction.denominator
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+
+		dividers = [
+			self._dividerFor(sampleRate, sampleWidth)
+			for sampleRate in self.sampleRates for sampleWidth in self.sampleWidths
+		]
+		maxDenominator = max(denominator for _, _, denominator in dividers)
+		periodWhole = Array(Const(whole - 1, self.clkDivider.shape()) for whole, _, _ in dividers)
+		periodNumerator = Array(Const(numerator, range(maxDenominator)) for _, numerator, _ in dividers)
+		periodDenominator = Array(Const(denominator, range(maxDenominator + 1)) for _, _, denominator in dividers)
+
+		rateIndex = Signal(range(len(self.sampleRates)))
+		rateValid = Signal()
+		requestedConfig = Signal(range(len(dividers)))
+		currentConfig = Signal.like(requestedConfig, reset = self.sampleRates.index(48000) * len(self.sampleWidths))
+		accumulator = Signal(range(maxDenominator * 2))
+		nextAccumulator = Signal.like(accumulator)
+		framesRemaining = Signal(range(self._muteFrames + 1))
+		# When there's no active source the I²S engine is idle and we can switch immediately
+		idle = Signal()
+		frameDone = Signal()
+		edge = Signal()
+
+		# Map the requested sample rate onto the divider table, ignoring any rate we can't generate
+		m.d.comb += rateValid.eq(1)
+		with m.Switch(self.sampleRate):
+			for idx, sampleRate in enumerate(self.sampleRates):
+				with m.Case(sampleRate):
+					m.d.comb += rateIndex.eq(idx)
+			with m.Default():
+				m.d.comb += rateValid.eq(0)
+		m.d.comb += [
+			requestedConfig.eq(Cat(self.sampleBits != 15, rateIndex)),
+			idle.eq(self.sampleBits == 0),
+			frameDone.eq(self.needSample | idle),
+			edge.eq(self.clkEdge | idle),
+		]
+
+		# Each time a half of the audio clock completes, pick the length of the next half
+		m.d.comb += nextAccumulator.eq(accumulator + periodNumerator[currentConfig])
+		with m.If(self.clkEdge):
+			with m.If(nextAccumulator >= periodDenominator[currentConfig]):
+				m.d.sync += [
+					accumulator.eq(nextAccumulator - periodDenominator[currentConfig]),
+					self.clkDivider.eq(periodWhole[currentConfig] + 1),
+				]
+			with m.Else():
+				m.d.sync += [
+					accumulator.eq(nextAccumulator),
+					self.clkDivider.eq(periodWhole[currentConfig]),
+				]
+
+		with m.FSM(name = 'clockFSM'):
+			# Run with the current configuration until the source asks for a different one
+			with m.State('RUN'):
+				m.d.comb += self.mute.eq(0)
+				with m.If(rateValid & ~idle & (requestedConfig != currentConfig)):
+					m.d.sync += framesRemaining.eq(self._muteFrames)
+					m.next = 'MUTE'
+
+			# Mute the output and let silence propagate out to the DAC before touching the clock
+			with m.State('MUTE'):
+				m.d.comb += self.mute.eq(1)
+				with m.If(frameDone):
+					with m.If(framesRemaining == 0):
+						m.next = 'SWITCH'
+					with m.Else():
+						m.d.sync += framesRemaining.eq(framesRemaining - 1)
+
+			# Switch configuration on a clock edge so we never generate a runt half-clock
+			with m.State('SWITCH'):
+				m.d.comb += self.mute.eq(1)
+				with m.If(edge):
+					m.d.sync += [
+						currentConfig.eq(requestedConfig),
+						accumulator.eq(0),
+						self.clkDivider.eq(periodWhole[requestedConfig]),
+						framesRemaining.eq(self._muteFrames),
+					]
+					m.next = 'SETTLE'
+
+			# Hold the mute for a little while longer so the DAC can relock to the new clock
+			with m.State('SETTLE'):
+				m.d.comb += self.mute.eq(1)
+				with m.If(frameDone):
+					with m.If(framesRemaining == 0):
+						m.next = 'RUN'
+					with m.Else():
+						m.d.sync += framesRemaining.eq(framesRemaining - 1)
+
+		return m
@@ -0,0 +1,89 @@
+from torii.hdl import Elaboratable, Module, Signal, Array, signed
+from torii.build import Platform
+
+from .multiplier import SerialMultiplier
+
+__all__ = (
+	'Crossfade',
+)
+
+class Crossfade(Elaboratable):
+	'''
+	This ramps the level of the samples down to silence and back up again around a change of source, so
+	switching between them is click-free.
+
+	While fadeOut is high the gain steps down linearly each sample until it reaches 0, at which point
+	silent goes high and the source can be changed over underneath it. Once fadeOut goes low again the
+	gain steps back up to unity, taking fadeSamples samples each way. The gain starts out at 0 so the
+	first source to play fades in too. Samples at unity gain pass straight through, untouched, and unity
+	is high while that's so.
+
+	Pulse start when sampleIn is valid, done pulses when sampleOut has been updated.
+	'''
+
+	def __init__(self, *, fadeSamples = 64):
+		assert fadeSamples & (fadeSamples - 1) == 0, 'The number of samples to fade over must be a power of 2'
+		self._fadeSamples = fadeSamples
+
+		self.fadeOut = Signal()
+		self.silent = Signal()
+		self.unity = Signal()
+
+		self.start = Signal()
+		self.sampleIn = Array((Signal(signed(24), name = 'sampleInL'), Signal(signed(24), name = 'sampleInR')))
+		self.sampleOut = Array((Signal(signed(24), name = 'sampleOutL'), Signal(signed(24), name = 'sampleOutR')))
+		self.done = Signal()
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+		fadeSamples = self._fadeSamples
+		gainBits = (fadeSamples - 1).bit_length()
+
+		multipliers = []
+		for channel in range(2):
+			# The gain is unsigned, so give the multiplier an extra bit so it's never seen as negative
+			multiplier = SerialMultiplier(aWidth = 24, bWidth = gainBits + 2)
+			m.submodules[f'multiplier{channel}'] = multiplier
+			multipliers.append(multiplier)
+
+		# The gain is fixed point, with unity as fadeSamples
+		gain = Signal(range(fadeSamples + 1))
+
+		m.d.comb += [
+			self.silent.eq(gain == 0),
+			self.unity.eq(gain == fadeSamples),
+		]
+		for channel, multiplier in enumerate(multipliers):
+			m.d.comb += [
+				multiplier.a.eq(self.sampleIn[channel]),
+				multiplier.b.eq(gain),
+			]
+		m.d.sync += self.done.eq(0)
+
+		with m.FSM(name = 'crossfadeFSM'):
+			with m.State('IDLE'):
+				with m.If(self.start):
+					with m.If(gain == fadeSamples):
+						m.d.sync += [sampleOut.eq(sample) for sampleOut, sample in zip(self.sampleOut, self.sampleIn)]
+						m.d.sync += self.done.eq(1)
+					with m.Else():
+						m.d.comb += [multiplier.start.eq(1) for multiplier in multipliers]
+						m.next = 'WAIT'
+
+					# Step the gain on for the next sample
+					with m.If(self.fadeOut):
+						with m.If(gain != 0):
+							m.d.sync += gain.eq(gain - 1)
+					with m.Elif(gain != fadeSamples):
+						m.d.sync += gain.eq(gain + 1)
+
+			with m.State('WAIT'):
+				with m.If(multipliers[0].done):
+					m.d.sync += [
+						sampleOut.eq(multiplier.product.shift_right(gainBits))
+						for sampleOut, multiplier in zip(self.sampleOut, multipliers)
+					]
+					m.d.sync += self.done.eq(1)
+					m.next = 'IDLE'
+
+		return m
@@ -0,0 +1,131 @@
+from torii.hdl import Elaboratable, Module, Signal, Array, Const, Cat, Mux, signed
+from torii.build import Platform
+
+from ..spi import SPIPort
+from ..usb.control import AudioRequestHandler
+
+__all__ = (
+	'DACControl',
+)
+
+class DACControl(Elaboratable):
+	'''
+	This keeps the PCM1796 DAC's control registers in step with the host's volume, mute and power domain
+	settings, so attenuation can happen in the DAC rather than costing us anything in the datapath.
+
+	The DAC's registers are written as 16-bit SPI words made up of the register address (with the top
+	bit clear to indicate a write) followed by the data. We keep a shadow of what we last wrote to each
+	register and compare that to what the host's settings currently say the register should hold. Any
+	register that differs is queued for writing, and the value written is always whatever is current
+	at the time, so bursts of rapid updates from the host coalesce into a single write of the latest.
+
+	The DAC's audio format is kept matched to the I²S engine's slot width, which follows sampleBits:
+	16-bit I²S while playing 16-bit audio, and 24-bit I²S otherwise.
+	'''
+
+	# Digital attenuation (left, right), attenuation and format control, and function control
+	registerAddresses = (16, 17, 18, 19)
+	# What the DAC's registers hold after reset
+	registerDefaults = (0xff, 0xff, 0x50, 0x00)
+	# Attenuation load enable, and the 16-bit and 24-bit I²S formats
+	attenuationLoad = 0x80
+	format16BitI2S = 0x40
+	format24BitI2S = 0x50
+	# Setting this in register 19 disables the DAC's output
+	outputDisable = 0x10
+
+	def __init__(self, requestHandler : AudioRequestHandler, spi : SPIPort, *, applyVolume = True):
+		self._requestHandler = requestHandler
+		self._spi = spi
+		# If the volume is being applied in the playback path instead, leave the DAC at 0dB
+		self._applyVolume = applyVolume
+
+		# The bit depth of the audio being played, as the playback path's sampleBits
+		self.sampleBits = Signal(range(25))
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+		requestHandler = self._requestHandler
+		spi = self._spi
+
+		registerCount = len(self.registerAddresses)
+		registers = Array(Signal(8, name = f'register{address}') for address in self.registerAddresses)
+		shadows = Array(
+			Signal(8, name = f'shadow{address}', reset = default)
+			for address, default in zip(self.registerAddresses, self.registerDefaults)
+		)
+		addresses = Array(Const(address, 8) for address in self.registerAddresses)
+		dirty = Signal(registerCount)
+		register = Signal(range(registerCount))
+		value = Signal(8)
+
+		# The DAC's attenuation is in 0.5dB steps down from 0xff for 0dB, with anything below 0x0f muting the channel
+		for channel in range(2):
+			if not self._applyVolume:
+				m.d.comb += registers[channel].eq(0xff)
+				continue
+			volume = Signal(signed(17), name = f'totalVolume{channel}')
+			m.d.comb += volume.eq(
+				requestHandler.volumeStates[0].as_signed() + requestHandler.volumeStates[channel + 1].as_signed()
+			)
+			with m.If(requestHandler.muteStates[channel + 1]):
+				m.d.comb += registers[channel].eq(0x00)
+			with m.Elif(volume >= 0):
+				m.d.comb += registers[channel].eq(0xff)
+			with m.Elif(volume < -120):
+				m.d.comb += registers[channel].eq(0x0f)
+			with m.Else():
+				m.d.comb += registers[channel].eq(0xff + (volume << 1))
+
+		m.d.comb += [
+			registers[2].eq(
+				self.attenuationLoad | Mux(self.sampleBits == 16, self.format16BitI2S, self.format24BitI2S) |
+				(requestHandler.muteStates[0] if self._applyVolume else 0)
+			),
+			# Power domain states D2 and deeper power the DAC's output stage down
+			registers[3].eq(Mux(requestHandler.powerState >= 2, self.outputDisable, 0)),
+			dirty.eq(Cat(registers[idx] != shadows[idx] for idx in range(registerCount))),
+			spi.chipSelect.eq(0),
+		]
+
+		with m.FSM(domain = 'usb', name = 'dacFSM'):
+			# Wait for one of the registers to need updating, picking the lowest numbered
+			with m.State('IDLE'):
+				for idx in reversed(range(registerCount)):
+					with m.If(dirty[idx]):
+						m.d.usb += register.eq(idx)
+				with m.If(dirty != 0):
+					m.next = 'LATCH'
+
+			# Grab the current value of the register to write and begin the SPI transaction once we have the bus
+			with m.State('LATCH'):
+				m.d.usb += value.eq(registers[register])
+				m.d.comb += [
+					spi.select.eq(1),
+					spi.dataOut.eq(addresses[register]),
+				]
+				with m.If(spi.granted):
+					m.d.comb += spi.start.eq(1)
+					m.next = 'ADDRESS'
+
+			# Once the address is out, follow it straight up with the data
+			with m.State('ADDRESS'):
+				m.d.comb += [
+					spi.select.eq(1),
+					spi.dataOut.eq(value),
+				]
+				with m.If(spi.done):
+					m.d.comb += spi.start.eq(1)
+					m.next = 'DATA'
+
+			with m.State('DATA'):
+				m.d.comb += spi.select.eq(1)
+				with m.If(spi.done):
+					m.d.usb += shadows[register].eq(value)
+					m.next = 'DESELECT'
+
+			# Give the DAC a cycle with chip select high between words
+			with m.State('DESELECT'):
+				m.next = 'IDLE'
+
+		return m
@@ -0,0 +1,153 @@
+from math import exp, pi
+from torii.hdl import Elaboratable, Module, Signal, Array, signed
+from torii.build import Platform
+
+from .multiplier import SerialMultiplier
+
+__all__ = (
+	'DeEmphasis',
+)
+
+class DeEmphasis(Elaboratable):
+	'''
+	This undoes the 50/15µs pre-emphasis some S/PDIF sources (mostly CD-era material) mark their audio
+	as having, with a first-order shelving IIR: y = b0·x + b1·x₁ - a1·y₁.
+
+	The coefficients are fitted to the analog de-emphasis network, tracking it to within about 0.3dB
+	across the audio band, and are picked for the current sample rate from a small table. Each channel
+	has one shift-add multiplier, used three times per sample.
+
+	The filter history is kept up to date even when not enabled, tracking the input as a pass through
+	would, so it can be switched in and out between samples (such as at an S/PDIF block boundary)
+	without a transient. Pulse start when sampleIn is valid, done pulses when sampleOut has been updated.
+	'''
+
+	sampleRates = (32000, 44100, 48000, 88200, 96000)
+	# Coefficients are signed Q1.16
+	coefficientWidth = 18
+	coefficientBits = 16
+	# Time constants of the pre-emphasis network's pole and zero
+	poleTime = 50e-6
+	zeroTime = 15e-6
+
+	def __init__(self):
+		self.enable = Signal()
+		self.sampleRate = Signal(range(192000))
+
+		self.start = Signal()
+		self.sampleIn = Array((Signal(signed(24), name = 'sampleInL'), Signal(signed(24), name = 'sampleInR')))
+		self.sampleOut = Array((Signal(signed(24), name = 'sampleOutL'), Signal(signed(24), name = 'sampleOutR')))
+		self.done = Signal()
+
+	def coefficientsFor(self, sampleRate : int):
+		''' Computes the b0, b1 and a1 de-emphasis coefficients for a sample rate '''
+		# Place the pole where the analog network's pole lands once sampled
+		pole = exp(-1 / (sampleRate * self.poleTime))
+		# A bilinear transform squashes the shelf in towards Nyquist, so instead place the zero such that the
+		# gain at Nyquist matches what the analog network's is there
+		frequency = pi * sampleRate
+		gain = abs((1 + 1j * frequency * self.zeroTime) / (1 + 1j * frequency * self.poleTime))
+		ratio = gain * (1 + pole) / (1 - pole)
+		zero = (ratio - 1) / (ratio + 1)
+		# Then normalise so the filter has unity gain at DC
+		scale = (1 - pole) / (1 - zero)
+		coefficients = (scale, -scale * zero, -pole)
+		return tuple(round(coefficient * (1 << self.coefficientBits)) for coefficient in coefficients)
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+
+		multipliers = []
+		for channel in range(2):
+			multiplier = SerialMultiplier(aWidth = 24, bWidth = self.coefficientWidth)
+			m.submodules[f'multiplier{channel}'] = multiplier
+			multipliers.append(multiplier)
+
+		coefficients = Array(Signal(signed(self.coefficientWidth), name = f'coefficient{i}') for i in range(3))
+		rateSupported = Signal()
+		inputs = [Signal(signed(24), name = f'input{channel}') for channel in range(2)]
+		previousInputs = [Signal(signed(24), name = f'previousInput{channel}') for channel in range(2)]
+		previousOutputs = [Signal(signed(24), name = f'previousOutput{channel}') for channel in range(2)]
+		accumulators = [
+			Signal(signed(24 + self.coefficientWidth + 2), name = f'accumulator{channel}') for channel in range(2)
+		]
+		step = Signal(range(3))
+
+		# Pick the coefficients for the sample rate, only running the filter at rates we know
+		m.d.comb += rateSupported.eq(0)
+		with m.Switch(self.sampleRate):
+			for sampleRate in self.sampleRates:
+				with m.Case(sampleRate):
+					m.d.comb += [
+						coefficient.eq(value)
+						for coefficient, value in zip(coefficients, self.coefficientsFor(sampleRate))
+					]
+					m.d.comb += rateSupported.eq(1)
+
+		# Each step multiplies x by b0, then x₁ by b1, then y₁ by a1, which is subtracted
+		for channel, multiplier in enumerate(multipliers):
+			operands = Array((inputs[channel], previousInputs[channel], previousOutputs[channel]))
+			m.d.comb += [
+				multiplier.a.eq(operands[step]),
+				multiplier.b.eq(coefficients[step]),
+			]
+		m.d.sync += self.done.eq(0)
+
+		with m.FSM(name = 'deemphasisFSM'):
+			with m.State('IDLE'):
+				m.d.sync += step.eq(0)
+				m.d.sync += [accumulator.eq(0) for accumulator in accumulators]
+				with m.If(self.start):
+					with m.If(self.enable & rateSupported):
+						m.d.sync += [value.eq(sample) for value, sample in zip(inputs, self.sampleIn)]
+						m.next = 'MULTIPLY'
+					# When not filtering, pass the sample through and keep the history following along
+					with m.Else():
+						for channel in range(2):
+							m.d.sync += [
+								self.sampleOut[channel].eq(self.sampleIn[channel]),
+								previousInputs[channel].eq(self.sampleIn[channel]),
+								previousOutputs[channel].eq(self.sampleIn[channel]),
+							]
+						m.d.sync += self.done.eq(1)
+
+			with m.State('MULTIPLY'):
+				m.d.comb += [multiplier.start.eq(1) for multiplier in multipliers]
+				m.next = 'WAIT'
+
+			with m.State('WAIT'):
+				with m.If(multipliers[0].done):
+					with m.If(step == 2):
+						m.d.sync += [
+							accumulator.eq(accumulator - multiplier.product)
+							for accumulator, multiplier in zip(accumulators, multipliers)
+						]
+						m.next = 'OUTPUT'
+					with m.Else():
+						m.d.sync += [
+							accumulator.eq(accumulator + multiplier.product)
+							for accumulator, multiplier in zip(accumulators, multipliers)
+						]
+						m.d.sync += step.eq(step + 1)
+						m.next = 'MULTIPLY'
+
+			# Scale the result back down, saturate it into the output and move the history along
+			with m.State('OUTPUT'):
+				for channel in range(2):
+					result = accumulators[channel].shift_right(self.coefficientBits)
+					output = Signal(signed(24), name = f'output{channel}')
+					with m.If(result > 0x7fffff):
+						m.d.comb += output.eq(0x7fffff)
+					with m.Elif(result < -0x800000):
+						m.d.comb += output.eq(-0x800000)
+					with m.Else():
+						m.d.comb += output.eq(result)
+					m.d.sync += [
+						self.sampleOut[channel].eq(output),
+						previousInputs[channel].eq(inputs[channel]),
+						previousOutputs[channel].eq(output),
+					]
+				m.d.sync += self.done.eq(1)
+				m.next = 'IDLE'
+
+		return m
@@ -0,0 +1,124 @@
+from torii.hdl import Elaboratable, Module, Signal, Array, Cat, Const, Mux, signed
+from torii.build import Platform
+
+__all__ = (
+	'Requantiser',
+)
+
+class Requantiser(Elaboratable):
+	'''
+	This reduces the word length of the playback samples for the DAC, adding TPDF dither and optionally
+	shaping the requantisation noise up out of the audio band, rather than just truncating.
+
+	The dither is made by summing two uniformly distributed values taken from a free-running LFSR,
+	which is fully refreshed between samples, giving triangular noise spanning ±1 LSB of the output.
+	Noise shaping is done by error feedback: the difference between what was output and what was asked
+	for is fed back into the following samples through either a first-order (1 - z⁻¹) or second-order
+	((1 - z⁻¹)²) filter. The channels are processed one after the other so they share the arithmetic.
+
+	Whether to requantise is decided for the stream as a whole, not sample by sample, as switching the
+	dither and shaping in and out on the samples' low bits would make the noise floor follow the signal.
+	enable should be high when the output is narrower than the samples and they've been processed on
+	the way, and low for an unprocessed 16-bit stream so bit-perfect playback stays that way, or when the
+	output is wide enough. When enable is low samples pass straight through. Pulse start when sampleIn is
+	valid, done pulses when sampleOut has been updated with the low dropBits cleared.
+	'''
+
+	# x³² + x²² + x² + x + 1, a maximal length polynomial
+	lfsrTaps = 0x80200003
+
+	def __init__(self, *, dropBits = 8):
+		assert 1 <= dropBits <= 8, 'The number of bits to drop must be between 1 and 8'
+		self._dropBits = dropBits
+
+		self.enable = Signal()
+		self.dither = Signal()
+		# The order of the noise shaping filter to use, 0 for none
+		self.shaping = Signal(range(3))
+
+		self.start = Signal()
+		self.sampleIn = Array((Signal(signed(24), name = 'sampleInL'), Signal(signed(24), name = 'sampleInR')))
+		self.sampleOut = Array((Signal(signed(24), name = 'sampleOutL'), Signal(signed(24), name = 'sampleOutR')))
+		self.done = Signal()
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+		dropBits = self._dropBits
+
+		lfsr = Signal(32, reset = 1)
+		channel = Signal()
+		# The requantisation error, which spans about ±1.5 output LSBs, for the last two samples of each channel
+		errorWidth = dropBits + 3
+		errors = [Array(Signal(signed(errorWidth), name = f'error{i}_{delay}') for i in range(2)) for delay in range(2)]
+		ditherValue = Signal(signed(dropBits + 2))
+		feedback = Signal(signed(errorWidth + 2))
+		target = Signal(signed(24 + 2))
+		rounded = Signal(signed(24 + 3))
+		quantised = Signal(signed(24 + 3))
+		error = Signal(signed(errorWidth))
+
+		# Step the LFSR every cycle, as that runs through the whole thing many times over between samples
+		m.d.sync += lfsr.eq(lfsr[1:] ^ Mux(lfsr[0], Const(self.lfsrTaps, 32), 0))
+
+		# Two uniform values of dropBits each summed and recentred gives triangular dither spanning ±1 output LSB.
+		# Each channel uses its own half of the LFSR so the two channels' dither is uncorrelated
+		uniformMax = (1 << dropBits) - 1
+		uniform = [lfsr.word_select(idx, 8)[0:dropBits] for idx in range(4)]
+		with m.If(self.dither):
+			with m.If(channel == 0):
+				m.d.comb += ditherValue.eq(uniform[0] + uniform[1] - uniformMax)
+			with m.Else():
+				m.d.comb += ditherValue.eq(uniform[2] + uniform[3] - uniformMax)
+		with m.Else():
+			m.d.comb += ditherValue.eq(0)
+
+		with m.Switch(self.shaping):
+			with m.Case(1):
+				m.d.comb += feedback.eq(errors[0][channel])
+			with m.Case(2):
+				m.d.comb += feedback.eq((errors[0][channel] << 1) - errors[1][channel])
+			with m.Default():
+				m.d.comb += feedback.eq(0)
+
+		# Subtract the shaped error from the sample, then round it to the output word length with the dither added
+		m.d.comb += [
+			target.eq(self.sampleIn[channel] - feedback),
+			rounded.eq(target + ditherValue + (1 << (dropBits - 1))),
+			quantised.eq(Cat(Const(0, dropBits), rounded[dropBits:])),
+			error.eq(quantised - target),
+		]
+		m.d.sync += self.done.eq(0)
+
+		with m.FSM(name = 'requantiserFSM'):
+			with m.State('IDLE'):
+				m.d.sync += channel.eq(0)
+				with m.If(self.start):
+					m.next = 'PROCESS'
+
+			with m.State('PROCESS'):
+				with m.If(self.enable):
+					# Saturate into the output, but feed back the error from before saturation so clipping
+					# can't make the shaping filter go unstable
+					with m.If(quantised > 0x7fffff):
+						m.d.sync += self.sampleOut[channel].eq(0x800000 - (1 << dropBits))
+					with m.Elif(quantised < -0x800000):
+						m.d.sync += self.sampleOut[channel].eq(-0x800000)
+					with m.Else():
+						m.d.sync += self.sampleOut[channel].eq(quantised)
+					m.d.sync += [
+						errors[0][channel].eq(error),
+						errors[1][channel].eq(errors[0][channel]),
+					]
+				with m.Else():
+					m.d.sync += [
+						self.sampleOut[channel].eq(self.sampleIn[channel]),
+						errors[0][channel].eq(0),
+						errors[1][channel].eq(0),
+					]
+
+				m.d.sync += channel.eq(1)
+				with m.If(channel == 1):
+					m.d.sync += self.done.eq(1)
+					m.next = 'IDLE'
+
+		return m
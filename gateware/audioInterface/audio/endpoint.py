@@ -16,6 +16,9 @@ class AudioEndpoint(Elaboratable):
 		self.next_address = Signal.like(self.address)
 		self.value = Signal(8)
 		self.valid = Signal()
+		# Pulsed as each packet to this endpoint completes, or is thrown away as invalid
+		self.packetReceived = Signal()
+		self.packetRejected = Signal()
 
 	def elaborate(self, platform):
 		m = Module()
@@ -55,6 +58,10 @@ class AudioEndpoint(Elaboratable):
 					]
 
 				with m.If(interface.rx_complete | interface.rx_invalid):
+					m.d.comb += [
+						self.packetReceived.eq(interface.rx_complete),
+						self.packetRejected.eq(interface.rx_invalid),
+					]
 					m.next = 'IDLE'
 
 		return m
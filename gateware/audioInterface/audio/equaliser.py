@@ -0,0 +1,191 @@
+from torii.hdl import Elaboratable, Module, Signal, Array, Memory, Cat, Const, signed
+from torii.build import Platform
+
+from .multiplier import SerialMultiplier
+
+__all__ = (
+	'Equaliser',
+)
+
+class Equaliser(Elaboratable):
+	'''
+	This implements a parametric equaliser as a cascade of direct form I biquads, for headphone correction.
+
+	Each band computes y = b0·x + b1·x₁ + b2·x₂ - a1·y₁ - a2·y₂ with coefficients in signed Q2.16. The
+	multiplies are done with shift-add multipliers, two per channel so the feed-forward and feedback halves
+	of each band run side by side, with both channels in parallel. A band takes 3 multiplies' worth of time,
+	about 64 cycles, so the default of 5 bands fits inside one sample period at up to 96kHz. The delay
+	lines are shared between neighbouring bands, as one band's output history is the next band's input history.
+
+	The coefficients live in EBR, in two banks. The host writes a new set into the bank not currently
+	in use through the usb domain write port, and then flips bank to swap them over, which only happens
+	at a sample boundary so updates are glitch-free. Each band's coefficients are stored in the order
+	b0, b1, b2, a1, a2, and the banks start out with every band a pass through.
+
+	Pulse start when sampleIn is valid, done pulses when sampleOut has been updated. When not enabled
+	samples are moved straight through.
+	'''
+
+	coefficientWidth = 18
+	coefficientBits = 16
+
+	def __init__(self, *, bands = 5):
+		self._bands = bands
+
+		self.enable = Signal()
+		self.bank = Signal()
+		self.start = Signal()
+		self.sampleIn = Array((Signal(signed(24), name = 'sampleInL'), Signal(signed(24), name = 'sampleInR')))
+		self.sampleOut = Array((Signal(signed(24), name = 'sampleOutL'), Signal(signed(24), name = 'sampleOutR')))
+		self.done = Signal()
+
+		# The usb domain coefficient write port, which writes to the bank that is not `writeBank`
+		self.writeBank = Signal()
+		self.writeBand = Signal(range(bands))
+		self.writeIndex = Signal(range(5))
+		self.writeData = Signal(self.coefficientWidth)
+		self.writeEnable = Signal()
+
+	def generateCoefficients(self):
+		''' Generates the initial contents of both coefficient banks, setting every band to pass through '''
+		bandBits = (self._bands - 1).bit_length()
+		passThrough = [1 << self.coefficientBits] + [0] * 7
+		return passThrough * (2 << bandBits)
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+		bands = self._bands
+		bandBits = (bands - 1).bit_length()
+
+		# Coefficients are addressed by their index within the band, then the band, then the bank. Indices 5-7
+		# are never written and so hold 0, which lets the feedback multipliers sit the last step out
+		memory = Memory(
+			width = self.coefficientWidth, depth = 2 * (8 << bandBits), init = self.generateCoefficients()
+		)
+		m.submodules.feedForwardCoefficient = feedForwardPort = memory.read_port(transparent = False)
+		m.submodules.feedbackCoefficient = feedbackPort = memory.read_port(transparent = False)
+		m.submodules.coefficientWrite = writePort = memory.write_port(domain = 'usb')
+
+		feedForward = []
+		feedback = []
+		for channel in range(2):
+			multiplier = SerialMultiplier(aWidth = 24, bWidth = self.coefficientWidth)
+			m.submodules[f'feedForward{channel}'] = multiplier
+			feedForward.append(multiplier)
+			multiplier = SerialMultiplier(aWidth = 24, bWidth = self.coefficientWidth)
+			m.submodules[f'feedback{channel}'] = multiplier
+			feedback.append(multiplier)
+
+		# The delay lines at the input to each band and the output of the last
+		delays = [
+			[
+				Array(Signal(signed(24), name = f'delay{channel}_{node}_{delay}') for node in range(bands + 1))
+				for delay in range(2)
+			]
+			for channel in range(2)
+		]
+		current = [Signal(signed(24), name = f'current{channel}') for channel in range(2)]
+		accumulators = [
+			Signal(signed(24 + self.coefficientWidth + 2), name = f'accumulator{channel}') for channel in range(2)
+		]
+		results = [Signal(signed(24), name = f'result{channel}') for channel in range(2)]
+		activeBank = Signal()
+		band = Signal(range(bands))
+		step = Signal(range(3))
+
+		m.d.comb += [
+			feedForwardPort.addr.eq(Cat(step, Const(0, 1), band[:bandBits], activeBank)),
+			feedbackPort.addr.eq(Cat(step + 3, band[:bandBits], activeBank)),
+			writePort.addr.eq(Cat(self.writeIndex, self.writeBand[:bandBits], ~self.writeBank)),
+			writePort.data.eq(self.writeData),
+			writePort.en.eq(self.writeEnable),
+		]
+		m.d.sync += self.done.eq(0)
+
+		# Pick the operands for each step: x·b0 and y₁·a1, then x₁·b1 and y₂·a2, then x₂·b2
+		for channel in range(2):
+			inputs = Array((current[channel], delays[channel][0][band], delays[channel][1][band]))
+			outputs = Array((delays[channel][0][band + 1], delays[channel][1][band + 1], Const(0, signed(24))))
+			m.d.comb += [
+				feedForward[channel].a.eq(inputs[step]),
+				feedForward[channel].b.eq(feedForwardPort.data),
+				feedback[channel].a.eq(outputs[step]),
+				feedback[channel].b.eq(feedbackPort.data),
+			]
+
+			# Scale the band's result back down and saturate it
+			result = accumulators[channel].shift_right(self.coefficientBits)
+			with m.If(result > 0x7fffff):
+				m.d.comb += results[channel].eq(0x7fffff)
+			with m.Elif(result < -0x800000):
+				m.d.comb += results[channel].eq(-0x800000)
+			with m.Else():
+				m.d.comb += results[channel].eq(result)
+
+		with m.FSM(name = 'equaliserFSM'):
+			with m.State('IDLE'):
+				m.d.sync += [
+					band.eq(0),
+					step.eq(0),
+				]
+				m.d.sync += [accumulator.eq(0) for accumulator in accumulators]
+				with m.If(self.start):
+					with m.If(self.enable):
+						# Only pick up a bank swap here, between samples
+						m.d.sync += activeBank.eq(self.bank)
+						m.d.sync += [value.eq(sample) for value, sample in zip(current, self.sampleIn)]
+						m.next = 'FETCH'
+					with m.Else():
+						m.d.sync += [sampleOut.eq(sample) for sampleOut, sample in zip(self.sampleOut, self.sampleIn)]
+						m.d.sync += self.done.eq(1)
+
+			# Give the coefficient reads for this step a cycle to complete
+			with m.State('FETCH'):
+				m.next = 'MULTIPLY'
+
+			with m.State('MULTIPLY'):
+				m.d.comb += [multiplier.start.eq(1) for multiplier in feedForward + feedback]
+				m.next = 'WAIT'
+
+			with m.State('WAIT'):
+				with m.If(feedForward[0].done):
+					m.d.sync += [
+						accumulators[channel].eq(
+							accumulators[channel] + feedForward[channel].product - feedback[channel].product
+						)
+						for channel in range(2)
+					]
+					m.d.sync += step.eq(step + 1)
+					with m.If(step == 2):
+						m.next = 'BAND-DONE'
+					with m.Else():
+						m.next = 'FETCH'
+
+			# Move this band's input history along, and feed its output on to the next band
+			with m.State('BAND-DONE'):
+				for channel in range(2):
+					m.d.sync += [
+						delays[channel][1][band].eq(delays[channel][0][band]),
+						delays[channel][0][band].eq(current[channel]),
+						current[channel].eq(results[channel]),
+						accumulators[channel].eq(0),
+					]
+				m.d.sync += step.eq(0)
+				with m.If(band == bands - 1):
+					m.next = 'OUTPUT'
+				with m.Else():
+					m.d.sync += band.eq(band + 1)
+					m.next = 'FETCH'
+
+			# Move the last band's output history along, and output the result
+			with m.State('OUTPUT'):
+				for channel in range(2):
+					m.d.sync += [
+						delays[channel][1][bands].eq(delays[channel][0][bands]),
+						delays[channel][0][bands].eq(current[channel]),
+						self.sampleOut[channel].eq(current[channel]),
+					]
+				m.d.sync += self.done.eq(1)
+				m.next = 'IDLE'
+
+		return m
@@ -12,11 +12,14 @@ class Channel(IntEnum):
 
 class I2S(Elaboratable):
 	def __init__(self):
-		# Max division is 12, but because we need to generate both halfs of the clock this is 6.
-		self.clkDivider = Signal(range(6))
+		# Max division is 36, but because we need to generate both halfs of the clock this is 18.
+		# That covers 32kHz 16-bit audio from the 36.864MHz system clock.
+		self.clkDivider = Signal(range(18))
 		self.sampleBits = Signal(range(24))
 		self.sample = Array((Signal(24, name = 'sampleL'), Signal(24, name = 'sampleR')))
 		self.needSample = Signal()
+		# Pulses each time a half of the audio clock completes, so the divider can be retuned glitch-free
+		self.clkEdge = Signal()
 
 	def elaborate(self, platform : Platform) -> Module:
 		m = Module()
@@ -34,6 +37,8 @@ class I2S(Elaboratable):
 		m.d.sync += sampleLatch.eq(channelCurrent)
 		m.d.comb += self.needSample.eq((~channelCurrent) & sampleLatch)
 
+		m.d.comb += self.clkEdge.eq(0)
+
 		with m.FSM():
 			with m.State('IDLE'):
 				m.d.sync += [
@@ -50,6 +55,7 @@ class I2S(Elaboratable):
 
 			with m.State('SETUP'):
 				with m.If(clkCounter == self.clkDivider):
+					m.d.comb += self.clkEdge.eq(1)
 					m.d.sync += [
 						clkCounter.eq(0),
 						audioClk.eq(~audioClk),
@@ -71,6 +77,7 @@ class I2S(Elaboratable):
 				# Each time the system clock to data clock counter fills to the set value,
 				# Do one half of the audio data clock cycle.
 				with m.If(clkCounter == self.clkDivider):
+					m.d.comb += self.clkEdge.eq(1)
 					m.d.sync += [
 						clkCounter.eq(0),
 						audioClk.eq(~audioClk),
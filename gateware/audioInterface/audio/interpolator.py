@@ -0,0 +1,159 @@
+from math import pi, sin, cos
+from torii.hdl import Elaboratable, Module, Signal, Array, Memory, Cat, signed
+from torii.build import Platform
+
+from .multiplier import SerialMultiplier
+
+__all__ = (
+	'Interpolator',
+)
+
+class Interpolator(Elaboratable):
+	'''
+	This implements a polyphase oversampling FIR interpolator to sit between the sample processing
+	stages and the I²S engine, taking some of the reconstruction work off the DAC's own filter.
+
+	The prototype filter is a Blackman windowed-sinc designed for the maximum oversampling factor, and
+	is stored in EBR split into `factor` phases of `taps` coefficients. Each output sample is computed
+	by applying one phase to the input history, for both channels in parallel, with shift-add
+	multipliers. Running at a lower oversampling factor just steps through the phases more than one at a
+	time, and as the sinc is 0 at every whole input sample the first phase is a plain (delayed) pass
+	through, so factorShift set to 0 gives 1x without needing a bypass.
+
+	The filter response is picked at construction time from `responses`, trading latency (half the
+	number of taps, in input samples) against passband ripple and stopband rejection. Note that each
+	output sample takes about 19 cycles per tap, so the longest response only just fits at 192kHz out.
+
+	Pulse start when the next output sample is wanted, and if consume is high then sampleIn is shifted
+	into the history. done pulses when sampleOut has been updated.
+	'''
+
+	# The available filter responses, and how many taps each phase has for them
+	responses = {
+		'short': 4,
+		'long': 8,
+	}
+	coefficientBits = 14
+
+	def __init__(self, *, factor = 4, response = 'long'):
+		assert factor in (2, 4), 'The oversampling factor must be 2 or 4'
+		assert response in self.responses, f'The filter response must be one of {", ".join(self.responses)}'
+		self._factor = factor
+		self._taps = self.responses[response]
+		# The filter's group delay, in input samples
+		self.latency = self._taps // 2
+
+		# The oversampling factor to run at, as a power of 2
+		self.factorShift = Signal(range((factor - 1).bit_length() + 1))
+		self.start = Signal()
+		self.consume = Signal()
+
+		self.sampleIn = Array((Signal(signed(24), name = 'sampleInL'), Signal(signed(24), name = 'sampleInR')))
+		self.sampleOut = Array((Signal(signed(24), name = 'sampleOutL'), Signal(signed(24), name = 'sampleOutR')))
+		self.done = Signal()
+
+	def generateCoefficients(self):
+		''' Generates the Blackman windowed-sinc interpolation filter, one set of taps per phase '''
+		taps = self._taps
+		factor = self._factor
+		coefficients = []
+		for phase in range(factor):
+			offset = phase / factor
+			values = []
+			for tap in range(taps):
+				# Time of this tap relative to the output sample, which sits between the middle two taps
+				time = tap - (taps // 2 - 1) - offset
+				sinc = 1.0 if time == 0 else sin(pi * time) / (pi * time)
+				window = (time + taps / 2) / taps
+				blackman = 0.42 - 0.5 * cos(2 * pi * window) + 0.08 * cos(4 * pi * window)
+				values.append(sinc * blackman)
+			# Normalise each phase to unity gain at DC so the phases don't modulate the level between them
+			total = sum(values)
+			scale = 1 << self.coefficientBits
+			coefficients.extend(round(value / total * scale) & 0xffff for value in values)
+		return coefficients
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+
+		taps = self._taps
+		tapBits = (taps - 1).bit_length()
+		phaseBits = (self._factor - 1).bit_length()
+
+		rom = Memory(width = 16, depth = taps * self._factor, init = self.generateCoefficients())
+		m.submodules.coefficients = readPort = rom.read_port(transparent = False)
+		multipliers = []
+		for channel in range(2):
+			multiplier = SerialMultiplier(aWidth = 24, bWidth = 16)
+			m.submodules[f'multiplier{channel}'] = multiplier
+			multipliers.append(multiplier)
+
+		history = [
+			Array(Signal(signed(24), name = f'history{channel}_{tap}') for tap in range(taps))
+			for channel in range(2)
+		]
+		accumulators = [Signal(signed(24 + 16 + tapBits), name = f'accumulator{channel}') for channel in range(2)]
+		tap = Signal(range(taps + 1))
+		phase = Signal(phaseBits)
+		# How many bits of the phase to skip over, to step through them at the right rate for the factor
+		phaseSkip = Signal(range(phaseBits + 1))
+
+		m.d.comb += [
+			readPort.addr.eq(Cat(tap[:tapBits], phase)),
+			self.consume.eq(self.start & (phase == 0)),
+			phaseSkip.eq(phaseBits - self.factorShift),
+		]
+		m.d.sync += self.done.eq(0)
+		for channel, multiplier in enumerate(multipliers):
+			m.d.comb += [
+				multiplier.a.eq(history[channel][tap[:tapBits]]),
+				multiplier.b.eq(readPort.data),
+			]
+
+		with m.FSM(name = 'interpolatorFSM'):
+			with m.State('IDLE'):
+				m.d.sync += tap.eq(0)
+				with m.If(self.start):
+					m.d.sync += [accumulator.eq(0) for accumulator in accumulators]
+					# At the start of each input sample period, shift the next input sample into the history
+					with m.If(self.consume):
+						for channel in range(2):
+							m.d.sync += [history[channel][idx].eq(history[channel][idx + 1]) for idx in range(taps - 1)]
+							m.d.sync += history[channel][taps - 1].eq(self.sampleIn[channel])
+					m.next = 'TAP-START'
+
+			# Kick off the multiplies for the next tap and move the coefficient read on to the tap after
+			with m.State('TAP-START'):
+				m.d.comb += [multiplier.start.eq(1) for multiplier in multipliers]
+				m.d.sync += tap.eq(tap + 1)
+				m.next = 'TAP-WAIT'
+
+			with m.State('TAP-WAIT'):
+				with m.If(multipliers[0].done):
+					m.d.sync += [
+						accumulator.eq(accumulator + multiplier.product)
+						for accumulator, multiplier in zip(accumulators, multipliers)
+					]
+					with m.If(tap == taps):
+						m.next = 'OUTPUT'
+					with m.Else():
+						m.next = 'TAP-START'
+
+			# Scale the result back down and saturate it into the output, then move on to the next phase
+			with m.State('OUTPUT'):
+				for accumulator, sampleOut in zip(accumulators, self.sampleOut):
+					result = accumulator.shift_right(self.coefficientBits)
+					with m.If(result > 0x7fffff):
+						m.d.sync += sampleOut.eq(0x7fffff)
+					with m.Elif(result < -0x800000):
+						m.d.sync += sampleOut.eq(-0x800000)
+					with m.Else():
+						m.d.sync += sampleOut.eq(result)
+				m.d.sync += [
+					# Clear the skipped bits as we step, so changing factor mid-sample can't leave us off the phase grid
+					phase.eq(((phase >> phaseSkip) + 1) << phaseSkip),
+					self.done.eq(1),
+				]
+				m.next = 'IDLE'
+
+		return m
@@ -0,0 +1,77 @@
+from torii.hdl import Elaboratable, Module, Signal, Mux, Cat, signed
+from torii.build import Platform
+
+__all__ = (
+	'SerialMultiplier',
+)
+
+class SerialMultiplier(Elaboratable):
+	'''
+	This implements a signed shift-add (Robertson's algorithm) multiplier that retires one bit of
+	the multiplier per clock. The HX8K has no DSP blocks, so this trades time for LUTs: an
+	`aWidth` x `bWidth` multiply costs a single `aWidth + 1` bit adder and takes `bWidth` clocks.
+
+	Pulse start with the operands set up to begin a multiplication. The operands are latched on
+	start, and done pulses for one cycle when product is valid. product then holds its value
+	until the next start.
+	'''
+
+	def __init__(self, *, aWidth : int, bWidth : int, domain = 'sync'):
+		self._domain = domain
+
+		self.a = Signal(signed(aWidth))
+		self.b = Signal(signed(bWidth))
+		self.start = Signal()
+
+		self.product = Signal(signed(aWidth + bWidth))
+		self.busy = Signal()
+		self.done = Signal()
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+		domain = m.d[self._domain]
+
+		aWidth = self.a.width
+		bWidth = self.b.width
+
+		multiplicand = Signal.like(self.a)
+		# The upper half of the partial product, with an extra bit of headroom so the add can't overflow
+		upper = Signal(signed(aWidth + 1))
+		# The lower half, into which the multiplier is loaded and then shifted out of as product bits shift in
+		lower = Signal(bWidth)
+		partialSum = Signal(signed(aWidth + 2))
+		bitsRemaining = Signal(range(bWidth + 1))
+		lastBit = Signal()
+
+		m.d.comb += [
+			lastBit.eq(bitsRemaining == 1),
+			self.busy.eq(bitsRemaining != 0),
+			self.product.eq(Cat(lower, upper)),
+		]
+		domain += self.done.eq(0)
+
+		# For each set multiplier bit add in the multiplicand. The multiplier's top bit carries a weight of
+		# -(2 ** (bWidth - 1)) for a signed number, so on the last bit we subtract instead.
+		with m.If(lower[0]):
+			m.d.comb += partialSum.eq(Mux(lastBit, upper - multiplicand, upper + multiplicand))
+		with m.Else():
+			m.d.comb += partialSum.eq(upper)
+
+		with m.If(self.start):
+			domain += [
+				multiplicand.eq(self.a),
+				upper.eq(0),
+				lower.eq(self.b),
+				bitsRemaining.eq(bWidth),
+			]
+		with m.Elif(self.busy):
+			# Arithmetic shift the partial sum back down, retiring the bit just consumed into the bottom half
+			domain += [
+				upper.eq(partialSum[1:]),
+				lower.eq(Cat(lower[1:], partialSum[0])),
+				bitsRemaining.eq(bitsRemaining - 1),
+			]
+			with m.If(lastBit):
+				domain += self.done.eq(1)
+
+		return m
@@ -16,6 +16,15 @@ class SPDIF(Elaboratable):
 		self.sampleValid = Signal()
 		self.bitDepth = Signal(range(24))
 		self.sampleRate = Signal(range(192000))
+		self.emphasis = Signal()
+
+		# Pulsed as blocks are accepted or dropped (by reason), and when the timing logic loses sync and resets
+		self.blockAccepted = Signal()
+		self.blockDroppedParity = Signal()
+		self.blockDroppedInvalid = Signal()
+		self.blockDroppedFormat = Signal()
+		self.blockDroppedLength = Signal()
+		self.resync = Signal()
 
 	def elaborate(self, platform : Platform) -> Module:
 		m = Module()
@@ -59,8 +68,20 @@ class SPDIF(Elaboratable):
 			sample.eq(blockHandler.dataOut),
 			bitDepth.eq(blockHandler.bitDepth),
 			sampleRate.eq(blockHandler.sampleRate),
+			self.emphasis.eq(blockHandler.emphasis),
+
+			self.blockAccepted.eq(blockHandler.blockValid),
+			self.blockDroppedParity.eq(blockHandler.droppedParity),
+			self.blockDroppedInvalid.eq(blockHandler.droppedInvalid),
+			self.blockDroppedFormat.eq(blockHandler.droppedFormat),
+			self.blockDroppedLength.eq(blockHandler.droppedLength),
 		]
 
+		# The timing logic holds reset while it's hunting for the signal, so count each time it goes back into that
+		timingReset = Signal(reset = 1)
+		m.d.usb += timingReset.eq(timing.reset)
+		m.d.comb += self.resync.eq(timing.reset & ~timingReset)
+
 		# If we see sync, block begin and then the block handler go valid, mark the source available
 		# until such a time as the block handler indicates it had to drop data
 		with m.FSM():
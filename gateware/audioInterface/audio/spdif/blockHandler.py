@@ -31,6 +31,14 @@ class BlockHandler(Elaboratable):
 		self.dataValid = Signal()
 		self.bitDepth = Signal(range(24))
 		self.sampleRate = Signal(range(192000))
+		# Whether the block's audio has had 50/15µs pre-emphasis applied
+		self.emphasis = Signal()
+		# Pulsed when a block is dropped, for each of the reasons it can be: a parity error, a sample
+		# marked invalid, control data we can't play, or a different number of samples in each channel
+		self.droppedParity = Signal()
+		self.droppedInvalid = Signal()
+		self.droppedFormat = Signal()
+		self.droppedLength = Signal()
 
 	def elaborate(self, platform : Platform) -> Module:
 		m = Module()
@@ -48,6 +56,7 @@ class BlockHandler(Elaboratable):
 		dataValid = self.dataValid
 
 		parityOk = Signal()
+		parityError = Signal()
 		blockError = Signal()
 		samplesA = Signal(range(192))
 		samplesB = Signal(range(192))
@@ -66,6 +75,8 @@ class BlockHandler(Elaboratable):
 		sample = Signal(24)
 		bitDepth = Signal(range(24))
 		sampleRate = Signal(range(192000))
+		emphasis = Signal()
+		emphasisInvalid = Signal()
 		channelAType = Signal(Channel)
 
 		channelA : SyncFIFOBuffered = DomainRenamer(sync = 'usb')(SyncFIFOBuffered(width = 24, depth = 192))
@@ -87,6 +98,7 @@ class BlockHandler(Elaboratable):
 			transferData.eq(0),
 			bitDepthInvalid.eq(0),
 			sampleRateInvalid.eq(0),
+			emphasisInvalid.eq(0),
 			blockValid.eq(transferData),
 			droppingData.eq(0),
 			dataValid.eq(0),
@@ -98,6 +110,7 @@ class BlockHandler(Elaboratable):
 				with m.If(blockBeginning):
 					m.d.usb += [
 						blockError.eq(0),
+						parityError.eq(0),
 						samplesA.eq(0),
 						samplesB.eq(0),
 					]
@@ -122,6 +135,8 @@ class BlockHandler(Elaboratable):
 					# If it's not valid, set a block error
 					with m.Else():
 						m.d.usb += blockError.eq(1)
+						with m.If(~parityOk):
+							m.d.usb += parityError.eq(1)
 				# If the timing logic indicates we need to drop the block, go into an abort state
 				with m.Elif(dropBlock):
 					m.next = 'ABORT'
@@ -129,6 +144,10 @@ class BlockHandler(Elaboratable):
 				with m.Elif(blockComplete):
 					# Unless we had a block error, in which case, go to the abort state
 					with m.If(blockError):
+						with m.If(parityError):
+							m.d.comb += self.droppedParity.eq(1)
+						with m.Else():
+							m.d.comb += self.droppedInvalid.eq(1)
 						m.next = 'ABORT'
 					with m.Else():
 						m.next = 'VALIDATE-CONTROL'
@@ -136,11 +155,24 @@ class BlockHandler(Elaboratable):
 			# Check that we have a S/PDIF control frame and move settings about as needed
 			with m.State('VALIDATE-CONTROL'):
 				# If the first control bit indicates this is an AES3 frame, immediately go to discarding the data.
-				# Likewise if this is compressed or 4-channel PCM data.
-				with m.If(controlBits[0] | controlBits[1] | controlBits[3]):
+				# Likewise if this is compressed data.
+				with m.If(controlBits[0] | controlBits[1]):
+					m.d.comb += self.droppedFormat.eq(1)
 					m.next = 'ABORT'
 				# Otherwise copy the sample rate and other information out
 				with m.Else():
+					# Decode the pre-emphasis mode (the bits are matched here last to first)
+					with m.Switch(controlBits[3:6]):
+						# No pre-emphasis
+						with m.Case('000'):
+							m.d.usb += emphasis.eq(0)
+						# 50/15µs pre-emphasis
+						with m.Case('001'):
+							m.d.usb += emphasis.eq(1)
+						# Anything else is reserved, so signal invalid
+						with m.Default():
+							m.d.comb += emphasisInvalid.eq(1)
+
 					# Decode the sample bit depth
 					with m.Switch(controlBits[32:36]):
 						# 24-bit words, full word length
@@ -159,8 +191,12 @@ class BlockHandler(Elaboratable):
 							m.d.usb += sampleRate.eq(44100)
 						with m.Case('0010'):
 							m.d.usb += sampleRate.eq(48000)
+						with m.Case('1000'):
+							m.d.usb += sampleRate.eq(88200)
 						with m.Case('1010'):
 							m.d.usb += sampleRate.eq(96000)
+						with m.Case('1100'):
+							m.d.usb += sampleRate.eq(176400)
 						with m.Case('1110'):
 							m.d.usb += sampleRate.eq(192000)
 						with m.Case('0011'):
@@ -180,10 +216,12 @@ class BlockHandler(Elaboratable):
 							m.d.comb += channelTypeInvalid.eq(1)
 
 					# If any of the channel information is bad, abort
-					with m.If(bitDepthInvalid | sampleRateInvalid | channelTypeInvalid):
+					with m.If(bitDepthInvalid | sampleRateInvalid | channelTypeInvalid | emphasisInvalid):
+						m.d.comb += self.droppedFormat.eq(1)
 						m.next = 'ABORT'
 					# If there's a mismatch on the number of samples per channel, abort
 					with m.Elif(samplesA != samplesB):
+						m.d.comb += self.droppedLength.eq(1)
 						m.next = 'ABORT'
 					# If all is well, continue to transfer
 					with m.Else():
@@ -218,6 +256,7 @@ class BlockHandler(Elaboratable):
 						transferChannel.eq(channelAType == Channel.right),
 						self.bitDepth.eq(bitDepth),
 						self.sampleRate.eq(sampleRate),
+						self.emphasis.eq(emphasis),
 					]
 					m.next = 'XFER-DATA-L'
 
@@ -0,0 +1,132 @@
+from torii.hdl import Elaboratable, Module, Signal, Array, Memory, signed
+from torii.build import Platform
+
+from .multiplier import SerialMultiplier
+
+__all__ = (
+	'VolumeControl',
+)
+
+class VolumeControl(Elaboratable):
+	'''
+	This applies the host's feature unit volume and mute settings to the playback samples.
+
+	The settings come in as the raw AudioRequestHandler state: index 0 is the master control and
+	indices 1 and 2 the left and right channels, with volumes in whole dB from -120 to 0. Each channel's
+	total attenuation is looked up in a dB-to-linear table held in EBR, and the gain actually applied
+	ramps exponentially towards that target a little each sample so changes don't cause zipper noise.
+	Mute is just a target gain of 0, so it ramps too. The multiplies are done with shift-add multipliers
+	for both channels in parallel.
+
+	unity is high while both channels' applied gains are at unity, so the samples pass through untouched.
+	Pulse start when sampleIn is valid, done pulses when sampleOut has been updated.
+	'''
+
+	# Gains are unsigned fixed point with this many fractional bits, so unity is 1 << gainBits
+	gainBits = 16
+	maxAttenuation = 120
+	# How quickly the applied gain chases the target, as a shift. 5 gives a time constant of 32 samples
+	rampShift = 5
+
+	def __init__(self):
+		self.volumes = Array(Signal(signed(16), name = f'volume{i}') for i in range(3))
+		self.mutes = Array(Signal(name = f'mute{i}') for i in range(3))
+		self.unity = Signal()
+
+		self.start = Signal()
+		self.sampleIn = Array((Signal(signed(24), name = 'sampleInL'), Signal(signed(24), name = 'sampleInR')))
+		self.sampleOut = Array((Signal(signed(24), name = 'sampleOutL'), Signal(signed(24), name = 'sampleOutR')))
+		self.done = Signal()
+
+	def generateGainTable(self):
+		''' Generates the dB attenuation to linear gain table '''
+		unity = 1 << self.gainBits
+		return [round(unity * (10 ** (-attenuation / 20))) for attenuation in range(self.maxAttenuation + 1)]
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+
+		gainWidth = self.gainBits + 1
+		rom = Memory(width = gainWidth, depth = self.maxAttenuation + 1, init = self.generateGainTable())
+		m.submodules.gainTable = readPort = rom.read_port(transparent = False)
+		multipliers = []
+		for channel in range(2):
+			# The gain is unsigned, so give the multiplier an extra bit so it's never seen as negative
+			multiplier = SerialMultiplier(aWidth = 24, bWidth = gainWidth + 1)
+			m.submodules[f'multiplier{channel}'] = multiplier
+			multipliers.append(multiplier)
+
+		attenuations = Array(Signal(range(self.maxAttenuation + 1), name = f'attenuation{i}') for i in range(2))
+		muted = Array(Signal(name = f'muted{i}') for i in range(2))
+		targetGains = Array(Signal(gainWidth, name = f'targetGain{i}') for i in range(2))
+		gains = Array(Signal(gainWidth, name = f'gain{i}', reset = 1 << self.gainBits) for i in range(2))
+
+		# Work out each channel's total attenuation from the master and channel volumes, limiting it to the table
+		for channel in range(2):
+			volume = Signal(signed(17), name = f'totalVolume{channel}')
+			m.d.comb += [
+				volume.eq(self.volumes[0] + self.volumes[channel + 1]),
+				muted[channel].eq(self.mutes[0] | self.mutes[channel + 1]),
+			]
+			with m.If(volume > 0):
+				m.d.comb += attenuations[channel].eq(0)
+			with m.Elif(volume < -self.maxAttenuation):
+				m.d.comb += attenuations[channel].eq(self.maxAttenuation)
+			with m.Else():
+				m.d.comb += attenuations[channel].eq(-volume)
+
+		for channel, multiplier in enumerate(multipliers):
+			m.d.comb += [
+				multiplier.a.eq(self.sampleIn[channel]),
+				multiplier.b.eq(gains[channel]),
+			]
+
+		m.d.comb += [
+			readPort.addr.eq(attenuations[0]),
+			self.unity.eq((gains[0] == (1 << self.gainBits)) & (gains[1] == (1 << self.gainBits))),
+		]
+		m.d.sync += self.done.eq(0)
+
+		with m.FSM(name = 'volumeFSM'):
+			# Wait for a new sample, looking up the left channel's target gain in the meantime
+			with m.State('IDLE'):
+				with m.If(self.start):
+					m.d.comb += readPort.addr.eq(attenuations[1])
+					m.d.sync += targetGains[0].eq(readPort.data)
+					m.next = 'LOOKUP'
+
+			with m.State('LOOKUP'):
+				m.d.sync += targetGains[1].eq(readPort.data)
+				m.next = 'RAMP'
+
+			# Move the applied gains a step closer to their targets
+			with m.State('RAMP'):
+				for channel in range(2):
+					target = Signal(gainWidth, name = f'target{channel}')
+					difference = Signal(signed(gainWidth + 1), name = f'difference{channel}')
+					m.d.comb += difference.eq(target - gains[channel])
+					with m.If(muted[channel]):
+						m.d.comb += target.eq(0)
+					with m.Else():
+						m.d.comb += target.eq(targetGains[channel])
+					# Once we're close enough that the step would be 0, snap to the target
+					with m.If((difference < (1 << self.rampShift)) & (difference > -(1 << self.rampShift))):
+						m.d.sync += gains[channel].eq(target)
+					with m.Else():
+						m.d.sync += gains[channel].eq(gains[channel] + difference.shift_right(self.rampShift))
+				m.next = 'MULTIPLY'
+
+			with m.State('MULTIPLY'):
+				m.d.comb += [multiplier.start.eq(1) for multiplier in multipliers]
+				m.next = 'WAIT'
+
+			with m.State('WAIT'):
+				with m.If(multipliers[0].done):
+					m.d.sync += [
+						sampleOut.eq(multiplier.product.shift_right(self.gainBits))
+						for sampleOut, multiplier in zip(self.sampleOut, multipliers)
+					]
+					m.d.sync += self.done.eq(1)
+					m.next = 'IDLE'
+
+		return m
@@ -0,0 +1,53 @@
+from torii.hdl import Elaboratable, Module, Signal, Cat
+from torii.build import Platform
+from functools import reduce
+from operator import xor
+
+__all__ = (
+	'CRC32',
+)
+
+class CRC32(Elaboratable):
+	'''
+	This computes the standard (zlib, Ethernet, etc) CRC-32 over a stream of bytes, a byte a cycle.
+
+	Pulse reset to start over, and hold valid high with a byte in data to add it to the CRC. value is
+	the CRC of the bytes so far, with the final inversion already done, so it can be compared directly
+	against what zlib.crc32() or the like gives for the same bytes.
+	'''
+
+	polynomial = 0xedb88320
+
+	def __init__(self, *, domain = 'usb'):
+		self._domain = domain
+
+		self.reset = Signal()
+		self.data = Signal(8)
+		self.valid = Signal()
+		self.value = Signal(32)
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+		crc = Signal(32, reset = 0xffffffff)
+
+		# Work out which bits of the CRC and the data byte go into each bit of the next CRC by running
+		# the bit-serial algorithm over sets of them, which turns the 8 steps into one layer of XORs
+		taps = [{('crc', bit)} for bit in range(32)]
+		for bit in range(8):
+			taps[bit] = taps[bit] ^ {('data', bit)}
+		for _ in range(8):
+			feedback = taps[0]
+			taps = taps[1:] + [set()]
+			taps = [tap ^ feedback if (self.polynomial >> bit) & 1 else tap for bit, tap in enumerate(taps)]
+
+		sources = {'crc': crc, 'data': self.data}
+		nextCRC = Cat(reduce(xor, (sources[source][bit] for source, bit in sorted(tap))) for tap in taps)
+
+		domain = m.d[self._domain]
+		with m.If(self.reset):
+			domain += crc.eq(crc.reset)
+		with m.Elif(self.valid):
+			domain += crc.eq(nextCRC)
+
+		m.d.comb += self.value.eq(~crc)
+		return m
@@ -0,0 +1,239 @@
+from torii.hdl import Elaboratable, Module, Signal, Array, Mux
+from torii.build import Platform
+from enum import IntEnum, unique
+
+from .spi import SPIPort
+
+__all__ = (
+	'SPIFlash',
+	'FlashCommands',
+	'FlashLayout',
+)
+
+@unique
+class FlashCommands(IntEnum):
+	writeEnable = 0x06
+	readStatus = 0x05
+	pageProgram = 0x02
+	sectorErase = 0x20
+	fastRead = 0x0b
+	releasePowerDown = 0xab
+
+class FlashLayout:
+	'''
+	Where things live in the configuration flash. This is what icemulti makes of a golden and an update image
+	aligned to 64KiB (icemulti -a16 -p0 -o flash.bin golden.bin update.bin): the warm boot header at the
+	start, the golden image, which is also what the FPGA boots on power up, and then the update slot that DFU
+	writes. The boot record gets the last sector before the golden image to itself, in the gap icemulti leaves.
+	'''
+
+	bootRecord = 0x00f000
+	goldenImage = 0x010000
+	updateImage = 0x040000
+	slotSize = 0x030000
+	# The size of an iCE40HX8K bitstream
+	imageSize = 135100
+	# SB_WARMBOOT's image numbers for each, which follow the order the images are given to icemulti in
+	goldenWarmboot = 0
+	updateWarmboot = 1
+
+class SPIFlash(Elaboratable):
+	'''
+	This drives the FPGA's configuration flash over a port on the configuration SPI bus, erasing its
+	4KiB sectors, programming its 256 byte pages and reading it back.
+
+	Pulse erase to erase the sector containing address, or program to program length bytes into the
+	page at address. done pulses when the flash reports the operation complete, and erasing is high
+	while an erase is in progress so the caller can tell the host how long it's going to be.
+
+	Pulse read to read length bytes from address using the fast read command, which unlike the plain
+	read command is good for the full SPI clock rate. readValid pulses as each byte arrives in readData,
+	and done pulses once the last one has.
+
+	The data to program is read out of a buffer a byte ahead of when it's needed: bufferData must
+	hold the byte at bufferAddress the cycle after bufferAddress is set, as a memory read port does.
+	writeValid pulses as each byte starts going out to the flash, with it in writeData.
+
+	The flash is woken from deep power down before its first operation, in case it was left there.
+	'''
+
+	pageSize = 256
+	sectorSize = 4096
+	# Typical times to program a page and erase a sector, in ms, rounded up
+	pageProgramTime = 1
+	sectorEraseTime = 45
+	# How long chip select has to be high between commands, how long it takes to wake up (3µs), and how long to
+	# leave between reads of the status register (10µs), at 60MHz
+	deselectCycles = 6
+	wakeCycles = 180
+	pollCycles = 600
+
+	def __init__(self, spi : SPIPort, *, chipSelect = 1):
+		self._spi = spi
+		self._chipSelect = chipSelect
+
+		self.address = Signal(24)
+		self.length = Signal(range(self.pageSize + 1))
+		self.erase = Signal()
+		self.program = Signal()
+		self.read = Signal()
+
+		self.bufferAddress = Signal(range(self.pageSize))
+		self.bufferData = Signal(8)
+
+		self.readData = Signal(8)
+		self.readValid = Signal()
+		self.writeData = Signal(8)
+		self.writeValid = Signal()
+
+		self.busy = Signal()
+		self.erasing = Signal()
+		self.done = Signal()
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+		spi = self._spi
+
+		headerLength = 4
+		# Fast reads have a dummy byte between the address and the data
+		readHeaderLength = headerLength + 1
+		awake = Signal()
+		reading = Signal()
+		started = Signal()
+		command = Signal(8)
+		index = Signal(range(headerLength + self.pageSize + 1))
+		transferLength = Signal.like(index)
+		delay = Signal(range(max(self.wakeCycles, self.pollCycles) + 1))
+		# The command followed by the address, most significant byte first
+		header = Array((command, self.address[16:24], self.address[8:16], self.address[0:8]))
+
+		m.d.comb += [
+			spi.chipSelect.eq(self._chipSelect),
+			spi.dataOut.eq(Mux(index < headerLength, header[index[0:2]], Mux(reading, 0, self.bufferData))),
+			# Read the buffer a byte ahead, so the data is ready when the byte before it is done
+			self.bufferAddress.eq(index - (headerLength - 1)),
+			self.readData.eq(spi.dataIn),
+			self.writeData.eq(spi.dataOut),
+		]
+		m.d.usb += self.done.eq(0)
+
+		def transfer(length, nextState):
+			# Clock bytes out until length have gone, then deselect for long enough to move on to nextState
+			m.d.comb += spi.select.eq(1)
+			with m.If(~started):
+				with m.If(spi.granted):
+					m.d.comb += spi.start.eq(1)
+					m.d.usb += started.eq(1)
+			with m.Elif(spi.done):
+				m.d.usb += [
+					started.eq(0),
+					index.eq(index + 1),
+				]
+				with m.If(index == length - 1):
+					m.d.usb += [
+						index.eq(0),
+						delay.eq(self.deselectCycles),
+					]
+					m.next = nextState
+
+		def deselect(nextState):
+			with m.If(delay == 0):
+				m.next = nextState
+			with m.Else():
+				m.d.usb += delay.eq(delay - 1)
+
+		with m.FSM(domain = 'usb', name = 'flash') as fsm:
+			with m.State('IDLE'):
+				with m.If(self.erase | self.program | self.read):
+					m.d.usb += [
+						self.erasing.eq(self.erase),
+						reading.eq(self.read),
+						index.eq(0),
+					]
+					with m.If(self.erase):
+						m.d.usb += transferLength.eq(headerLength)
+					with m.Elif(self.program):
+						m.d.usb += transferLength.eq(headerLength + self.length)
+					with m.Else():
+						m.d.usb += transferLength.eq(readHeaderLength + self.length)
+
+					with m.If(awake & self.read):
+						m.d.usb += command.eq(FlashCommands.fastRead)
+						m.next = 'READ'
+					with m.Elif(awake):
+						m.d.usb += command.eq(FlashCommands.writeEnable)
+						m.next = 'WRITE-ENABLE'
+					with m.Else():
+						m.d.usb += command.eq(FlashCommands.releasePowerDown)
+						m.next = 'WAKE'
+
+			# Make sure the flash isn't in deep power down, and give it time to come out if it was
+			with m.State('WAKE'):
+				transfer(1, 'WAKE-WAIT')
+				with m.If(spi.done):
+					m.d.usb += delay.eq(self.wakeCycles)
+			with m.State('WAKE-WAIT'):
+				m.d.usb += awake.eq(1)
+				with m.If(reading):
+					m.d.usb += command.eq(FlashCommands.fastRead)
+					deselect('READ')
+				with m.Else():
+					m.d.usb += command.eq(FlashCommands.writeEnable)
+					deselect('WRITE-ENABLE')
+
+			# Send the fast read command, its address and the dummy byte, then hand the data on as it arrives
+			with m.State('READ'):
+				m.d.comb += self.readValid.eq(spi.done & (index >= readHeaderLength))
+				transfer(transferLength, 'FINISH')
+
+			with m.State('WRITE-ENABLE'):
+				transfer(1, 'WRITE-ENABLE-DESELECT')
+			with m.State('WRITE-ENABLE-DESELECT'):
+				m.d.usb += command.eq(Mux(self.erasing, FlashCommands.sectorErase, FlashCommands.pageProgram))
+				deselect('COMMAND')
+
+			# Send the erase or program command, its address, and for programming, the data
+			with m.State('COMMAND'):
+				m.d.comb += self.writeValid.eq(spi.start & ~self.erasing & (index >= headerLength))
+				transfer(transferLength, 'COMMAND-DESELECT')
+			with m.State('COMMAND-DESELECT'):
+				m.d.usb += command.eq(FlashCommands.readStatus)
+				deselect('POLL')
+
+			# Read the status register until the flash says it's no longer busy, letting go of the bus between reads
+			with m.State('POLL'):
+				m.d.comb += [
+					spi.select.eq(1),
+					spi.dataOut.eq(Mux(index == 0, command, 0)),
+				]
+				with m.If(~started):
+					with m.If(spi.granted):
+						m.d.comb += spi.start.eq(1)
+						m.d.usb += started.eq(1)
+				with m.Elif(spi.done):
+					m.d.usb += [
+						started.eq(0),
+						index.eq(1),
+					]
+					with m.If(index == 1):
+						m.d.usb += index.eq(0)
+						with m.If(spi.dataIn[0]):
+							m.d.usb += delay.eq(self.pollCycles)
+							m.next = 'POLL-WAIT'
+						with m.Else():
+							m.d.usb += delay.eq(self.deselectCycles)
+							m.next = 'FINISH'
+			with m.State('POLL-WAIT'):
+				deselect('POLL')
+
+			with m.State('FINISH'):
+				with m.If(delay == 0):
+					m.d.usb += [
+						self.erasing.eq(0),
+						reading.eq(0),
+						self.done.eq(1),
+					]
+				deselect('IDLE')
+
+		m.d.comb += self.busy.eq(~fsm.ongoing('IDLE'))
+		return m
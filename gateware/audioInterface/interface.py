@@ -1,17 +1,34 @@
 from torii.hdl import Elaboratable, Module, ClockDomain, ResetSignal
 from .usb import USBInterface
 from .audio import AudioStream
+from .audio.dac import DACControl
+from .spi import SPIController
 
 __all__ = (
 	'AudioInterface',
 )
 
 class AudioInterface(Elaboratable):
+	def __init__(self, *, volumeInDAC = True, oversample = 1, interpolationFilter = 'long', golden = False):
+		# Whether the host's volume settings are applied by the DAC, or in the gateware's playback path
+		self._volumeInDAC = volumeInDAC
+		self._oversample = oversample
+		self._interpolationFilter = interpolationFilter
+		# Whether this is the golden image, which decides whether to boot the update slot, or the update image
+		self._golden = golden
+
 	def elaborate(self, platform):
 		m = Module()
 		m.domains += ClockDomain('usb')
-		m.submodules.usb = usb = USBInterface(resource = ('ulpi', 0))
-		m.submodules.audio = AudioStream(usb)
+		# The configuration SPI bus is shared between the DAC (port 0) and the DFU handler's flash access (port 1),
+		# with the flash run at the fastest clock we can make, 30MHz, so reading it back isn't held up by the bus
+		m.submodules.spi = spi = SPIController(resource = ('cfg_spi', 0), ports = 2, clkDivider = (4, 1))
+		m.submodules.usb = usb = USBInterface(resource = ('ulpi', 0), flash = spi.ports[1], golden = self._golden)
+		m.submodules.audio = audio = AudioStream(usb, applyVolume = not self._volumeInDAC,
+			oversample = self._oversample, interpolationFilter = self._interpolationFilter)
+		m.submodules.dac = dac = DACControl(usb.audioRequestHandler, spi.ports[0], applyVolume = self._volumeInDAC)
+		# Keep the DAC's audio format in step with the slot width being played out to it
+		m.d.comb += dac.sampleBits.eq(audio.sampleBits)
 
 		m.d.comb += ResetSignal('usb').eq(0)
 		return m
@@ -0,0 +1,54 @@
+from pathlib import Path
+from subprocess import run
+from tempfile import TemporaryDirectory
+from typing import Iterable, Optional
+import logging
+
+__all__ = (
+	'personalise',
+)
+
+def personalise(*, bitstream : Path, serials : Iterable[str], product : Optional[str], outputDir : Path):
+	'''
+	This makes a bitstream per serial number from an already placed and routed build (its .asc), by having
+	icebram swap the placeholder descriptor ROM image for one holding that unit's serial number, then
+	packing the result with icepack. No synthesis or place and route is involved, so each unit's
+	bitstream takes next to no time to make.
+
+	The placeholder image is rebuilt from the descriptors here, so this has to be run from the same
+	version of the gateware the bitstream was built from - icebram fails to find the ROM if it isn't.
+	'''
+	from torii.tools import require_tool
+	from .usb import buildDescriptors
+	from .usb.rom import DescriptorROMImage
+
+	icebram = require_tool('icebram')
+	icepack = require_tool('icepack')
+
+	placeholder = DescriptorROMImage(*buildDescriptors())
+	outputDir.mkdir(parents = True, exist_ok = True)
+
+	with TemporaryDirectory() as workDir:
+		workDir = Path(workDir)
+		placeholderHex = workDir / 'placeholder.hex'
+		placeholderHex.write_text(placeholder.hexImage())
+
+		strings = {} if product is None else {'product': product}
+		for serial in serials:
+			if not serial.replace('-', '').isalnum():
+				raise ValueError(f'Serial number {serial!r} must be made of only letters, numbers and dashes')
+			# The new image has to fit in the EBRs the placeholder was given, and keep its descriptors in the same places
+			image = DescriptorROMImage(*buildDescriptors(serialNumber = serial, **strings), depth = placeholder.depth)
+			if image.layout != placeholder.layout:
+				raise ValueError(f'Serial number {serial!r} changes which descriptors there are, and so cannot be '
+					'patched in (is it the same as one of the other strings?)')
+
+			unitHex = workDir / f'{serial}.hex'
+			unitHex.write_text(image.hexImage())
+			unitASC = workDir / f'{serial}.asc'
+			unitBitstream = outputDir / f'{bitstream.stem}-{serial}.bin'
+
+			with bitstream.open('rb') as ascIn, unitASC.open('wb') as ascOut:
+				run([icebram, str(placeholderHex), str(unitHex)], stdin = ascIn, stdout = ascOut, check = True)
+			run([icepack, str(unitASC), str(unitBitstream)], check = True)
+			logging.info(f'Wrote {unitBitstream} for serial number {serial}')
@@ -0,0 +1,101 @@
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional
+import logging
+
+__all__ = (
+	'ElaborationProfile',
+	'profileElaboration',
+)
+
+class ElaborationProfile:
+	'''
+	The time spent elaborating each Elaboratable in a design, recorded by profileElaboration. Each record
+	is for one Elaboratable, holding the time its elaboration took including the submodules it added
+	(total), and excluding them (self). Records are named by their path of submodule names down from the
+	top of the hierarchy, with anonymous submodules named by their class.
+	'''
+
+	class Record:
+		def __init__(self, elaboratable, parent : Optional['ElaborationProfile.Record']):
+			self.name = type(elaboratable).__name__
+			self.parent = parent
+			self.children : List['ElaborationProfile.Record'] = []
+			self.total = 0.0
+			self.fragment = None
+
+		@property
+		def path(self) -> str:
+			if self.parent is None:
+				return self.name
+			return f'{self.parent.path}.{self.name}'
+
+		@property
+		def self(self) -> float:
+			return self.total - sum(child.total for child in self.children)
+
+	def __init__(self):
+		self.roots : List[ElaborationProfile.Record] = []
+
+	def records(self) -> Iterator['ElaborationProfile.Record']:
+		''' Every record, parents ahead of their children, in the order they were elaborated '''
+		pending = list(reversed(self.roots))
+		while pending:
+			record = pending.pop()
+			yield record
+			pending.extend(reversed(record.children))
+
+	def report(self, *, limit : Optional[int] = 25, logger = logging):
+		''' Log the records that took the longest in themselves, along with the overall time taken '''
+		records = sorted(self.records(), key = lambda record: record.self, reverse = True)
+		total = sum(root.total for root in self.roots)
+		logger.info(f'Elaboration took {total * 1000:.1f}ms over {len(records)} elaborate() calls')
+		logger.info(f'{"self (ms)":>10} {"total (ms)":>10}  elaboratable')
+		for record in records[:limit]:
+			logger.info(f'{record.self * 1000:10.2f} {record.total * 1000:10.2f}  {record.path}')
+
+@contextmanager
+def profileElaboration():
+	'''
+	Time every elaborate() done within this context, by wrapping Fragment.get, which is what elaborates
+	an Elaboratable and, through Module, each of its submodules in turn. Submodules are named afterwards,
+	as they are added to their parent's Fragment.
+	'''
+	from torii.hdl.ir import Fragment
+
+	profile = ElaborationProfile()
+	stack : List[ElaborationProfile.Record] = []
+	byFragment : Dict[int, ElaborationProfile.Record] = {}
+	get = Fragment.get
+	addSubfragment = Fragment.add_subfragment
+
+	def profiledGet(obj, platform, *args, **kwargs):
+		if isinstance(obj, Fragment):
+			return get(obj, platform, *args, **kwargs)
+		parent = stack[-1] if stack else None
+		record = ElaborationProfile.Record(obj, parent)
+		(profile.roots if parent is None else parent.children).append(record)
+		stack.append(record)
+		start = perf_counter()
+		try:
+			fragment = get(obj, platform, *args, **kwargs)
+		finally:
+			record.total = perf_counter() - start
+			stack.pop()
+		record.fragment = fragment
+		byFragment[id(fragment)] = record
+		return fragment
+
+	def profiledAddSubfragment(self, subfragment, name = None):
+		record = byFragment.get(id(subfragment))
+		if name is not None and record is not None and record.fragment is subfragment:
+			record.name = name
+		return addSubfragment(self, subfragment, name)
+
+	Fragment.get = staticmethod(profiledGet)
+	Fragment.add_subfragment = profiledAddSubfragment
+	try:
+		yield profile
+	finally:
+		Fragment.get = staticmethod(get)
+		Fragment.add_subfragment = addSubfragment
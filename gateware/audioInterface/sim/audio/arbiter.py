@@ -0,0 +1,52 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ...audio.arbiter import SourceArbiter, SourcePolicy, Source
+
+class SourceArbiterTestCase(ToriiTestCase):
+	dut : SourceArbiter = SourceArbiter
+	dut_args = {}
+	domains = (('usb', 60e6),)
+
+	def setSources(self, *, usb : bool, spdif : bool):
+		yield self.dut.usbActive.eq(usb)
+		yield self.dut.spdifActive.eq(spdif)
+		yield Settle()
+		switched = yield self.dut.switched
+		yield
+		yield Settle()
+		return switched, (yield self.dut.source), (yield self.dut.active)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testPriority(self):
+		yield self.dut.policy.eq(SourcePolicy.priority)
+		# S/PDIF plays only when USB isn't
+		self.assertEqual((yield from self.setSources(usb = False, spdif = False)), (0, Source.usb, 0))
+		self.assertEqual((yield from self.setSources(usb = False, spdif = True)), (1, Source.spdif, 1))
+		self.assertEqual((yield from self.setSources(usb = True, spdif = True)), (1, Source.usb, 1))
+		self.assertEqual((yield from self.setSources(usb = False, spdif = True)), (1, Source.spdif, 1))
+		# Losing every source leaves the last one picked, but not active
+		self.assertEqual((yield from self.setSources(usb = False, spdif = False)), (0, Source.spdif, 0))
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testLastActive(self):
+		yield self.dut.policy.eq(SourcePolicy.lastActive)
+		self.assertEqual((yield from self.setSources(usb = False, spdif = True)), (1, Source.spdif, 1))
+		# USB starting up doesn't take over from S/PDIF
+		self.assertEqual((yield from self.setSources(usb = True, spdif = True)), (0, Source.spdif, 1))
+		# But does once S/PDIF goes away, and then keeps playing when S/PDIF comes back
+		self.assertEqual((yield from self.setSources(usb = True, spdif = False)), (1, Source.usb, 1))
+		self.assertEqual((yield from self.setSources(usb = True, spdif = True)), (0, Source.usb, 1))
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testHostSelected(self):
+		yield self.dut.policy.eq(SourcePolicy.hostSelected)
+		yield self.dut.hostSource.eq(Source.spdif)
+		# Only the host's pick plays, even if it isn't available
+		self.assertEqual((yield from self.setSources(usb = True, spdif = False)), (1, Source.spdif, 0))
+		self.assertEqual((yield from self.setSources(usb = True, spdif = True)), (0, Source.spdif, 1))
+		yield self.dut.hostSource.eq(Source.usb)
+		self.assertEqual((yield from self.setSources(usb = True, spdif = True)), (1, Source.usb, 1))
@@ -0,0 +1,65 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ...audio.clocking import AudioClockGen
+
+class AudioClockGenTestCase(ToriiTestCase):
+	dut : AudioClockGen = AudioClockGen
+	domains = (('sync', 36.864e6), )
+
+	def frames(self, count):
+		for _ in range(count):
+			self.assertEqual((yield self.dut.mute), 1)
+			yield from self.pulse_pos(self.dut.needSample)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testClockSwitch(self):
+		sampleRate = self.dut.sampleRate
+		sampleBits = self.dut.sampleBits
+		clkEdge = self.dut.clkEdge
+		clkDivider = self.dut.clkDivider
+		mute = self.dut.mute
+
+		# Start out playing 48kHz 16-bit audio, which needs a half clock of exactly 12 system clocks
+		yield sampleRate.eq(48000)
+		yield sampleBits.eq(15)
+		yield Settle()
+		yield
+		yield Settle()
+		self.assertEqual((yield mute), 0)
+		self.assertEqual((yield clkDivider), 11)
+		for _ in range(8):
+			yield from self.pulse_pos(clkEdge)
+			self.assertEqual((yield clkDivider), 11)
+
+		# Now ask for 44.1kHz, which should mute, wait for the silence to get out, and then switch
+		yield sampleRate.eq(44100)
+		yield Settle()
+		yield
+		yield Settle()
+		yield from self.frames(3)
+		self.assertEqual((yield mute), 1)
+		self.assertEqual((yield clkDivider), 11)
+		yield from self.pulse_pos(clkEdge)
+		self.assertEqual((yield clkDivider), 12)
+		yield from self.frames(3)
+		self.assertEqual((yield mute), 0)
+
+		# 44.1kHz 16-bit needs a half clock of 640/49 system clocks, so check we get exactly that on average
+		yield from self.pulse_pos(clkEdge)
+		cycles = 0
+		for _ in range(49):
+			cycles += (yield clkDivider) + 1
+			yield from self.pulse_pos(clkEdge)
+		self.assertEqual(cycles, 640)
+		self.assertEqual((yield mute), 0)
+
+		# Going idle should not try to retune anything
+		yield sampleBits.eq(0)
+		yield sampleRate.eq(48000)
+		yield Settle()
+		yield
+		yield Settle()
+		self.assertEqual((yield mute), 0)
+		yield
@@ -0,0 +1,47 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ...audio.crossfade import Crossfade
+
+class CrossfadeTestCase(ToriiTestCase):
+	dut : Crossfade = Crossfade
+	dut_args = {
+		'fadeSamples': 8,
+	}
+	domains = (('sync', 36.864e6),)
+
+	def processSample(self, left, right):
+		yield self.dut.sampleIn[0].eq(left)
+		yield self.dut.sampleIn[1].eq(right)
+		yield self.dut.start.eq(1)
+		yield
+		yield self.dut.start.eq(0)
+		yield Settle()
+		while (yield self.dut.done) == 0:
+			yield
+			yield Settle()
+		return ((yield self.dut.sampleOut[0]), (yield self.dut.sampleOut[1]))
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testCrossfade(self):
+		dut = self.dut
+		yield Settle()
+		# The gain starts out at 0 and ramps up to unity over 8 samples, after which samples pass straight through
+		assert (yield dut.silent) == 1
+		assert (yield dut.unity) == 0
+		for gain in range(8):
+			expected = ((0x123456 * gain) >> 3, (-0x123456 * gain) >> 3)
+			self.assertEqual((yield from self.processSample(0x123456, -0x123456)), expected)
+		assert (yield dut.silent) == 0
+		assert (yield dut.unity) == 1
+		for _ in range(2):
+			self.assertEqual((yield from self.processSample(0x123457, -0x123457)), (0x123457, -0x123457))
+
+		# Fading out takes the gain back down to silence, where it stays
+		yield dut.fadeOut.eq(1)
+		for gain in range(8, 0, -1):
+			expected = ((0x400000 * gain) >> 3, (-0x400000 * gain) >> 3)
+			self.assertEqual((yield from self.processSample(0x400000, -0x400000)), expected)
+		assert (yield dut.silent) == 1
+		self.assertEqual((yield from self.processSample(0x400000, -0x400000)), (0, 0))
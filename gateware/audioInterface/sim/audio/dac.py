@@ -0,0 +1,132 @@
+from torii import Elaboratable, Module, Record
+from torii.hdl.rec import DIR_FANOUT, DIR_FANIN
+from torii.sim import Settle, Passive
+from torii.test import ToriiTestCase
+
+from ...audio.dac import DACControl
+from ...spi import SPIController
+from ...usb.control import AudioRequestHandler
+
+spiBus = Record(
+	layout = (
+		('cs', [
+			('o', 2, DIR_FANOUT),
+		]),
+		('clk', [
+			('o', 1, DIR_FANOUT),
+		]),
+		('copi', [
+			('o', 1, DIR_FANOUT),
+		]),
+		('cipo', [
+			('i', 1, DIR_FANIN),
+		]),
+	)
+)
+
+class Platform:
+	def request(self, name, number):
+		assert name == 'cfg_spi'
+		assert number == 0
+		return spiBus
+
+class DAC(Elaboratable):
+	def __init__(self):
+		self.requestHandler = AudioRequestHandler(configuration = 1, interfaces = (0, 1))
+		self.spi = SPIController()
+		self.dac = DACControl(self.requestHandler, self.spi.ports[0])
+
+	def elaborate(self, platform):
+		m = Module()
+		m.submodules.requestHandler = self.requestHandler
+		m.submodules.spi = self.spi
+		m.submodules.dac = self.dac
+		return m
+
+class DACControlTestCase(ToriiTestCase):
+	dut : DAC = DAC
+	domains = (('usb', 60e6), )
+	platform = Platform()
+
+	def readWord(self):
+		''' Waits for the DAC to be selected and collects the 16-bit word written to it '''
+		while (yield spiBus.cs.o) != 0b01:
+			yield
+			yield Settle()
+		word = 0
+		bits = 0
+		clk = 0
+		while (yield spiBus.cs.o) == 0b01:
+			# Sample the data on the rising edges of the clock
+			if (yield spiBus.clk.o) and not clk:
+				word = (word << 1) | (yield spiBus.copi.o)
+				bits += 1
+			clk = yield spiBus.clk.o
+			yield
+			yield Settle()
+		self.assertEqual(bits, 16)
+		return word >> 8, word & 0xff
+
+	def waitForWrites(self, count):
+		while len(self.writes) < count:
+			yield
+		yield
+
+	@ToriiTestCase.simulation
+	def testDACControl(self):
+		requestHandler = self.dut.requestHandler
+		self.writes = []
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def monitor(self):
+			yield Passive()
+			while True:
+				self.writes.append((yield from self.readWord()))
+		monitor(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def control(self):
+			yield Settle()
+
+			# Coming out of reset, the format control register needs the attenuation load enable setting
+			yield from self.waitForWrites(1)
+			self.assertEqual(self.writes[0], (18, 0xd0))
+
+			# Turn the left channel down by 6dB
+			yield requestHandler.volumeStates[1].eq(-6 & 0xffff)
+			yield from self.waitForWrites(2)
+			self.assertEqual(self.writes[1], (16, 0xf3))
+
+			# Hammer the right channel's volume. One write gets going with whatever the setting is when it starts,
+			# and the rest should then coalesce so just the latest setting gets written
+			for volume in range(1, 20):
+				yield requestHandler.volumeStates[2].eq(-volume & 0xffff)
+				yield
+			yield from self.waitForWrites(4)
+			self.assertEqual(self.writes[2][0], 17)
+			self.assertEqual(self.writes[3], (17, 0xff - 38))
+
+			# Mute the master channel, then the right one
+			yield requestHandler.muteStates[0].eq(1)
+			yield from self.waitForWrites(5)
+			self.assertEqual(self.writes[4], (18, 0xd1))
+			yield requestHandler.muteStates[2].eq(1)
+			yield from self.waitForWrites(6)
+			self.assertEqual(self.writes[5], (17, 0x00))
+
+			# Playing 16-bit audio should switch the DAC over to 16-bit I²S, and back again after
+			yield self.dut.dac.sampleBits.eq(16)
+			yield from self.waitForWrites(7)
+			self.assertEqual(self.writes[6], (18, 0xc1))
+			yield self.dut.dac.sampleBits.eq(24)
+			yield from self.waitForWrites(8)
+			self.assertEqual(self.writes[7], (18, 0xd1))
+
+			# Powering the domain down should disable the DAC's output
+			yield requestHandler.powerState.eq(2)
+			yield from self.waitForWrites(9)
+			self.assertEqual(self.writes[8], (19, 0x10))
+			for _ in range(100):
+				yield
+			self.assertEqual(len(self.writes), 9)
+		control(self)
@@ -0,0 +1,74 @@
+from math import pi, sin
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ...audio.deemphasis import DeEmphasis
+
+class DeEmphasisTestCase(ToriiTestCase):
+	dut : DeEmphasis = DeEmphasis
+	dut_args = {}
+	domains = (('sync', 36.864e6),)
+
+	def processSample(self, left, right):
+		yield self.dut.sampleIn[0].eq(left)
+		yield self.dut.sampleIn[1].eq(right)
+		yield self.dut.start.eq(1)
+		yield
+		yield self.dut.start.eq(0)
+		yield Settle()
+		while (yield self.dut.done) == 0:
+			yield
+			yield Settle()
+		return ((yield self.dut.sampleOut[0]), (yield self.dut.sampleOut[1]))
+
+	def filterModel(self, samples, sampleRate):
+		''' An exact fixed point model of the filter, as run from silence '''
+		b0, b1, a1 = self.dut.coefficientsFor(sampleRate)
+		previousInput = 0
+		previousOutput = 0
+		outputs = []
+		for sample in samples:
+			result = (b0 * sample + b1 * previousInput - a1 * previousOutput) >> DeEmphasis.coefficientBits
+			result = max(-0x800000, min(0x7fffff, result))
+			previousInput = sample
+			previousOutput = result
+			outputs.append(result)
+		return outputs
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testDeEmphasis(self):
+		dut = self.dut
+		yield dut.sampleRate.eq(44100)
+		yield Settle()
+
+		# When not enabled, samples pass straight through
+		self.assertEqual((yield from self.processSample(0x123456, -0x123456)), (0x123456, -0x123456))
+		# Finish on silence so the history is clear for enabling the filter
+		self.assertEqual((yield from self.processSample(0, 0)), (0, 0))
+
+		# A step into the enabled filter should exactly match the model, and settle at unity gain
+		yield dut.enable.eq(1)
+		samples = [0x400000] * 64
+		expectedSamples = zip(self.filterModel(samples, 44100), self.filterModel([-sample for sample in samples], 44100))
+		for sample, expected in zip(samples, expectedSamples):
+			self.assertEqual((yield from self.processSample(sample, -sample)), expected)
+		self.assertAlmostEqual(expected[0], 0x400000, delta = 0x400000 >> 10)
+
+		# A tone towards the top of the audio band should come out about 9dB down
+		yield dut.enable.eq(0)
+		yield from self.processSample(0, 0)
+		yield dut.enable.eq(1)
+		samples = [round(0x400000 * sin(2 * pi * 16000 * idx / 44100)) for idx in range(128)]
+		outputs = []
+		for sample in samples:
+			outputs.append((yield from self.processSample(sample, sample))[0])
+		self.assertEqual(outputs, self.filterModel(samples, 44100))
+		peak = max(abs(output) for output in outputs[64:])
+		self.assertLess(peak, 0x400000 * 0.4)
+		self.assertGreater(peak, 0x400000 * 0.3)
+
+		# At a rate the filter has no coefficients for, samples pass straight through even when enabled
+		yield dut.sampleRate.eq(192000)
+		yield Settle()
+		self.assertEqual((yield from self.processSample(0x123456, -0x123456)), (0x123456, -0x123456))
@@ -0,0 +1,74 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ...audio.dither import Requantiser
+
+class RequantiserTestCase(ToriiTestCase):
+	dut : Requantiser = Requantiser
+	domains = (('sync', 36.864e6), )
+
+	def processSample(self, left, right):
+		yield self.dut.sampleIn[0].eq(left)
+		yield self.dut.sampleIn[1].eq(right)
+		yield from self.pulse_pos(self.dut.start)
+		yield Settle()
+		while (yield self.dut.done) == 0:
+			yield
+			yield Settle()
+		return ((yield self.dut.sampleOut[0]), (yield self.dut.sampleOut[1]))
+
+	def averageOutput(self, sample, count):
+		total = 0
+		for _ in range(count):
+			left, right = yield from self.processSample(sample, -sample)
+			# The low bits must always have been cleared
+			self.assertEqual(left & 0xff, 0)
+			self.assertEqual(right & 0xff, 0)
+			total += left
+		return total / count
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testRequantiser(self):
+		dut = self.dut
+		yield Settle()
+		yield
+
+		# With the requantiser disabled, samples should pass straight through
+		self.assertEqual((yield from self.processSample(0x123456, -0x123456)), (0x123456, -0x123456))
+
+		# Enabled without dither this should round to the nearest output LSB
+		yield dut.enable.eq(1)
+		self.assertEqual((yield from self.processSample(0x123456, -0x123456)), (0x123400, -0x123400))
+		self.assertEqual((yield from self.processSample(0x123480, 0x1234c0)), (0x123500, 0x123500))
+		# And without dither, samples that already fit come out untouched
+		self.assertEqual((yield from self.processSample(0x123400, -0x123400)), (0x123400, -0x123400))
+
+		# With dither on, the output should wander around but on average come out as the input
+		yield dut.dither.eq(1)
+		outputs = set()
+		for _ in range(32):
+			left, right = yield from self.processSample(0x123440, -0x123440)
+			self.assertLessEqual(abs(left - 0x123440), 0x1c0)
+			self.assertLessEqual(abs(right + 0x123440), 0x1c0)
+			outputs.add(left)
+		self.assertGreater(len(outputs), 1)
+		# Including for samples that already fit, so the dither doesn't come and go with the signal
+		outputs = set()
+		for _ in range(32):
+			left, right = yield from self.processSample(0x123400, -0x123400)
+			outputs.add(left)
+		self.assertGreater(len(outputs), 1)
+		average = yield from self.averageOutput(0x123440, 256)
+		self.assertLess(abs(average - 0x123440), 0x30)
+
+		# The same should go for both orders of noise shaping
+		for order in (1, 2):
+			yield dut.shaping.eq(order)
+			average = yield from self.averageOutput(0x123440, 256)
+			self.assertLess(abs(average - 0x123440), 0x30)
+		# And noise shaping must not go unstable at full scale
+		for _ in range(64):
+			left, right = yield from self.processSample(0x7fffff, -0x800000)
+			self.assertGreater(left, 0x7ff000)
+			self.assertLess(right, -0x7ff000)
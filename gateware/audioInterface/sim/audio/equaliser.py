@@ -0,0 +1,98 @@
+from math import pi, sin, cos
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ...audio.equaliser import Equaliser
+
+class EqualiserTestCase(ToriiTestCase):
+	dut : Equaliser = Equaliser
+	dut_args = {
+		'bands': 2,
+	}
+	domains = (('sync', 36.864e6), ('usb', 60e6))
+
+	def peakingCoefficients(self, frequency, gain, q, sampleRate = 48000):
+		''' Computes the RBJ peaking EQ biquad coefficients, normalised and quantised to Q2.16 '''
+		amplitude = 10 ** (gain / 40)
+		omega = 2 * pi * frequency / sampleRate
+		alpha = sin(omega) / (2 * q)
+		a0 = 1 + alpha / amplitude
+		coefficients = (
+			(1 + alpha * amplitude) / a0,
+			(-2 * cos(omega)) / a0,
+			(1 - alpha * amplitude) / a0,
+			(-2 * cos(omega)) / a0,
+			(1 - alpha / amplitude) / a0,
+		)
+		return tuple(round(coefficient * (1 << Equaliser.coefficientBits)) for coefficient in coefficients)
+
+	def processSample(self, left, right):
+		yield self.dut.sampleIn[0].eq(left)
+		yield self.dut.sampleIn[1].eq(right)
+		yield self.dut.start.eq(1)
+		yield
+		yield self.dut.start.eq(0)
+		yield Settle()
+		while (yield self.dut.done) == 0:
+			yield
+			yield Settle()
+		return ((yield self.dut.sampleOut[0]), (yield self.dut.sampleOut[1]))
+
+	@ToriiTestCase.simulation
+	def testEqualiser(self):
+		dut = self.dut
+		coefficients = self.peakingCoefficients(1000, 6, 0.7)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self):
+			# Load a peaking filter into band 1 of the inactive bank
+			yield dut.writeBand.eq(1)
+			for index, coefficient in enumerate(coefficients):
+				yield dut.writeIndex.eq(index)
+				yield dut.writeData.eq(coefficient & 0x3ffff)
+				yield dut.writeEnable.eq(1)
+				yield Settle()
+				yield
+			yield dut.writeEnable.eq(0)
+			yield Settle()
+			yield
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self):
+			# Give the coefficients a chance to be written
+			for _ in range(16):
+				yield
+			yield Settle()
+
+			# When not enabled, samples pass straight through
+			self.assertEqual((yield from self.processSample(0x123456, -0x123456)), (0x123456, -0x123456))
+
+			# Enabled on the initial bank, every band passes through too. Finish on silence to clear the history
+			yield dut.enable.eq(1)
+			for sample in (0x123456, -0x123456, 0x200000, 0, 0):
+				self.assertEqual((yield from self.processSample(sample, -sample)), (sample, -sample))
+
+			# Swap banks and feed an impulse in, which should exactly match a fixed point model of the filter
+			yield dut.bank.eq(1)
+			b0, b1, b2, a1, a2 = coefficients
+			histories = [[0, 0, 0, 0], [0, 0, 0, 0]]
+			for idx in range(64):
+				sample = 0x100000 if idx == 0 else 0
+				expected = []
+				for history, value in zip(histories, (sample, -sample)):
+					x1, x2, y1, y2 = history
+					result = (b0 * value + b1 * x1 + b2 * x2 - a1 * y1 - a2 * y2) >> Equaliser.coefficientBits
+					history[:] = [value, x1, result, y1]
+					expected.append(result)
+				self.assertEqual((yield from self.processSample(sample, -sample)), tuple(expected))
+
+			# The filter should have a gain of 6dB at its centre frequency
+			peak = 0
+			for idx in range(192):
+				sample = round(0x100000 * sin(2 * pi * 1000 * idx / 48000))
+				left, _ = yield from self.processSample(sample, -sample)
+				if idx >= 96:
+					peak = max(peak, left)
+			self.assertLess(abs(peak - 0x100000 * (10 ** (6 / 20))), 0x8000)
+		domainSync(self)
@@ -0,0 +1,44 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ...audio.multiplier import SerialMultiplier
+
+class SerialMultiplierTestCase(ToriiTestCase):
+	dut : SerialMultiplier = SerialMultiplier
+	dut_args = {
+		'aWidth': 24,
+		'bWidth': 16,
+	}
+	domains = (('sync', 36.864e6), )
+
+	def multiply(self, a, b):
+		yield self.dut.a.eq(a)
+		yield self.dut.b.eq(b)
+		yield from self.pulse_pos(self.dut.start)
+		yield Settle()
+		for _ in range(15):
+			self.assertEqual((yield self.dut.done), 0)
+			self.assertEqual((yield self.dut.busy), 1)
+			yield
+			yield Settle()
+		self.assertEqual((yield self.dut.done), 1)
+		self.assertEqual((yield self.dut.busy), 0)
+		self.assertEqual((yield self.dut.product), a * b)
+		yield
+		yield Settle()
+		self.assertEqual((yield self.dut.done), 0)
+		self.assertEqual((yield self.dut.product), a * b)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testMultiply(self):
+		yield
+		yield from self.multiply(1, 1)
+		yield from self.multiply(0x7fffff, 0x7fff)
+		yield from self.multiply(-0x800000, 0x7fff)
+		yield from self.multiply(0x7fffff, -0x8000)
+		yield from self.multiply(-0x800000, -0x8000)
+		yield from self.multiply(-12345, 321)
+		yield from self.multiply(4321, -1234)
+		yield from self.multiply(0, -1)
+		yield
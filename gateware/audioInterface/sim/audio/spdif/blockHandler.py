@@ -13,26 +13,16 @@ class BlockHandlerTestCase(ToriiTestCase):
 			parity ^= (data >> bit) & 1
 		return parity << 27
 
-	@ToriiTestCase.simulation
-	@ToriiTestCase.sync_domain(domain = 'usb')
-	def testBlockHandling(self):
+	def sendBlock(self, *, emphasis : int):
 		channel = self.dut.channel
 		dataIn = self.dut.dataIn
 		dataAvailable = self.dut.dataAvailable
 		blockBeginning = self.dut.blockBeginning
 		blockComplete = self.dut.blockComplete
-		dropBlock = self.dut.dropBlock
-
-		blockValid = self.dut.blockValid
-		droppingData = self.dut.droppingData
-		dataOut = self.dut.dataOut
-		dataValid = self.dut.dataValid
-		bitDepth = self.dut.bitDepth
-		sampleRate = self.dut.sampleRate
 
 		channelStatusBytes = [
-			# S/PDIF, PCM audio, mode 0
-			0b00000000,
+			# S/PDIF, PCM audio, the pre-emphasis mode being tested, mode 0
+			emphasis << 3,
 			# Category 0
 			0b00000000,
 			# Source 1, Channel 1
@@ -52,7 +42,7 @@ class BlockHandlerTestCase(ToriiTestCase):
 		yield
 		yield from self.pulse_pos(blockBeginning)
 		for sample in range(192):
-			statusBit = (channelStatusBytes[sample >> 3] >> (sample & 3)) & 1
+			statusBit = (channelStatusBytes[sample >> 3] >> (sample & 7)) & 1
 			# Channel A
 			sampleA = ((0xca00 | sample) << 8) | (statusBit << 26)
 			sampleA |= self.computeParity(sampleA)
@@ -66,13 +56,20 @@ class BlockHandlerTestCase(ToriiTestCase):
 			yield channel.eq(1)
 			yield from self.pulse_pos(dataAvailable)
 		yield from self.pulse_pos(blockComplete)
+
+	def checkBlock(self, *, emphasis : bool):
+		blockValid = self.dut.blockValid
+		dataOut = self.dut.dataOut
+		dataValid = self.dut.dataValid
+
 		self.assertEqual((yield blockValid), 0)
 		yield
 		self.assertEqual((yield blockValid), 1)
 		self.assertEqual((yield dataValid), 0)
 		yield
-		self.assertEqual((yield bitDepth), 16)
-		self.assertEqual((yield sampleRate), 48000)
+		self.assertEqual((yield self.dut.bitDepth), 16)
+		self.assertEqual((yield self.dut.sampleRate), 48000)
+		self.assertEqual((yield self.dut.emphasis), int(emphasis))
 		for sample in range(192):
 			self.assertEqual((yield dataValid), 1)
 			self.assertEqual((yield dataOut), 0xca00 | sample)
@@ -83,5 +80,34 @@ class BlockHandlerTestCase(ToriiTestCase):
 		self.assertEqual((yield dataValid), 0)
 		yield
 
+	def checkDropped(self, *, emphasis : bool):
+		# The block's control data can't be played, so it should be thrown away rather than transferred
+		self.assertEqual((yield self.dut.droppedFormat), 1)
+		self.assertEqual((yield self.dut.blockValid), 0)
+		yield
+		self.assertEqual((yield self.dut.blockValid), 0)
+		self.assertEqual((yield self.dut.droppingData), 1)
+		for _ in range(194):
+			self.assertEqual((yield self.dut.dataValid), 0)
+			yield
+		# And what's being played keeps the pre-emphasis setting it had
+		self.assertEqual((yield self.dut.emphasis), int(emphasis))
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testBlockHandling(self):
+		# No pre-emphasis, then 50/15µs pre-emphasis, then back to none again
+		yield from self.sendBlock(emphasis = 0b000)
+		yield from self.checkBlock(emphasis = False)
+		yield from self.sendBlock(emphasis = 0b001)
+		yield from self.checkBlock(emphasis = True)
+		# The other modes are all reserved
+		yield from self.sendBlock(emphasis = 0b010)
+		yield from self.checkDropped(emphasis = True)
+		yield from self.sendBlock(emphasis = 0b000)
+		yield from self.checkBlock(emphasis = False)
+		yield from self.sendBlock(emphasis = 0b111)
+		yield from self.checkDropped(emphasis = False)
+
 # 0x1f00d00
 # 0x1cafe00
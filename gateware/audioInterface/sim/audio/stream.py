@@ -5,7 +5,8 @@ from torii.test import ToriiTestCase
 
 from ...audio import AudioStream
 from ...audio.endpoint import AudioEndpoint
-from ...usb.control import AudioRequestHandler
+from ...usb.control import AudioRequestHandler, VendorRequestHandler, CounterRequestHandler
+from ...usb.notifier import NotificationEndpoint
 
 i2sBus = Record(
 	layout = (
@@ -46,6 +47,9 @@ class Platform:
 class USBInterface(Elaboratable):
 	def __init__(self):
 		self.audioRequestHandler = AudioRequestHandler(configuration = 1, interfaces = (0, 1))
+		self.vendorRequestHandler = VendorRequestHandler(configuration = 1, interface = 0)
+		self.counterRequestHandler = CounterRequestHandler(configuration = 1, interface = 0)
+		self.notificationEndpoint = NotificationEndpoint(2)
 
 	def addEndpoint(self, endpoint : AudioEndpoint):
 		self.endpoint = endpoint
@@ -54,6 +58,9 @@ class USBInterface(Elaboratable):
 		m = Module()
 		m.submodules.endpoint = self.endpoint
 		m.submodules.audioRequestHandler = self.audioRequestHandler
+		m.submodules.vendorRequestHandler = self.vendorRequestHandler
+		m.submodules.counterRequestHandler = self.counterRequestHandler
+		m.submodules.notificationEndpoint = self.notificationEndpoint
 		return m
 
 class AudioInterface(Elaboratable):
@@ -73,11 +80,12 @@ class AudioStreamTestCase(ToriiTestCase):
 	platform = Platform()
 
 	def readBit(self, bit):
-		for i in range(6):
+		# USB audio is 48kHz 16-bit, so each half of the audio clock is 12 system clocks long
+		for i in range(12):
 			yield
 		yield Settle()
 		(yield i2sBus.data.o) == bit
-		for i in range(6):
+		for i in range(12):
 			yield
 		yield Settle()
 
@@ -157,29 +165,29 @@ class AudioStreamTestCase(ToriiTestCase):
 			yield
 			yield stream.next.eq(1)
 			# Send the first sample pair
-			yield stream.payload.eq(0xAD)
+			yield stream.data.eq(0xAD)
 			yield Settle()
 			yield
-			yield stream.payload.eq(0xDE)
+			yield stream.data.eq(0xDE)
 			yield Settle()
 			yield
-			yield stream.payload.eq(0xEF)
+			yield stream.data.eq(0xEF)
 			yield Settle()
 			yield
-			yield stream.payload.eq(0xBE)
+			yield stream.data.eq(0xBE)
 			yield Settle()
 			yield
 			# Then send the second
-			yield stream.payload.eq(0xDA)
+			yield stream.data.eq(0xDA)
 			yield Settle()
 			yield
-			yield stream.payload.eq(0xBA)
+			yield stream.data.eq(0xBA)
 			yield Settle()
 			yield
-			yield stream.payload.eq(0x0C)
+			yield stream.data.eq(0x0C)
 			yield Settle()
 			yield
-			yield stream.payload.eq(0x11)
+			yield stream.data.eq(0x11)
 			yield Settle()
 			yield
 			yield stream.next.eq(0)
@@ -193,3 +201,110 @@ class AudioStreamTestCase(ToriiTestCase):
 			yield Settle()
 			yield
 		domainUSB(self)
+
+	@ToriiTestCase.simulation
+	def testPowerGating(self):
+		requestHandler = self.dut.usb.audioRequestHandler
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def domainUSB(self):
+			# Start the host streaming with the power domain in D3, then bring it back to D0
+			yield requestHandler.altModes[1].eq(1)
+			yield requestHandler.powerState.eq(3)
+			yield Settle()
+			for _ in range(200):
+				yield
+			yield requestHandler.powerState.eq(0)
+			yield Settle()
+			yield
+		domainUSB(self)
+
+		@ToriiTestCase.sync_domain(domain = 'sync')
+		def domainSync(self):
+			# Let the power state and sample format get through into the audio domain
+			for _ in range(8):
+				yield
+			yield Settle()
+			# While powered down, the I²S bus must sit still
+			clk = yield i2sBus.clk.o
+			for _ in range(64):
+				yield
+				yield Settle()
+				assert (yield i2sBus.clk.o) == clk
+			# And once powered back up, it must start running again
+			for _ in range(128):
+				yield
+			toggles = 0
+			for _ in range(64):
+				yield
+				yield Settle()
+				value = yield i2sBus.clk.o
+				toggles += value != clk
+				clk = value
+			assert toggles > 0
+		domainSync(self)
+
+	def sendSamples(self, count):
+		# Send a packet of count 16-bit sample pairs to the streaming endpoint
+		interface = self.dut.usb.endpoint.interface
+		stream = interface.rx
+		yield interface.tokenizer.new_token.eq(1)
+		yield
+		yield interface.tokenizer.new_token.eq(0)
+		yield stream.valid.eq(1)
+		yield stream.next.eq(1)
+		for sample in range(count * 4):
+			yield stream.data.eq(sample)
+			yield
+		yield stream.next.eq(0)
+		yield stream.valid.eq(0)
+		yield interface.rx_complete.eq(1)
+		yield
+		yield interface.rx_complete.eq(0)
+		# Give the samples time to make it across the FIFO into the audio domain
+		for _ in range(16):
+			yield
+		yield Settle()
+
+	def startStreaming(self, altMode):
+		interface = self.dut.usb.endpoint.interface
+		yield interface.active_config.eq(1)
+		yield interface.tokenizer.endpoint.eq(1)
+		yield interface.tokenizer.is_out.eq(1)
+		yield self.dut.usb.audioRequestHandler.altModes[1].eq(altMode)
+		yield
+		yield Settle()
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testLowLatencyPriming(self):
+		primed = self.dut.audio._primed
+		yield from self.startStreaming(2)
+		# The low latency alt mode starts playing once 12 samples are in the FIFO
+		yield from self.sendSamples(11)
+		assert (yield primed) == 0
+		yield from self.sendSamples(1)
+		assert (yield primed) == 1
+		# Those are played out a sample each 48kHz period, after which the FIFO runs dry and has to be primed again
+		for _ in range(20000):
+			if not (yield primed):
+				break
+			yield
+		assert (yield primed) == 0
+		yield from self.sendSamples(11)
+		assert (yield primed) == 0
+		yield from self.sendSamples(1)
+		assert (yield primed) == 1
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testPriming(self):
+		primed = self.dut.audio._primed
+		yield from self.startStreaming(1)
+		# Whereas the normal alt mode waits for a packet and a half, 64 samples
+		yield from self.sendSamples(12)
+		assert (yield primed) == 0
+		yield from self.sendSamples(51)
+		assert (yield primed) == 0
+		yield from self.sendSamples(1)
+		assert (yield primed) == 1
@@ -0,0 +1,56 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+
+from ...audio.volume import VolumeControl
+
+class VolumeControlTestCase(ToriiTestCase):
+	dut : VolumeControl = VolumeControl
+	domains = (('sync', 36.864e6), )
+
+	def processSample(self):
+		yield from self.pulse_pos(self.dut.start)
+		yield Settle()
+		while (yield self.dut.done) == 0:
+			yield
+			yield Settle()
+		return ((yield self.dut.sampleOut[0]), (yield self.dut.sampleOut[1]))
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'sync')
+	def testVolume(self):
+		dut = self.dut
+		yield dut.sampleIn[0].eq(0x400000)
+		yield dut.sampleIn[1].eq(-0x400000)
+		yield Settle()
+		yield
+
+		# At 0dB, samples should pass through exactly
+		self.assertEqual((yield from self.processSample()), (0x400000, -0x400000))
+		self.assertEqual((yield dut.unity), 1)
+
+		# Drop the left channel by 6dB, the gain should ramp down smoothly and settle on half
+		yield dut.volumes[1].eq(-6)
+		previous = 0x400000
+		for _ in range(400):
+			left, right = yield from self.processSample()
+			self.assertLessEqual(left, previous)
+			previous = left
+			self.assertEqual(right, -0x400000)
+		self.assertLess(abs(left - 0x400000 * (10 ** (-6 / 20))), 0x40)
+		self.assertEqual((yield dut.unity), 0)
+
+		# The master volume should stack with the channel volumes
+		yield dut.volumes[0].eq(-14)
+		for _ in range(400):
+			left, right = yield from self.processSample()
+		self.assertLess(abs(left - 0x400000 * (10 ** (-20 / 20))), 0x40)
+		self.assertLess(abs(right + 0x400000 * (10 ** (-14 / 20))), 0x40)
+
+		# And muting the right channel should ramp it to silence
+		yield dut.mutes[2].eq(1)
+		left, right = yield from self.processSample()
+		self.assertNotEqual(right, 0)
+		for _ in range(400):
+			left, right = yield from self.processSample()
+		self.assertEqual(right, 0)
+		self.assertNotEqual(left, 0)
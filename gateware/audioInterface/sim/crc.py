@@ -0,0 +1,39 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+from zlib import crc32
+
+from ..crc import CRC32
+
+class CRC32TestCase(ToriiTestCase):
+	dut : CRC32 = CRC32
+	domains = (('usb', 60e6), )
+
+	def feed(self, data : bytes):
+		for value in data:
+			yield self.dut.data.eq(value)
+			yield self.dut.valid.eq(1)
+			yield
+		yield self.dut.valid.eq(0)
+		yield Settle()
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testCRC32(self):
+		# Nothing fed in yet is the CRC of nothing
+		yield Settle()
+		assert (yield self.dut.value) == crc32(b'')
+		data = b'123456789'
+		yield from self.feed(data)
+		assert (yield self.dut.value) == crc32(data) == 0xcbf43926
+		# Gaps between bytes don't make a difference
+		yield
+		yield
+		data = bytes(range(256))
+		yield from self.feed(data)
+		assert (yield self.dut.value) == crc32(data, crc32(b'123456789'))
+		# And resetting starts it over
+		yield self.dut.reset.eq(1)
+		yield
+		yield self.dut.reset.eq(0)
+		yield from self.feed(data)
+		assert (yield self.dut.value) == crc32(data)
@@ -0,0 +1,205 @@
+from torii import Elaboratable, Module, Record
+from torii.hdl import Memory
+from torii.hdl.rec import DIR_FANOUT, DIR_FANIN
+from torii.sim import Settle, Passive
+from torii.test import ToriiTestCase
+
+from ..spi import SPIController
+from ..flash import SPIFlash, FlashCommands
+
+spiBus = Record(
+	layout = (
+		('cs', [
+			('o', 2, DIR_FANOUT),
+		]),
+		('clk', [
+			('o', 1, DIR_FANOUT),
+		]),
+		('copi', [
+			('o', 1, DIR_FANOUT),
+		]),
+		('cipo', [
+			('i', 1, DIR_FANIN),
+		]),
+	)
+)
+
+class Platform:
+	def request(self, name, number):
+		assert name == 'cfg_spi'
+		assert number == 0
+		return spiBus
+
+class FlashModel:
+	''' A behavioural model of enough of an SPI NOR flash to check the commands the gateware sends it '''
+
+	def __init__(self, bus : Record, *, size = 65536, busyPolls = 2):
+		self.bus = bus
+		self.memory = bytearray(b'\xff' * size)
+		self.busyPolls = busyPolls
+		self.commands = []
+		self._writeEnabled = False
+		self._busy = 0
+
+	def respond(self, data : list) -> int:
+		''' Work out the byte to send back for the byte after those in data '''
+		if data[0] == FlashCommands.readStatus:
+			return (1 if self._busy else 0) | (2 if self._writeEnabled else 0)
+		# Fast reads start returning data after the address and dummy byte
+		elif data[0] == FlashCommands.fastRead and len(data) >= 5:
+			address = (data[1] << 16) | (data[2] << 8) | data[3]
+			return self.memory[(address + len(data) - 5) % len(self.memory)]
+		return 0
+
+	def execute(self, data : list):
+		''' Carry out a command once chip select has been dropped '''
+		command = data[0]
+		self.commands.append(command)
+		address = (data[1] << 16) | (data[2] << 8) | data[3] if len(data) >= 4 else 0
+		if command == FlashCommands.readStatus:
+			# Each read of the status register counts down how busy the flash is
+			if self._busy:
+				self._busy -= 1
+		elif command == FlashCommands.writeEnable:
+			self._writeEnabled = True
+		elif command == FlashCommands.sectorErase:
+			assert self._writeEnabled
+			sector = address & ~0xfff
+			self.memory[sector:sector + 0x1000] = b'\xff' * 0x1000
+			self._writeEnabled = False
+			self._busy = self.busyPolls
+		elif command == FlashCommands.pageProgram:
+			assert self._writeEnabled
+			for idx, value in enumerate(data[4:]):
+				# Programming wraps within the page, and can only clear bits
+				target = (address & ~0xff) | ((address + idx) & 0xff)
+				self.memory[target] &= value
+			self._writeEnabled = False
+			self._busy = self.busyPolls
+
+	def run(self):
+		yield Passive()
+		while True:
+			yield Settle()
+			if not ((yield self.bus.cs.o) & 0b10):
+				yield
+				continue
+			data = []
+			byte = 0
+			bits = 0
+			response = 0
+			clk = yield self.bus.clk.o
+			yield self.bus.cipo.i.eq(0)
+			while (yield self.bus.cs.o) & 0b10:
+				value = yield self.bus.clk.o
+				# Sample on the rising edge, and change what we send back on the falling edge
+				if value and not clk:
+					byte = (byte << 1) | (yield self.bus.copi.o)
+					bits += 1
+					if bits == 8:
+						data.append(byte)
+						response = self.respond(data)
+						byte = 0
+						bits = 0
+				elif clk and not value:
+					yield self.bus.cipo.i.eq((response >> (7 - bits)) & 1)
+				clk = value
+				yield
+				yield Settle()
+			if data:
+				self.execute(data)
+
+class Flash(Elaboratable):
+	def __init__(self):
+		self.spi = SPIController(clkDivider = 1)
+		self.flash = SPIFlash(self.spi.ports[0])
+		self.buffer = Memory(width = 8, depth = SPIFlash.pageSize, init = range(SPIFlash.pageSize))
+
+	def elaborate(self, platform):
+		m = Module()
+		m.submodules.spi = self.spi
+		m.submodules.flash = self.flash
+		m.submodules.bufferRead = readPort = self.buffer.read_port(domain = 'usb', transparent = False)
+		m.d.comb += [
+			readPort.addr.eq(self.flash.bufferAddress),
+			self.flash.bufferData.eq(readPort.data),
+		]
+		return m
+
+class SPIFlashTestCase(ToriiTestCase):
+	dut : Flash = Flash
+	domains = (('usb', 60e6), )
+	platform = Platform()
+
+	def waitDone(self):
+		while not (yield self.dut.flash.done):
+			yield
+			yield Settle()
+		yield
+
+	@ToriiTestCase.simulation
+	def testSPIFlash(self):
+		flash = self.dut.flash
+		model = FlashModel(spiBus)
+		model.memory[0x1000:0x1010] = b'\x00' * 16
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def flashModel(self):
+			yield from model.run()
+		flashModel(self)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def control(self):
+			# Erase the sector at 4KiB, waking the flash up first
+			yield flash.address.eq(0x1010)
+			yield flash.erase.eq(1)
+			yield
+			yield flash.erase.eq(0)
+			yield Settle()
+			assert (yield flash.busy) == 1
+			assert (yield flash.erasing) == 1
+			yield from self.waitDone()
+			assert (yield flash.busy) == 0
+			assert (yield flash.erasing) == 0
+			self.assertEqual(model.commands, [
+				FlashCommands.releasePowerDown, FlashCommands.writeEnable, FlashCommands.sectorErase,
+				FlashCommands.readStatus, FlashCommands.readStatus, FlashCommands.readStatus,
+			])
+			self.assertEqual(model.memory[0x1000:0x1010], b'\xff' * 16)
+
+			# Then program some of its first page
+			model.commands.clear()
+			yield flash.address.eq(0x1000)
+			yield flash.length.eq(20)
+			yield flash.program.eq(1)
+			yield
+			yield flash.program.eq(0)
+			yield Settle()
+			assert (yield flash.erasing) == 0
+			written = []
+			while not (yield flash.done):
+				if (yield flash.writeValid):
+					written.append((yield flash.writeData))
+				yield
+				yield Settle()
+			yield
+			self.assertEqual(bytes(written), bytes(range(20)))
+			self.assertEqual(model.commands[:2], [FlashCommands.writeEnable, FlashCommands.pageProgram])
+			self.assertEqual(model.memory[0x1000:0x1015], bytes(range(20)) + b'\xff')
+
+			# And read it back, along with a bit of the rest of the page
+			model.commands.clear()
+			yield flash.address.eq(0x1002)
+			yield flash.length.eq(24)
+			yield flash.read.eq(1)
+			yield
+			yield flash.read.eq(0)
+			data = []
+			while not (yield flash.done):
+				if (yield flash.readValid):
+					data.append((yield flash.readData))
+				yield
+				yield Settle()
+			self.assertEqual(model.commands, [FlashCommands.fastRead])
+			self.assertEqual(bytes(data), bytes(range(2, 20)) + b'\xff' * 6)
+		control(self)
@@ -0,0 +1,32 @@
+from unittest import TestCase
+from torii.hdl import Elaboratable, Module, Signal
+from torii.hdl.ir import Fragment
+
+from ..profiling import profileElaboration
+
+class Leaf(Elaboratable):
+	def elaborate(self, platform):
+		m = Module()
+		m.d.sync += Signal().eq(1)
+		return m
+
+class Tree(Elaboratable):
+	def elaborate(self, platform):
+		m = Module()
+		m.submodules.left = Leaf()
+		m.submodules += Leaf()
+		return m
+
+class ProfileElaborationTestCase(TestCase):
+	def testProfile(self):
+		get = Fragment.get
+		with profileElaboration() as profile:
+			Fragment.get(Tree(), None)
+		# Fragment.get is put back afterwards
+		assert Fragment.get is get
+
+		records = list(profile.records())
+		assert [record.path for record in records] == ['Tree', 'Tree.left', 'Tree.Leaf']
+		tree = records[0]
+		assert tree.total >= sum(child.total for child in tree.children)
+		assert all(record.self >= 0 for record in records)
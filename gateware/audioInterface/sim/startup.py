@@ -0,0 +1,60 @@
+from pathlib import Path
+from subprocess import run
+from sys import executable
+from typing import Dict, Tuple
+from unittest import TestCase
+
+gatewarePath = Path(__file__).resolve().parents[2]
+
+def importTimes(*args : str) -> Dict[str, Tuple[int, int]]:
+	'''
+	Run Python with the given arguments under `python -X importtime`, returning the time each module's
+	import took in µs, by itself and including the imports it made
+	'''
+	result = run([executable, '-X', 'importtime', *args], cwd = gatewarePath, capture_output = True, text = True,
+		check = True)
+	times : Dict[str, Tuple[int, int]] = {}
+	for line in result.stderr.splitlines():
+		if not line.startswith('import time:') or 'self [us]' in line:
+			continue
+		selfTime, cumulative, name = line.removeprefix('import time:').split('|')
+		# Nested imports are indented under the module that made them, after the space following the |
+		times[name[1:].rstrip()] = (int(selfTime), int(cumulative))
+	return times
+
+class StartupTimeTestCase(TestCase):
+	'''
+	The CLI should get as far as dispatching any action without importing anything heavy, so that
+	`--help` and the like feel instant. This measures the imports each action's argument parsing does,
+	failing if they add up to more than the budget or pull in any of the packages only the actions use.
+	What the interpreter imports for itself before running anything isn't counted.
+	'''
+
+	# Imports up to the point of dispatching an action must take no longer than this, in µs
+	importBudget = 100_000
+	# These are for the actions themselves to import, once they know they need them
+	heavyPackages = ('torii', 'torii_usb', 'usb_construct', 'rich')
+
+	def testStartupTime(self):
+		interpreter = set(importTimes('-c', 'pass'))
+		cli = str(gatewarePath / 'audioInterface.py')
+		for action in ('build', 'sim', 'personalise'):
+			with self.subTest(action = action):
+				# Take the best of a few runs, so a busy machine doesn't fail the test
+				runs = [importTimes(cli, action, '--help') for _ in range(3)]
+				totals = [
+					sum(
+						cumulative for name, (_, cumulative) in times.items()
+						if not name.startswith(' ') and name not in interpreter
+					)
+					for times in runs
+				]
+				times = runs[totals.index(min(totals))]
+
+				heavy = sorted(name.strip() for name in times if name.strip().split('.')[0] in self.heavyPackages)
+				assert not heavy, f'{action} imports {", ".join(heavy)} before dispatching'
+				slowest = sorted(times.items(), key = lambda item: item[1][0], reverse = True)[:5]
+				assert min(totals) <= self.importBudget, (
+					f'{action} took {min(totals) / 1000:.1f}ms to import, over the {self.importBudget / 1000:.0f}ms '
+					f'budget. Slowest: {", ".join(f"{name.strip()} ({selfTime}µs)" for name, (selfTime, _) in slowest)}'
+				)
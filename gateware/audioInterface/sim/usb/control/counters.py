@@ -0,0 +1,152 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+from usb_construct.types import USBRequestType, USBRequestRecipient
+from typing import Tuple
+
+from ....usb.control.counters import CounterRequestHandler, PerformanceCounters
+from ....usb.control.vendor import VendorRequests
+
+class CounterRequestHandlerTestCase(ToriiTestCase):
+	dut : CounterRequestHandler = CounterRequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0
+	}
+	domains = (('usb', 60e6),)
+
+	def sendSetupReadCounters(self, *, length : int, retrieve : bool = True):
+		yield self.setup.recipient.eq(USBRequestRecipient.INTERFACE)
+		yield self.setup.type.eq(USBRequestType.VENDOR)
+		yield self.setup.is_in_request.eq(1 if retrieve else 0)
+		yield self.setup.request.eq(VendorRequests.READ_COUNTERS)
+		yield self.setup.value.eq(0)
+		yield self.setup.index.eq(0)
+		yield self.setup.length.eq(length)
+		yield self.setup.received.eq(1)
+		yield Settle()
+		yield
+		yield self.setup.received.eq(0)
+		yield Settle()
+		yield
+		yield
+
+	def receiveData(self, *, length : int) -> Tuple[int, ...]:
+		yield self.tx.ready.eq(1)
+		yield self.interface.data_requested.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.data_requested.eq(0)
+		yield Settle()
+		yield
+		data = []
+		for idx in range(length):
+			assert (yield self.tx.first) == (1 if idx == 0 else 0)
+			assert (yield self.tx.last) == (1 if idx == length - 1 else 0)
+			assert (yield self.tx.valid) == 1
+			data.append((yield self.tx.data))
+			if idx == length - 1:
+				yield self.tx.ready.eq(0)
+				yield self.interface.status_requested.eq(1)
+			yield Settle()
+			yield
+		assert (yield self.tx.valid) == 0
+		assert (yield self.interface.handshakes_out.ack) == 1
+		yield self.interface.status_requested.eq(0)
+		yield Settle()
+		yield
+		return tuple(data)
+
+	def receiveStall(self):
+		yield self.interface.status_requested.eq(1)
+		yield Settle()
+		assert (yield self.interface.handshakes_out.stall) == 1
+		yield
+		yield self.interface.status_requested.eq(0)
+		yield Settle()
+		yield
+
+	def readCounters(self):
+		length = len(PerformanceCounters) * 2
+		yield from self.sendSetupReadCounters(length = length)
+		data = yield from self.receiveData(length = length)
+		return {
+			counter: data[counter * 2] | (data[counter * 2 + 1] << 8) for counter in PerformanceCounters
+		}
+
+	def pulseEvent(self, counter : PerformanceCounters, *, count : int = 1):
+		yield self.dut.events[counter].eq(1)
+		for _ in range(count):
+			yield Settle()
+			yield
+		yield self.dut.events[counter].eq(0)
+		yield Settle()
+		yield
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testCounterRequestHandler(self):
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+
+		yield self.interface.active_config.eq(1)
+		yield Settle()
+		yield
+
+		# Generate some events and move the fill level about
+		yield from self.pulseEvent(PerformanceCounters.fifoUnderruns, count = 3)
+		yield from self.pulseEvent(PerformanceCounters.packetsReceived, count = 300)
+		yield from self.pulseEvent(PerformanceCounters.blocksDroppedLength)
+		yield self.dut.fillLevelValid.eq(1)
+		for level in (128, 100, 200, 150):
+			yield self.dut.fillLevel.eq(level)
+			yield Settle()
+			yield
+		# Fill levels while no audio is moving don't count
+		yield self.dut.fillLevelValid.eq(0)
+		yield self.dut.fillLevel.eq(0)
+		yield Settle()
+		yield
+
+		counters = yield from self.readCounters()
+		expected = {counter: 0 for counter in PerformanceCounters}
+		expected.update({
+			PerformanceCounters.fifoUnderruns: 3,
+			PerformanceCounters.packetsReceived: 300,
+			PerformanceCounters.blocksDroppedLength: 1,
+			PerformanceCounters.fifoMinFill: 100,
+			PerformanceCounters.fifoMaxFill: 200,
+		})
+		self.assertEqual(counters, expected)
+
+		# Reading the counters clears them
+		counters = yield from self.readCounters()
+		expected = {counter: 0 for counter in PerformanceCounters}
+		expected[PerformanceCounters.fifoMinFill] = 0xffff
+		self.assertEqual(counters, expected)
+
+		# And the host can ask for just the first few
+		yield from self.pulseEvent(PerformanceCounters.fifoUnderruns)
+		yield from self.sendSetupReadCounters(length = 2)
+		self.assertEqual((yield from self.receiveData(length = 2)), (1, 0))
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testStalledRead(self):
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+
+		yield self.interface.active_config.eq(1)
+		yield Settle()
+		yield
+
+		yield from self.pulseEvent(PerformanceCounters.packetsRejected, count = 5)
+		# Requests that can't return the counters are stalled, and leave them be
+		yield from self.sendSetupReadCounters(length = len(PerformanceCounters) * 2, retrieve = False)
+		yield from self.receiveStall()
+		yield from self.sendSetupReadCounters(length = 0)
+		yield from self.receiveStall()
+
+		counters = yield from self.readCounters()
+		self.assertEqual(counters[PerformanceCounters.packetsRejected], 5)
@@ -1,18 +1,50 @@
+from torii import Elaboratable, Module
 from torii.sim import Settle
 from torii.test import ToriiTestCase
 from usb_construct.types import USBRequestType, USBRequestRecipient, USBStandardRequests
 from usb_construct.types.descriptors.dfu import DFURequests
 from typing import Tuple, Union
+from struct import pack
+from zlib import crc32
 
-from ....usb.control.dfu import DFURequestHandler, DFUState
+from ....spi import SPIController
+from ....flash import SPIFlash, FlashCommands, FlashLayout
+from ....usb.control.dfu import DFURequestHandler, DFUState, DFUStatus, ImageVerifyStatus
+from ....usb.control.vendor import VendorRequests
+from ...flash import FlashModel, Platform, spiBus
 
-class DFURequestHandlerTestCase(ToriiTestCase):
-	dut : DFURequestHandler = DFURequestHandler
-	dut_args = {
-		'configuration': 1,
-		'interface': 0
-	}
+installedMagic = DFURequestHandler.installedMagic
+confirmedMagic = DFURequestHandler.confirmedMagic
+
+class DFU(Elaboratable):
+	def __init__(self, **kwargs):
+		self.spi = SPIController(clkDivider = 1)
+		self.handler = DFURequestHandler(
+			configuration = 1, interface = 0, flash = self.spi.ports[0], imageBase = 0, imageSize = 300, **kwargs
+		)
+
+	def elaborate(self, platform):
+		m = Module()
+		m.submodules.spi = self.spi
+		m.submodules.handler = self.handler
+		return m
+
+class DFUTestCase(ToriiTestCase):
+	dut : DFU = DFU
 	domains = (('usb', 60e6),)
+	platform = Platform()
+
+	def attach(self, model : FlashModel = None):
+		self.interface = self.dut.handler.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+
+		if model is not None:
+			@ToriiTestCase.sync_domain(domain = 'usb')
+			def flashModel(self):
+				yield from model.run()
+			flashModel(self)
 
 	def setupReceived(self):
 		yield self.setup.received.eq(1)
@@ -53,10 +85,44 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
 			request = DFURequests.DETACH, value = 1000, index = 0, length = 0)
 
+	def sendDFUDownload(self, *, block : int, length : int):
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = False,
+			request = DFURequests.DOWNLOAD, value = block, index = 0, length = length)
+
+	def sendDFUUpload(self, *, block : int, length : int):
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = True,
+			request = DFURequests.UPLOAD, value = block, index = 0, length = length)
+
 	def sendDFUGetStatus(self):
 		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = True,
 			request = DFURequests.GET_STATUS, value = 0, index = 0, length = 6)
 
+	def sendRollback(self):
+		yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = False,
+			request = VendorRequests.ROLLBACK, value = 0, index = 0, length = 0)
+
+	def waitReboot(self, cycles : int):
+		# Wait for the device to reboot, returning which image it's booting or None if it didn't
+		for _ in range(cycles):
+			if (yield self.dut.handler._triggerReboot):
+				return (yield self.dut.handler._warmbootSelect)
+			yield
+		return None
+
+	def sendImageCRC(self):
+		yield from self.sendSetup(type = USBRequestType.VENDOR, retrieve = True,
+			request = VendorRequests.IMAGE_CRC, value = 0, index = 0, length = DFURequestHandler.imageCRCLength)
+
+	def waitManifested(self):
+		# Poll GET_STATUS like a host would, until the device is done programming and checking the flash
+		manifesting = (DFUStatus.ok, SPIFlash.pageProgramTime, 0, 0, DFUState.manifest, 0)
+		while True:
+			yield from self.sendDFUGetStatus()
+			if not (yield from self.receiveData(data = manifesting, check = False)):
+				break
+			for _ in range(SPIFlash.pollCycles):
+				yield
+
 	def receiveData(self, *, data : Union[Tuple[int], bytes], check = True):
 		result = True
 		yield self.tx.ready.eq(1)
@@ -65,7 +131,7 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 		yield
 		yield self.interface.data_requested.eq(0)
 		assert (yield self.tx.valid) == 0
-		assert (yield self.tx.payload) == 0
+		assert (yield self.tx.data) == 0
 		while (yield self.tx.first) == 0:
 			yield Settle()
 			yield
@@ -74,8 +140,8 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 			assert (yield self.tx.last) == (1 if idx == len(data) - 1 else 0)
 			assert (yield self.tx.valid) == 1
 			if check:
-				assert (yield self.tx.payload) == value
-			elif (yield self.tx.payload) != value:
+				assert (yield self.tx.data) == value
+			elif (yield self.tx.data) != value:
 				result = False
 			assert (yield self.interface.handshakes_out.ack) == 0
 			if idx == len(data) - 1:
@@ -84,7 +150,7 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 			yield Settle()
 			yield
 		assert (yield self.tx.valid) == 0
-		assert (yield self.tx.payload) == 0
+		assert (yield self.tx.data) == 0
 		assert (yield self.interface.handshakes_out.ack) == 1
 		yield self.interface.status_requested.eq(0)
 		yield Settle()
@@ -110,13 +176,85 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 		yield Settle()
 		yield
 
+	def sendData(self, *, data : Union[Tuple[int], bytes]):
+		yield self.rx.valid.eq(1)
+		for value in data:
+			yield Settle()
+			yield
+			yield self.rx.data.eq(value)
+			yield self.rx.next.eq(1)
+			yield Settle()
+			yield
+			yield self.rx.next.eq(0)
+		yield self.rx.valid.eq(0)
+		yield self.interface.rx_ready_for_response.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.rx_ready_for_response.eq(0)
+		yield self.interface.status_requested.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.status_requested.eq(0)
+		yield self.interface.handshakes_in.ack.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.handshakes_in.ack.eq(0)
+		yield Settle()
+		yield
+
+	def receiveUpload(self, *, data : bytes):
+		# Read the block out a packet at a time, going again whenever we're NAK'd, and count the NAKs
+		naks = 0
+		for packet, offset in enumerate(range(0, max(len(data), 1), 64)):
+			chunk = data[offset:offset + 64]
+			while True:
+				yield self.tx.ready.eq(1)
+				yield self.interface.data_requested.eq(1)
+				yield Settle()
+				nak = yield self.interface.handshakes_out.nak
+				if not chunk and not nak:
+					assert (yield self.tx.valid) == 1
+					assert (yield self.tx.last) == 1
+				yield
+				yield self.interface.data_requested.eq(0)
+				yield Settle()
+				if not nak:
+					break
+				naks += 1
+				for _ in range(16):
+					yield
+			received = []
+			for idx, value in enumerate(chunk):
+				assert (yield self.tx.valid) == 1
+				assert (yield self.tx.first) == (1 if idx == 0 else 0)
+				assert (yield self.tx.last) == (1 if idx == len(chunk) - 1 else 0)
+				received.append((yield self.tx.data))
+				yield
+				yield Settle()
+			yield self.tx.ready.eq(0)
+			assert (yield self.tx.valid) == 0
+			self.assertEqual(bytes(received), chunk)
+			assert (yield self.interface.tx_data_pid) == (1 if packet % 2 == 0 else 0)
+			yield self.interface.handshakes_in.ack.eq(1)
+			yield Settle()
+			yield
+			yield self.interface.handshakes_in.ack.eq(0)
+			yield Settle()
+			yield
+		yield self.interface.status_requested.eq(1)
+		yield Settle()
+		assert (yield self.interface.handshakes_out.ack) == 1
+		yield
+		yield self.interface.status_requested.eq(0)
+		yield Settle()
+		yield
+		return naks
+
+class DFURequestHandlerTestCase(DFUTestCase):
 	@ToriiTestCase.simulation
 	@ToriiTestCase.sync_domain(domain = 'usb')
 	def testDFURequestHandler(self):
-		self.interface = self.dut.interface
-		self.setup = self.interface.setup
-		self.tx = self.interface.tx
-		self.rx = self.interface.rx
+		self.attach()
 
 		yield self.interface.active_config.eq(1)
 		yield Settle()
@@ -128,6 +266,241 @@ class DFURequestHandlerTestCase(ToriiTestCase):
 		yield
 		yield from self.sendDFUGetStatus()
 		yield from self.receiveData(data = (0, 0, 0, 0, DFUState.appIdle, 0))
+		# A detach reboots into the golden image, once the boot record's been read
 		yield from self.sendDFUDetach()
 		yield from self.receiveZLP()
-		assert (yield self.dut._triggerReboot) == 1
+		assert (yield from self.waitReboot(1000)) == FlashLayout.goldenWarmboot
+
+	@ToriiTestCase.simulation
+	def testDFUDownload(self):
+		model = FlashModel(spiBus)
+		# Start out with a confirmed update in the slot, to be replaced
+		bootRecord = FlashLayout.bootRecord
+		model.memory[bootRecord:bootRecord + 3] = bytes((installedMagic, confirmedMagic, 0xfe))
+		self.attach(model)
+
+		def waitProgrammed(pages):
+			# Wait for the flash to finish programming, and the gateware to notice
+			while model.commands.count(FlashCommands.pageProgram) != pages or model._busy:
+				yield
+			for _ in range(SPIFlash.pollCycles * 2):
+				yield
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			eraseTimeout = SPIFlash.sectorEraseTime + SPIFlash.pageProgramTime
+			yield self.interface.active_config.eq(1)
+			yield Settle()
+			yield
+			# The first block lands in an empty buffer, so the host can carry straight on
+			firstBlock = bytes((idx * 3) & 0xff for idx in range(SPIFlash.pageSize))
+			yield from self.sendDFUDownload(block = 0, length = len(firstBlock))
+			yield from self.sendData(data = firstBlock)
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.ok, 0, 0, 0, DFUState.dnloadIdle, 0))
+			# The second fills the other half, so the host has to wait for the sector erase and first page
+			yield from self.sendDFUDownload(block = 1, length = 8)
+			yield from self.sendData(data = range(0x80, 0x88))
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.ok, eraseTimeout, 0, 0, DFUState.dnBusy, 0))
+			# Once the first block is programmed, there's space again
+			yield from waitProgrammed(1)
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.ok, 0, 0, 0, DFUState.dnloadIdle, 0))
+			# A zero length download ends it, and the device reboots once everything's been programmed
+			yield from self.sendDFUDownload(block = 2, length = 0)
+			yield from self.receiveZLP()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.ok, 1, 0, 0, DFUState.manifest, 0))
+			assert (yield self.dut.handler._triggerReboot) == 0
+			# The flash is read back to check it once it's all programmed, and the reboot waits for that
+			yield from self.waitManifested()
+			# The boot record's sector was erased before anything was programmed, and installed written once checked
+			self.assertEqual(model.commands.count(FlashCommands.sectorErase), 2)
+			self.assertEqual(model.commands.count(FlashCommands.pageProgram), 3)
+			self.assertEqual(model.memory[bootRecord:bootRecord + 3], bytes((installedMagic, 0xff, 0xff)))
+			image = firstBlock + bytes(range(0x80, 0x88))
+			yield from self.sendImageCRC()
+			yield from self.receiveData(
+				data = pack('<BI', ImageVerifyStatus.passed, len(image))[:4] + pack('<II', crc32(image), crc32(image))
+			)
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.ok, 0, 0, 0, DFUState.manifestWaitReset, 0))
+			assert (yield from self.waitReboot(16)) == FlashLayout.goldenWarmboot
+			self.assertEqual(model.memory[0:256], firstBlock)
+			self.assertEqual(model.memory[256:265], bytes(range(0x80, 0x88)) + b'\xff')
+
+			# Downloading anything else now is an error
+			yield from self.sendDFUDownload(block = 3, length = 16)
+			yield self.interface.data_requested.eq(1)
+			yield Settle()
+			assert (yield self.interface.handshakes_out.stall) == 1
+			yield
+			yield self.interface.data_requested.eq(0)
+			yield Settle()
+			yield
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.errStalledPkt, 0, 0, 0, DFUState.error, 0))
+		host(self)
+
+	@ToriiTestCase.simulation
+	def testDFUVerifyFailure(self):
+		model = FlashModel(spiBus)
+		self.attach(model)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			yield self.interface.active_config.eq(1)
+			yield Settle()
+			yield
+			image = bytes(range(32))
+			yield from self.sendDFUDownload(block = 0, length = len(image))
+			yield from self.sendData(data = image)
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.ok, 0, 0, 0, DFUState.dnloadIdle, 0))
+			yield from self.sendDFUDownload(block = 1, length = 0)
+			yield from self.receiveZLP()
+			# Have a bit not take while the page is programmed
+			while FlashCommands.pageProgram not in model.commands:
+				yield
+			model.memory[5] |= 0x80
+			yield from self.waitManifested()
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.errVerify, 0, 0, 0, DFUState.error, 0))
+			assert (yield self.dut.handler._triggerReboot) == 0
+			# And with the boot record left erased, the update slot won't be booted
+			self.assertEqual(model.memory[FlashLayout.bootRecord], 0xff)
+			corrupted = bytes(model.memory[0:len(image)])
+			yield from self.sendImageCRC()
+			yield from self.receiveData(
+				data = pack('<BI', ImageVerifyStatus.failed, len(image))[:4] + pack('<II', crc32(image), crc32(corrupted))
+			)
+		host(self)
+
+	@ToriiTestCase.simulation
+	def testDFUUpload(self):
+		model = FlashModel(spiBus)
+		image = bytes((idx * 7) & 0xff for idx in range(300))
+		model.memory[0:300] = image
+		self.attach(model)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			yield self.interface.active_config.eq(1)
+			yield Settle()
+			yield
+			# The first block has to come in from the flash, so we get NAK'd for a bit
+			yield from self.sendDFUUpload(block = 0, length = 256)
+			assert (yield from self.receiveUpload(data = image[0:256])) > 0
+			# But the next is read ahead while we're busy with that, and being the end of the image, is short
+			for _ in range(1000):
+				yield
+			yield from self.sendDFUUpload(block = 1, length = 256)
+			assert (yield from self.receiveUpload(data = image[256:300])) == 0
+			# Past reading the boot record in at startup
+			self.assertEqual(model.commands, [
+				FlashCommands.releasePowerDown, FlashCommands.fastRead, FlashCommands.fastRead, FlashCommands.fastRead
+			])
+			yield from self.sendDFUGetStatus()
+			yield from self.receiveData(data = (DFUStatus.ok, 0, 0, 0, DFUState.appIdle, 0))
+			# Anything past the end is empty
+			yield from self.sendDFUUpload(block = 2, length = 256)
+			assert (yield from self.receiveUpload(data = b'')) == 0
+		host(self)
+
+class DFUGoldenBootTestCase(DFUTestCase):
+	dut_args = {
+		'golden': True,
+	}
+
+	def bootWith(self, record : bytes):
+		model = FlashModel(spiBus)
+		model.memory[FlashLayout.bootRecord:FlashLayout.bootRecord + 3] = record
+		self.attach(model)
+		return model
+
+	@ToriiTestCase.simulation
+	def testBootConfirmed(self):
+		model = self.bootWith(bytes((installedMagic, confirmedMagic, 0xf8)))
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			# A confirmed update is booted straight away, attempts or no
+			assert (yield from self.waitReboot(1000)) == FlashLayout.updateWarmboot
+			self.assertNotIn(FlashCommands.pageProgram, model.commands)
+		host(self)
+
+	@ToriiTestCase.simulation
+	def testBootAttempt(self):
+		model = self.bootWith(bytes((installedMagic, 0xff, 0xfc)))
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			# One that's not been confirmed has an attempt used up first
+			assert (yield from self.waitReboot(SPIFlash.pollCycles * 4)) == FlashLayout.updateWarmboot
+			self.assertEqual(model.memory[FlashLayout.bootRecord + 2], 0xf8)
+		host(self)
+
+	@ToriiTestCase.simulation
+	def testBootExhausted(self):
+		model = self.bootWith(bytes((installedMagic, 0xff, 0xf8)))
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			# And once they're all gone, we stay put
+			assert (yield from self.waitReboot(SPIFlash.pollCycles * 4)) is None
+			self.assertNotIn(FlashCommands.pageProgram, model.commands)
+		host(self)
+
+class DFUUpdateBootTestCase(DFUTestCase):
+	dut_args = {
+		'confirmTimeout': 4000,
+	}
+
+	@ToriiTestCase.simulation
+	def testConfirm(self):
+		model = FlashModel(spiBus)
+		model.memory[FlashLayout.bootRecord:FlashLayout.bootRecord + 3] = bytes((installedMagic, 0xff, 0xfe))
+		self.attach(model)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			# Being configured by the host confirms the update, and so it's not rebooted out of
+			for _ in range(100):
+				yield
+			yield self.interface.active_config.eq(1)
+			assert (yield from self.waitReboot(6000)) is None
+			self.assertEqual(model.memory[FlashLayout.bootRecord + 1], confirmedMagic)
+		host(self)
+
+	@ToriiTestCase.simulation
+	def testFallback(self):
+		model = FlashModel(spiBus)
+		model.memory[FlashLayout.bootRecord:FlashLayout.bootRecord + 3] = bytes((installedMagic, 0xff, 0xfe))
+		self.attach(model)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			# But if no host gets as far as configuring it, it gives up and goes back to the golden image
+			assert (yield from self.waitReboot(3900)) is None
+			assert (yield from self.waitReboot(200)) == FlashLayout.goldenWarmboot
+			self.assertNotIn(FlashCommands.pageProgram, model.commands)
+		host(self)
+
+	@ToriiTestCase.simulation
+	def testRollback(self):
+		model = FlashModel(spiBus)
+		model.memory[FlashLayout.bootRecord:FlashLayout.bootRecord + 3] = bytes((installedMagic, confirmedMagic, 0xff))
+		self.attach(model)
+
+		@ToriiTestCase.sync_domain(domain = 'usb')
+		def host(self):
+			yield self.interface.active_config.eq(1)
+			yield Settle()
+			yield
+			# Rolling back clears installed in the boot record, then reboots into the golden image
+			yield from self.sendRollback()
+			yield from self.receiveZLP()
+			assert (yield from self.waitReboot(SPIFlash.pollCycles * 4)) == FlashLayout.goldenWarmboot
+			self.assertEqual(model.memory[FlashLayout.bootRecord], 0x00)
+		host(self)
@@ -0,0 +1,33 @@
+from torii.test import ToriiTestCase
+from usb_construct.types import USBRequestType, USBRequestRecipient
+from usb_construct.types.descriptors.uac3 import AudioClassSpecificRequestCodes
+
+from .standard import DescriptorHandlerTestCase, highCapabilityDescriptors
+
+class HighCapabilityRequestHandlerTestCase(DescriptorHandlerTestCase):
+	def sendGetHighCapabilityDescriptor(self, *, descriptorID : int, length : int):
+		yield from self.sendSetup(type = USBRequestType.CLASS, recipient = USBRequestRecipient.INTERFACE,
+			request = AudioClassSpecificRequestCodes.HIGH_CAPABILITY_DESCRIPTOR, value = descriptorID, index = 0,
+			length = length)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testGetHighCapabilityDescriptor(self):
+		cluster = highCapabilityDescriptors[2]
+		connectors = highCapabilityDescriptors[4]
+
+		self.attach(self.dut.highCapability)
+		yield self.interface.active_config.eq(1)
+		# The host reads the header of each descriptor first, then the whole thing
+		yield from self.sendGetHighCapabilityDescriptor(descriptorID = 2, length = 6)
+		yield from self.receiveResponse(length = 6, data = cluster)
+		yield from self.sendGetHighCapabilityDescriptor(descriptorID = 2, length = len(cluster))
+		yield from self.receiveResponse(length = len(cluster), data = cluster)
+		yield from self.sendGetHighCapabilityDescriptor(descriptorID = 4, length = len(connectors))
+		yield from self.receiveResponse(length = len(connectors), data = connectors)
+
+		# IDs without a descriptor are stalled
+		yield from self.sendGetHighCapabilityDescriptor(descriptorID = 3, length = 6)
+		assert (yield from self.requestData()) == 1
+		yield
+		assert (yield self.tx.valid) == 0
@@ -2,7 +2,8 @@ from torii.sim import Settle
 from torii.test import ToriiTestCase
 from usb_construct.types import USBRequestType, USBRequestRecipient, USBStandardRequests
 from usb_construct.types.descriptors.uac3 import (
-	AudioClassSpecificRequestCodes, AudioControlInterfaceControlSelectors, FeatureUnitControlSelectors
+	AudioClassSpecificRequestCodes, AudioControlInterfaceControlSelectors, FeatureUnitControlSelectors,
+	TerminalControlSelectors, ClockSourceControlSelectors
 )
 from typing import Tuple
 
@@ -72,13 +73,34 @@ class AudioRequestHandlerTestCase(ToriiTestCase):
 			value = (0, FeatureUnitControlSelectors.FU_VOLUME_CONTROL),
 			index = (0, 2), length = 8)
 
+	def sendSetupLatency(self, *, retrieve : bool):
+		# setup packet for interface 0 to the output terminal
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = retrieve,
+			request = AudioClassSpecificRequestCodes.CUR,
+			value = (0, TerminalControlSelectors.TE_LATENCY_CONTROL),
+			index = (0, 3), length = 4)
+
+	def sendSetupSampleRate(self, *, retrieve : bool):
+		# setup packet for interface 0 to the clock source
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = retrieve,
+			request = AudioClassSpecificRequestCodes.CUR,
+			value = (0, ClockSourceControlSelectors.CS_SAM_FREQ_CONTROL),
+			index = (0, 9), length = 4)
+
+	def sendSetupSampleRateRange(self):
+		# setup packet for interface 0 to the clock source
+		yield from self.sendSetup(type = USBRequestType.CLASS, retrieve = True,
+			request = AudioClassSpecificRequestCodes.RANGE,
+			value = (0, ClockSourceControlSelectors.CS_SAM_FREQ_CONTROL),
+			index = (0, 9), length = 14)
+
 	def receiveData(self, *, data : Tuple):
 		yield self.tx.ready.eq(1)
 		yield self.interface.data_requested.eq(1)
 		yield Settle()
 		yield
 		assert (yield self.tx.valid) == 0
-		assert (yield self.tx.payload) == 0
+		assert (yield self.tx.data) == 0
 		yield self.interface.data_requested.eq(0)
 		yield Settle()
 		yield
@@ -86,7 +108,7 @@ class AudioRequestHandlerTestCase(ToriiTestCase):
 			assert (yield self.tx.first) == (1 if idx == 0 else 0)
 			assert (yield self.tx.last) == (1 if idx == len(data) - 1 else 0)
 			assert (yield self.tx.valid) == 1
-			assert (yield self.tx.payload) == value
+			assert (yield self.tx.data) == value
 			assert (yield self.interface.handshakes_out.ack) == 0
 			if idx == len(data) - 1:
 				yield self.tx.ready.eq(0)
@@ -94,7 +116,7 @@ class AudioRequestHandlerTestCase(ToriiTestCase):
 			yield Settle()
 			yield
 		assert (yield self.tx.valid) == 0
-		assert (yield self.tx.payload) == 0
+		assert (yield self.tx.data) == 0
 		assert (yield self.interface.handshakes_out.ack) == 1
 		yield self.interface.status_requested.eq(0)
 		yield Settle()
@@ -124,7 +146,7 @@ class AudioRequestHandlerTestCase(ToriiTestCase):
 		for value in data:
 			yield Settle()
 			yield
-			yield self.rx.payload.eq(value)
+			yield self.rx.data.eq(value)
 			yield self.rx.next.eq(1)
 			yield Settle()
 			yield
@@ -174,4 +196,22 @@ class AudioRequestHandlerTestCase(ToriiTestCase):
 		yield from self.receiveData(data = (1, ))
 		yield from self.sendSetupVolumeState(retrieve = True)
 		yield from self.receiveData(data = (0, 0))
+		yield self.dut.latency.eq(6041666)
+		yield from self.sendSetupLatency(retrieve = True)
+		yield from self.receiveData(data = (0x42, 0x30, 0x5c, 0x00))
+		# The sample rate reported is whichever is being played
+		yield self.dut.sampleRate.eq(44100)
+		yield from self.sendSetupSampleRate(retrieve = True)
+		yield from self.receiveData(data = (0x44, 0xac, 0x00, 0x00))
+		# But only 48kHz is supported over USB
+		yield from self.sendSetupSampleRateRange()
+		yield from self.receiveData(data = (1, 0, 0x80, 0xbb, 0, 0, 0x80, 0xbb, 0, 0, 0, 0, 0, 0))
+		# The latency is read-only, so trying to set it should stall
+		yield from self.sendSetupLatency(retrieve = False)
+		yield self.interface.data_requested.eq(1)
+		yield Settle()
+		assert (yield self.interface.handshakes_out.stall) == 1
+		yield
+		yield self.interface.data_requested.eq(0)
+		yield Settle()
 		yield
@@ -0,0 +1,146 @@
+from torii import Elaboratable, Module
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+from usb_construct.types import USBRequestType, USBRequestRecipient, USBStandardRequests
+from usb_construct.types.descriptors.standard import StandardDescriptorNumbers
+
+from ....usb import buildDescriptors
+from ....usb.rom import DescriptorROM
+from ....usb.control.standard import StandardRequestHandler
+from ....usb.control.windows import WindowsRequestHandler
+from ....usb.control.highCapability import HighCapabilityRequestHandler
+
+descriptors, platformDescriptors, highCapabilityDescriptors = buildDescriptors(serialNumber = 'AB-1234')
+
+class DescriptorHandlers(Elaboratable):
+	def __init__(self):
+		self.rom = DescriptorROM(descriptors, platformDescriptors, highCapabilityDescriptors, ports = 3)
+		self.standard = StandardRequestHandler(self.rom, self.rom.ports[0])
+		self.windows = WindowsRequestHandler(self.rom, self.rom.ports[1])
+		self.highCapability = HighCapabilityRequestHandler(self.rom, self.rom.ports[2],
+			configuration = 1, interface = 0)
+
+	def elaborate(self, platform):
+		m = Module()
+		m.submodules.rom = self.rom
+		m.submodules.standard = self.standard
+		m.submodules.windows = self.windows
+		m.submodules.highCapability = self.highCapability
+		return m
+
+class DescriptorHandlerTestCase(ToriiTestCase):
+	dut : DescriptorHandlers = DescriptorHandlers
+	domains = (('usb', 60e6),)
+
+	def attach(self, handler):
+		self.interface = handler.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+
+	def sendSetup(self, *, type : USBRequestType, request : int, value : int, index : int, length : int,
+		recipient : USBRequestRecipient = USBRequestRecipient.DEVICE
+	):
+		yield self.setup.recipient.eq(recipient)
+		yield self.setup.type.eq(type)
+		yield self.setup.is_in_request.eq(1)
+		yield self.setup.request.eq(request)
+		yield self.setup.value.eq(value)
+		yield self.setup.index.eq(index)
+		yield self.setup.length.eq(length)
+		yield self.setup.received.eq(1)
+		yield Settle()
+		yield
+		yield self.setup.received.eq(0)
+		yield Settle()
+		# Acknowledging the setup packet and the host's IN token take longer than this
+		for _ in range(4):
+			yield
+
+	def requestData(self):
+		yield self.tx.ready.eq(1)
+		yield self.interface.data_requested.eq(1)
+		yield Settle()
+		stall = yield self.interface.handshakes_out.stall
+		yield
+		yield self.interface.data_requested.eq(0)
+		yield Settle()
+		return stall
+
+	def receivePacket(self, *, data : bytes, ack = True):
+		assert (yield from self.requestData()) == 0
+		# The packet starts straight away, and goes out without gaps
+		for idx, value in enumerate(data):
+			assert (yield self.tx.valid) == 1
+			assert (yield self.tx.first) == (1 if idx == 0 else 0)
+			assert (yield self.tx.last) == (1 if idx == len(data) - 1 else 0)
+			assert (yield self.tx.data) == value
+			yield
+			yield Settle()
+		assert (yield self.tx.valid) == 0
+		if ack:
+			yield from self.acknowledge()
+
+	def acknowledge(self):
+		yield self.interface.handshakes_in.ack.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.handshakes_in.ack.eq(0)
+		yield Settle()
+		yield
+
+	def finishRequest(self):
+		yield self.interface.status_requested.eq(1)
+		yield Settle()
+		assert (yield self.interface.handshakes_out.ack) == 1
+		yield
+		yield self.interface.status_requested.eq(0)
+		yield Settle()
+		yield
+
+	def receiveResponse(self, *, length : int, data : bytes):
+		data = data[:length]
+		for offset in range(0, len(data), 64):
+			yield from self.receivePacket(data = data[offset:offset + 64])
+		yield from self.finishRequest()
+
+class StandardRequestHandlerTestCase(DescriptorHandlerTestCase):
+	def sendGetDescriptor(self, *, number : int, index : int = 0, length : int):
+		yield from self.sendSetup(type = USBRequestType.STANDARD, request = USBStandardRequests.GET_DESCRIPTOR,
+			value = (number << 8) | index, index = 0, length = length)
+
+	def receiveDescriptor(self, *, number : int, index : int = 0, length : int, data : bytes):
+		yield from self.sendGetDescriptor(number = number, index = index, length = length)
+		yield from self.receiveResponse(length = length, data = data)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testGetDescriptor(self):
+		self.attach(self.dut.standard)
+
+		device = descriptors.get_descriptor_bytes(StandardDescriptorNumbers.DEVICE)
+		configuration = descriptors.get_descriptor_bytes(StandardDescriptorNumbers.CONFIGURATION)
+		assert len(configuration) > 128
+		yield from self.receiveDescriptor(number = StandardDescriptorNumbers.DEVICE, length = 64, data = device)
+		# Asking for just the start of a descriptor gets just that
+		yield from self.receiveDescriptor(number = StandardDescriptorNumbers.CONFIGURATION, length = 9,
+			data = configuration)
+		# Whereas the whole thing takes several packets
+		yield from self.receiveDescriptor(number = StandardDescriptorNumbers.CONFIGURATION, length = 0xffff,
+			data = configuration)
+		# If a packet goes missing, the host asking for it again gets it again
+		yield from self.sendGetDescriptor(number = StandardDescriptorNumbers.CONFIGURATION, length = 0xffff)
+		yield from self.receivePacket(data = configuration[0:64])
+		yield from self.receivePacket(data = configuration[64:128], ack = False)
+		yield from self.receivePacket(data = configuration[64:128])
+		yield from self.receiveResponse(length = 0xffff, data = configuration[128:])
+		# The serial number is in there too
+		serialIndex = device[16]
+		assert serialIndex != 0
+		yield from self.receiveDescriptor(number = StandardDescriptorNumbers.STRING, index = serialIndex,
+			length = 255, data = b'\x10\x03' + 'AB-1234'.encode('utf-16-le'))
+
+		# Descriptors we don't have are stalled
+		yield from self.sendGetDescriptor(number = StandardDescriptorNumbers.DEVICE_QUALIFIER, length = 10)
+		assert (yield from self.requestData()) == 1
+		yield
+		assert (yield self.tx.valid) == 0
@@ -0,0 +1,209 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+from usb_construct.types import USBRequestType, USBRequestRecipient
+from typing import Tuple
+
+from ....usb.control.vendor import VendorRequestHandler, VendorRequests
+
+class VendorRequestHandlerTestCase(ToriiTestCase):
+	dut : VendorRequestHandler = VendorRequestHandler
+	dut_args = {
+		'configuration': 1,
+		'interface': 0
+	}
+	domains = (('usb', 60e6),)
+
+	def setupReceived(self):
+		yield self.setup.received.eq(1)
+		yield Settle()
+		yield
+		yield self.setup.received.eq(0)
+		yield Settle()
+		yield
+		yield
+
+	def sendSetup(self, *, retrieve : bool, request, index : int, length : int, value : int = 0):
+		yield self.setup.recipient.eq(USBRequestRecipient.INTERFACE)
+		yield self.setup.type.eq(USBRequestType.VENDOR)
+		yield self.setup.is_in_request.eq(1 if retrieve else 0)
+		yield self.setup.request.eq(request)
+		yield self.setup.value.eq(value)
+		yield self.setup.index.eq(index)
+		yield self.setup.length.eq(length)
+		yield from self.setupReceived()
+
+	def sendSetupDitherConfig(self, *, retrieve : bool, index : int = 0):
+		yield from self.sendSetup(retrieve = retrieve, request = VendorRequests.DITHER_CONFIG, index = index, length = 1)
+
+	def sendSetupEQCoefficients(self, *, band : int, length : int = 15):
+		yield from self.sendSetup(retrieve = False, request = VendorRequests.EQ_COEFFICIENTS, value = band,
+			index = 0, length = length)
+
+	def sendSetupEQCommit(self, *, retrieve : bool, enable : bool = False, swap : bool = False):
+		yield from self.sendSetup(retrieve = retrieve, request = VendorRequests.EQ_COMMIT,
+			value = int(enable) | (int(swap) << 1), index = 0, length = 1 if retrieve else 0)
+
+	def sendSetupSourceConfig(self, *, retrieve : bool):
+		yield from self.sendSetup(retrieve = retrieve, request = VendorRequests.SOURCE_CONFIG, index = 0, length = 1)
+
+	def receiveZLP(self):
+		yield self.interface.status_requested.eq(1)
+		yield Settle()
+		yield
+		assert (yield self.tx.valid) == 1
+		assert (yield self.tx.last) == 1
+		yield self.interface.status_requested.eq(0)
+		yield self.interface.handshakes_in.ack.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.handshakes_in.ack.eq(0)
+		yield Settle()
+		yield
+
+	def receiveData(self, *, data : Tuple):
+		yield self.tx.ready.eq(1)
+		yield self.interface.data_requested.eq(1)
+		yield Settle()
+		yield
+		assert (yield self.tx.valid) == 0
+		yield self.interface.data_requested.eq(0)
+		yield Settle()
+		yield
+		for idx, value in enumerate(data):
+			assert (yield self.tx.first) == (1 if idx == 0 else 0)
+			assert (yield self.tx.last) == (1 if idx == len(data) - 1 else 0)
+			assert (yield self.tx.valid) == 1
+			assert (yield self.tx.data) == value
+			if idx == len(data) - 1:
+				yield self.tx.ready.eq(0)
+				yield self.interface.status_requested.eq(1)
+			yield Settle()
+			yield
+		assert (yield self.tx.valid) == 0
+		assert (yield self.interface.handshakes_out.ack) == 1
+		yield self.interface.status_requested.eq(0)
+		yield Settle()
+		yield
+
+	def sendData(self, *, data : Tuple):
+		yield self.rx.valid.eq(1)
+		for value in data:
+			yield Settle()
+			yield
+			yield self.rx.data.eq(value)
+			yield self.rx.next.eq(1)
+			yield Settle()
+			yield
+			yield self.rx.next.eq(0)
+		yield self.rx.valid.eq(0)
+		yield self.interface.rx_ready_for_response.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.rx_ready_for_response.eq(0)
+		yield self.interface.status_requested.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.status_requested.eq(0)
+		yield self.interface.handshakes_in.ack.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.handshakes_in.ack.eq(0)
+		yield Settle()
+		yield
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testVendorRequestHandler(self):
+		self.interface = self.dut.interface
+		self.setup = self.interface.setup
+		self.tx = self.interface.tx
+		self.rx = self.interface.rx
+
+		yield self.interface.active_config.eq(1)
+		yield Settle()
+		yield
+		# Dither defaults on, with no noise shaping
+		yield from self.sendSetupDitherConfig(retrieve = True)
+		yield from self.receiveData(data = (0b001, ))
+		# Switch to second order shaping with no dither
+		yield from self.sendSetupDitherConfig(retrieve = False)
+		yield from self.sendData(data = (0b100, ))
+		assert (yield self.dut.dither) == 0
+		assert (yield self.dut.noiseShaping) == 2
+		yield from self.sendSetupDitherConfig(retrieve = True)
+		yield from self.receiveData(data = (0b100, ))
+		# A shaping order we don't support should be ignored
+		yield from self.sendSetupDitherConfig(retrieve = False)
+		yield from self.sendData(data = (0b111, ))
+		assert (yield self.dut.dither) == 1
+		assert (yield self.dut.noiseShaping) == 2
+
+		# Load a set of coefficients for band 1, which should get written out to the equaliser in order
+		coefficients = (0x10000, -0x8000, 0x1234, -0x1ffff, 0x1ffff)
+		data = b''.join((coefficient & 0xffffff).to_bytes(3, 'little') for coefficient in coefficients)
+		yield from self.sendSetupEQCoefficients(band = 1)
+		writes = []
+		yield self.rx.valid.eq(1)
+		for value in data:
+			yield Settle()
+			yield
+			yield self.rx.data.eq(value)
+			yield self.rx.next.eq(1)
+			yield Settle()
+			yield
+			yield self.rx.next.eq(0)
+		yield self.rx.valid.eq(0)
+		for _ in range(8):
+			yield Settle()
+			if (yield self.dut.eqWrite):
+				writes.append(((yield self.dut.eqWriteBand), (yield self.dut.eqWriteIndex), (yield self.dut.eqWriteData)))
+			yield
+		assert writes == [(1, index, coefficient & 0x3ffff) for index, coefficient in enumerate(coefficients)]
+		yield self.interface.rx_ready_for_response.eq(1)
+		yield Settle()
+		yield
+		yield self.interface.rx_ready_for_response.eq(0)
+		yield from self.receiveZLP()
+
+		# Enabling the equaliser by itself must leave the banks alone
+		assert (yield self.dut.eqBank) == 0
+		yield from self.sendSetupEQCommit(retrieve = False, enable = True)
+		yield from self.receiveZLP()
+		assert (yield self.dut.eqBank) == 0
+		assert (yield self.dut.eqEnable) == 1
+		yield from self.sendSetupEQCommit(retrieve = True)
+		yield from self.receiveData(data = (0x51, ))
+		# Commit them, swapping the banks over, and check that's reported back along with the band count
+		yield from self.sendSetupEQCommit(retrieve = False, enable = True, swap = True)
+		yield from self.receiveZLP()
+		assert (yield self.dut.eqBank) == 1
+		assert (yield self.dut.eqEnable) == 1
+		yield from self.sendSetupEQCommit(retrieve = True)
+		yield from self.receiveData(data = (0x53, ))
+		# Disabling it again keeps the bank it swapped to
+		yield from self.sendSetupEQCommit(retrieve = False)
+		yield from self.receiveZLP()
+		assert (yield self.dut.eqBank) == 1
+		assert (yield self.dut.eqEnable) == 0
+
+		# The source is picked by priority to begin with, and the picked source is reported back
+		yield self.dut.source.eq(1)
+		yield self.dut.sourceActive.eq(1)
+		yield from self.sendSetupSourceConfig(retrieve = True)
+		yield from self.receiveData(data = (0x30, ))
+		# Have the host pick S/PDIF
+		yield from self.sendSetupSourceConfig(retrieve = False)
+		yield from self.sendData(data = (0b110, ))
+		assert (yield self.dut.sourcePolicy) == 2
+		assert (yield self.dut.hostSource) == 1
+		# A policy we don't have should be ignored
+		yield from self.sendSetupSourceConfig(retrieve = False)
+		yield from self.sendData(data = (0b011, ))
+		assert (yield self.dut.sourcePolicy) == 2
+		assert (yield self.dut.hostSource) == 0
+
+		# And requests for other interfaces are not ours to handle
+		yield from self.sendSetupDitherConfig(retrieve = False, index = 1)
+		yield from self.sendData(data = (0b000, ))
+		assert (yield self.dut.dither) == 1
+		yield
@@ -0,0 +1,42 @@
+from torii.test import ToriiTestCase
+from usb_construct.types import USBRequestType, USBStandardRequests
+from usb_construct.types.descriptors.microsoft import MicrosoftRequests
+from usb_construct.types.descriptors.standard import StandardDescriptorNumbers
+
+from .standard import DescriptorHandlerTestCase, descriptors, platformDescriptors
+
+class WindowsRequestHandlerTestCase(DescriptorHandlerTestCase):
+	def sendGetDescriptorSet(self, *, vendorCode : int, length : int):
+		yield from self.sendSetup(type = USBRequestType.VENDOR, request = vendorCode, value = 0,
+			index = MicrosoftRequests.GET_DESCRIPTOR_SET, length = length)
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testGetDescriptorSet(self):
+		descriptorSet = platformDescriptors.descriptors[1]
+		assert len(descriptorSet) > 10
+
+		self.attach(self.dut.windows)
+		yield from self.sendGetDescriptorSet(vendorCode = 1, length = 0xffff)
+		yield from self.receiveResponse(length = 0xffff, data = descriptorSet)
+		# Each request starts over from the beginning of the set
+		yield from self.sendGetDescriptorSet(vendorCode = 1, length = 10)
+		yield from self.receiveResponse(length = 10, data = descriptorSet)
+
+		# The standard descriptors come out of the same ROM
+		self.attach(self.dut.standard)
+		yield from self.sendSetup(type = USBRequestType.STANDARD, request = USBStandardRequests.GET_DESCRIPTOR,
+			value = StandardDescriptorNumbers.BOS << 8, index = 0, length = 0xffff)
+		bos = descriptors.get_descriptor_bytes(StandardDescriptorNumbers.BOS)
+		yield from self.receiveResponse(length = 0xffff, data = bos)
+
+		# Vendor codes without a descriptor set are stalled
+		self.attach(self.dut.windows)
+		yield from self.sendGetDescriptorSet(vendorCode = 2, length = 0xffff)
+		assert (yield from self.requestData()) == 1
+		yield
+		assert (yield self.tx.valid) == 0
+		# A stalled request leaves nothing behind to catch an ACK meant for someone else on the next one
+		yield from self.sendGetDescriptorSet(vendorCode = 1, length = 0xffff)
+		yield from self.acknowledge()
+		yield from self.receiveResponse(length = 0xffff, data = descriptorSet)
@@ -0,0 +1,40 @@
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from ...usb import buildDescriptors
+from ...usb.descriptorCache import cachedDescriptors, descriptorCacheKey
+from ...usb.rom import DescriptorROMImage
+from ...usb.notifier import NotificationEndpoint
+from ...usb.control.dfu import DFURequestHandler
+
+class DescriptorCacheTestCase(TestCase):
+	def testCache(self):
+		with TemporaryDirectory() as cacheDir:
+			cacheDir = Path(cacheDir)
+			emitted = cachedDescriptors(cacheDir = cacheDir)
+			cacheFiles = list(cacheDir.iterdir())
+			assert [cacheFile.name for cacheFile in cacheFiles] == [f'descriptors-{descriptorCacheKey()}.json']
+			# What comes back out of the cache is what went into it
+			assert cachedDescriptors(cacheDir = cacheDir) == emitted
+			# And makes the same ROM as the descriptors built afresh
+			assert DescriptorROMImage(*emitted).words == DescriptorROMImage(*buildDescriptors()).words
+
+			# Different arguments are cached separately
+			assert descriptorCacheKey(serialNumber = 'AB-1234') != descriptorCacheKey()
+			unit = cachedDescriptors(cacheDir = cacheDir, serialNumber = 'AB-1234')
+			assert unit != emitted
+			assert len(list(cacheDir.iterdir())) == 2
+
+			# As do descriptors built around different values from the rest of the gateware
+			assert descriptorCacheKey(transferSize = DFURequestHandler.transferSize) == descriptorCacheKey()
+			assert descriptorCacheKey(transferSize = DFURequestHandler.transferSize * 2) != descriptorCacheKey()
+			longerMessages = NotificationEndpoint.messageLength + 1
+			assert descriptorCacheKey(notificationLength = longerMessages) != descriptorCacheKey()
+			smallerDFU = cachedDescriptors(cacheDir = cacheDir, transferSize = DFURequestHandler.transferSize // 2)
+			assert smallerDFU != emitted
+			assert len(list(cacheDir.iterdir())) == 3
+
+			# A cache entry that can't be read is emitted again in its place
+			cacheFiles[0].write_text('{')
+			assert cachedDescriptors(cacheDir = cacheDir) == emitted
@@ -0,0 +1,104 @@
+from torii.sim import Settle
+from torii.test import ToriiTestCase
+from usb_construct.types.descriptors.uac3 import (
+	AudioClassSpecificRequestCodes, AudioControlInterfaceControlSelectors, ClockSourceControlSelectors
+)
+
+from ...usb.notifier import NotificationEndpoint
+
+class NotificationEndpointTestCase(ToriiTestCase):
+	dut : NotificationEndpoint = NotificationEndpoint
+	dut_args = {
+		'endpointNumber': 2,
+		'holdoffCycles': 16,
+	}
+	domains = (('usb', 60e6),)
+
+	def poll(self):
+		yield self.tokenizer.endpoint.eq(2)
+		yield self.tokenizer.is_in.eq(1)
+		yield self.tokenizer.new_token.eq(1)
+		yield self.tokenizer.ready_for_response.eq(1)
+		yield Settle()
+		nak = yield self.interface.handshakes_out.nak
+		yield
+		yield self.tokenizer.new_token.eq(0)
+		yield self.tokenizer.ready_for_response.eq(0)
+		yield Settle()
+		yield
+		return nak
+
+	def receiveMessage(self, *, data, ack = True):
+		assert (yield from self.poll()) == 0
+		yield self.tx.ready.eq(1)
+		for idx, value in enumerate(data):
+			yield Settle()
+			assert (yield self.tx.valid) == 1
+			assert (yield self.tx.first) == (1 if idx == 0 else 0)
+			assert (yield self.tx.last) == (1 if idx == len(data) - 1 else 0)
+			assert (yield self.tx.data) == value
+			yield
+		yield self.tx.ready.eq(0)
+		yield Settle()
+		assert (yield self.tx.valid) == 0
+		if ack:
+			yield self.interface.handshakes_in.ack.eq(1)
+			yield Settle()
+			yield
+			yield self.interface.handshakes_in.ack.eq(0)
+			yield Settle()
+			yield
+
+	@ToriiTestCase.simulation
+	@ToriiTestCase.sync_domain(domain = 'usb')
+	def testNotificationEndpoint(self):
+		self.interface = self.dut.interface
+		self.tokenizer = self.interface.tokenizer
+		self.tx = self.interface.tx
+
+		sampleRateMessage = (
+			0, AudioClassSpecificRequestCodes.CUR, 0, ClockSourceControlSelectors.CS_SAM_FREQ_CONTROL, 0, 9
+		)
+		powerStateMessage = (
+			0, AudioClassSpecificRequestCodes.CUR, 0, AudioControlInterfaceControlSelectors.AC_POWER_DOMAIN_CONTROL, 0, 10
+		)
+
+		# Nothing gets noted while the device is unconfigured
+		yield self.dut.sampleRate.eq(48000)
+		yield Settle()
+		yield
+		yield
+		yield self.interface.active_config.eq(1)
+		yield Settle()
+		yield
+		assert (yield from self.poll()) == 1
+
+		# A change is sent on the next poll, once, however many times the signal changed
+		yield self.dut.sampleRate.eq(44100)
+		yield Settle()
+		yield
+		yield self.dut.sampleRate.eq(48000)
+		yield Settle()
+		yield
+		yield from self.receiveMessage(data = sampleRateMessage)
+		assert (yield self.interface.tx_pid_toggle[0]) == 1
+
+		# The next change has to wait out the hold-off
+		yield self.dut.powerState.eq(1)
+		assert (yield from self.poll()) == 1
+		for _ in range(16):
+			yield
+		# And a message the host doesn't ACK is sent again
+		yield from self.receiveMessage(data = powerStateMessage, ack = False)
+		assert (yield self.interface.tx_pid_toggle[0]) == 1
+		yield self.tokenizer.new_token.eq(1)
+		yield Settle()
+		yield
+		yield self.tokenizer.new_token.eq(0)
+		yield Settle()
+		yield
+		yield from self.receiveMessage(data = powerStateMessage)
+		assert (yield self.interface.tx_pid_toggle[0]) == 0
+		for _ in range(16):
+			yield
+		assert (yield from self.poll()) == 1
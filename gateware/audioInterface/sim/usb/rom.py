@@ -0,0 +1,51 @@
+from unittest import TestCase
+
+from ...usb import buildDescriptors
+from ...usb.rom import DescriptorROMImage
+
+class DescriptorROMTestCase(TestCase):
+	def testLayout(self):
+		descriptors, platformDescriptors, highCapabilityDescriptors = buildDescriptors()
+		rom = DescriptorROMImage(descriptors, platformDescriptors, highCapabilityDescriptors)
+		# The ROM fills a whole number of EBRs
+		assert rom.depth % DescriptorROMImage.ebrDepth == 0
+		assert len(rom.words) == rom.depth
+		image = b''.join(word.to_bytes(DescriptorROMImage.wordSize, 'big') for word in rom.words[:rom.used])
+
+		def descriptor(slot : int):
+			length = rom.words[slot * DescriptorROMImage.entrySize]
+			address = rom.words[slot * DescriptorROMImage.entrySize + 1]
+			return image[address:address + length]
+
+		# Each table entry points at its descriptor
+		for (number, index), slot in rom.standardSlots.items():
+			assert descriptor(slot) == descriptors.get_descriptor_bytes(number, index)
+		for vendorCode, slot in rom.platformSlots.items():
+			assert descriptor(slot) == platformDescriptors.descriptors[vendorCode]
+		for descriptorID, slot in rom.highCapabilitySlots.items():
+			assert descriptor(slot) == highCapabilityDescriptors[descriptorID]
+		# With everything packed back to back after the table
+		tableLength = rom.entries * DescriptorROMImage.entrySize * DescriptorROMImage.wordSize
+		totalLength = tableLength + sum(len(descriptor(slot)) for slot in range(rom.entries))
+		assert rom.used == -(-totalLength // DescriptorROMImage.wordSize)
+
+	def testPlaceholder(self):
+		# The placeholder image has to be the same on every build for icebram to find it
+		first = DescriptorROMImage(*buildDescriptors())
+		second = DescriptorROMImage(*buildDescriptors())
+		assert first.hexImage() == second.hexImage()
+		lines = first.hexImage().splitlines()
+		assert len(lines) == first.depth
+		assert all(len(line) == DescriptorROMImage.wordSize * 2 for line in lines)
+		# The filler must not look like an empty block RAM
+		assert first.words[first.used:].count(0) < 4
+
+	def testPersonalise(self):
+		placeholder = DescriptorROMImage(*buildDescriptors())
+		unit = DescriptorROMImage(*buildDescriptors(serialNumber = 'HPA-0042'), depth = placeholder.depth)
+		assert unit.layout == placeholder.layout
+		assert unit.depth == placeholder.depth
+		assert unit.words != placeholder.words
+		# A serial number that needs more ROM than there is can't be patched in
+		with self.assertRaises(ValueError):
+			DescriptorROMImage(*buildDescriptors(serialNumber = 'X' * 120), depth = placeholder.used)
@@ -0,0 +1,132 @@
+from torii.hdl import Elaboratable, Module, Signal, Array, Const, Cat, DomainRenamer
+from torii.build import Platform
+
+__all__ = (
+	'SPIController',
+	'SPIPort',
+)
+
+class SPIPort:
+	'''
+	One user's view of the SPI controller. Hold select high with chipSelect set to the device to talk
+	to, and wait for granted to go high - from then on the bus is this port's until select drops.
+	'''
+
+	def __init__(self, *, chipSelects : int, name : str):
+		self.chipSelect = Signal(range(chipSelects), name = f'{name}ChipSelect')
+		self.select = Signal(name = f'{name}Select')
+		self.start = Signal(name = f'{name}Start')
+		self.dataOut = Signal(8, name = f'{name}DataOut')
+
+		self.granted = Signal(name = f'{name}Granted')
+		self.dataIn = Signal(8, name = f'{name}DataIn')
+		self.busy = Signal(name = f'{name}Busy')
+		self.done = Signal(name = f'{name}Done')
+
+class SPIController(Elaboratable):
+	'''
+	This implements a mode 0 SPI controller for the configuration SPI bus, which is shared between
+	the FPGA's configuration flash and the DAC's control interface.
+
+	Each user of the bus gets a port. Transactions are driven a byte at a time: once the port has been
+	granted the bus, pulse start with dataOut set up to clock a byte out. done pulses when the byte has
+	been exchanged, at which point dataIn holds the byte read back. Dropping select ends the transaction
+	and gives the bus up, at which point the lowest numbered port waiting on it gets it next.
+
+	The SPI clock runs at the domain clock frequency divided by 2 * clkDivider. clkDivider can also be
+	a tuple giving each port its own divider, so that devices that can go faster don't have to run at
+	the pace of the slowest one on the bus.
+	'''
+
+	def __init__(self, *, resource = ('cfg_spi', 0), chipSelects = 2, clkDivider = 4, domain = 'usb', ports = 1):
+		self._resource = resource
+		if isinstance(clkDivider, int):
+			clkDivider = (clkDivider,) * ports
+		assert len(clkDivider) == ports, 'There must be one clock divider per port'
+		self._clkDividers = clkDivider
+		self._domain = domain
+
+		self.ports = tuple(SPIPort(chipSelects = chipSelects, name = f'port{idx}') for idx in range(ports))
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+		bus = platform.request(*self._resource)
+
+		clkCounter = Signal(range(max(self._clkDividers)))
+		clk = Signal()
+		bitsRemaining = Signal(range(9))
+		shiftOut = Signal(8)
+		shiftIn = Signal(8)
+		halfCycle = Signal()
+		busy = Signal()
+		done = Signal()
+
+		# Work out which port owns the bus. The owner keeps it until it drops select and its last byte is out
+		owner = Signal(range(len(self.ports)))
+		owned = Signal()
+		selects = Array(port.select for port in self.ports)
+		chipSelects = Array(port.chipSelect for port in self.ports)
+		starts = Array(port.start for port in self.ports)
+		dataOuts = Array(port.dataOut for port in self.ports)
+		clkDividers = Array(Const(divider - 1, clkCounter.shape()) for divider in self._clkDividers)
+		select = Signal()
+		start = Signal()
+
+		with m.If(owned):
+			with m.If(~selects[owner] & ~busy):
+				m.d.sync += owned.eq(0)
+		with m.Elif(Cat(selects).any()):
+			for idx in reversed(range(len(self.ports))):
+				with m.If(selects[idx]):
+					m.d.sync += owner.eq(idx)
+			m.d.sync += owned.eq(1)
+
+		m.d.comb += [
+			select.eq(owned & selects[owner]),
+			start.eq(owned & starts[owner]),
+		]
+		for idx, port in enumerate(self.ports):
+			m.d.comb += [
+				port.granted.eq(owned & (owner == idx)),
+				port.dataIn.eq(shiftIn),
+				port.busy.eq(port.granted & busy),
+				port.done.eq(port.granted & done),
+			]
+
+		m.d.comb += [
+			bus.cs.o.eq(select << chipSelects[owner]),
+			bus.clk.o.eq(clk),
+			bus.copi.o.eq(shiftOut[7]),
+			busy.eq(bitsRemaining != 0),
+			halfCycle.eq(clkCounter == clkDividers[owner]),
+		]
+		m.d.sync += done.eq(0)
+
+		with m.If(start & ~busy):
+			m.d.sync += [
+				shiftOut.eq(dataOuts[owner]),
+				bitsRemaining.eq(8),
+				clkCounter.eq(0),
+			]
+		with m.Elif(busy):
+			m.d.sync += clkCounter.eq(clkCounter + 1)
+			with m.If(halfCycle):
+				m.d.sync += [
+					clkCounter.eq(0),
+					clk.eq(~clk),
+				]
+				# On the rising edge, sample the incomming data
+				with m.If(~clk):
+					m.d.sync += shiftIn.eq(Cat(bus.cipo.i, shiftIn[:7]))
+				# On the falling edge, move on to the next bit
+				with m.Else():
+					m.d.sync += [
+						shiftOut.eq(shiftOut << 1),
+						bitsRemaining.eq(bitsRemaining - 1),
+					]
+					with m.If(bitsRemaining == 1):
+						m.d.sync += done.eq(1)
+
+		if self._domain != 'sync':
+			m = DomainRenamer(sync = self._domain)(m)
+		return m
@@ -1,6 +1,7 @@
 from torii.hdl import Elaboratable, Module
 from torii_usb.usb2 import USBDevice
 from usb_construct.types import USBTransferType, USBSynchronizationType, USBUsageType
+from usb_construct.emitters.descriptor import ConstructEmitter
 from usb_construct.emitters.descriptors.standard import (
 	DeviceDescriptorCollection, LanguageIDs, DeviceClassCodes, MiscellaneousSubclassCodes,
 	MultifunctionProtocolCodes, InterfaceClassCodes, ApplicationSubclassCodes, DFUProtocolCodes
@@ -12,16 +13,260 @@ from usb_construct.contextmgrs.descriptors.dfu import *
 from usb_construct.emitters.descriptors.microsoft import PlatformDescriptorCollection
 from usb_construct.contextmgrs.descriptors.microsoft import *
 
+from ..spi import SPIPort
 from .types import *
+from .descriptors import StereoClusterDescriptor
+from .rom import DescriptorROM
+from .descriptorCache import cachedDescriptors
 from .control import *
+from .notifier import NotificationEndpoint
 
 __all__ = (
 	'USBInterface',
+	'buildDescriptors',
+	'serialPlaceholder',
 )
 
+# What the serial number is until a unit is personalised
+serialPlaceholder = '0' * 16
+
+def buildDescriptors(*, serialNumber = serialPlaceholder, product = 'Headphone Amp+DAC Audio Interface',
+	notificationLength = NotificationEndpoint.messageLength, transferSize = DFURequestHandler.transferSize
+):
+	'''
+	This builds the device's descriptors: the standard ones, the Microsoft OS 2.0 descriptor sets, and the
+	UAC3 high capability descriptors by ID. The serial number defaults to a placeholder, which is what goes
+	into the gateware's descriptor ROM, for the personalise action to swap each unit's own serial number in for.
+
+	Everything the descriptors take from the rest of the gateware comes in as an argument, defaulting to
+	what the gateware uses, so the descriptor cache sees it: the notification endpoint's message length,
+	and the DFU transfer size.
+	'''
+	descriptors = DeviceDescriptorCollection()
+	with descriptors.DeviceDescriptor() as deviceDesc:
+		deviceDesc.bcdUSB = 2.01
+		deviceDesc.bDeviceClass = DeviceClassCodes.MISCELLANEOUS
+		deviceDesc.bDeviceSubclass = MiscellaneousSubclassCodes.MULTIFUNCTION
+		deviceDesc.bDeviceProtocol = MultifunctionProtocolCodes.INTERFACE_ASSOCIATION
+		deviceDesc.idVendor = 0x1209
+		deviceDesc.idProduct = 0xBADC
+		deviceDesc.bcdDevice = 1.01
+		deviceDesc.iManufacturer = 'bad_alloc Heavy Industries'
+		deviceDesc.iProduct = product
+		deviceDesc.iSerialNumber = serialNumber
+		deviceDesc.bNumConfigurations = 1
+
+	with descriptors.ConfigurationDescriptor() as configDesc:
+		configDesc.bConfigurationValue = 1
+		configDesc.iConfiguration = 'PCM audio interface'
+		# Bus powered with no remote wakeup support
+		configDesc.bmAttributes = 0x80
+		# 50mA max.
+		configDesc.bMaxPower = 25
+
+		with configDesc.InterfaceAssociationDescriptor() as ifaceAssocDesc:
+			ifaceAssocDesc.bFirstInterface = 0
+			ifaceAssocDesc.bInterfaceCount = 2
+			ifaceAssocDesc.bFunctionClass = AudioFunctionClassCode.AUDIO_FUNCTION
+			ifaceAssocDesc.bFunctionSubclass = AudioFunctionSubclassCodes.HEADPHONE
+			ifaceAssocDesc.bFunctionProtocol = AudioFunctionProtocolCodes.AF_VERSION_03_00
+			ifaceAssocDesc.iFunction = 'PCM audio interface'
+
+		with configDesc.InterfaceDescriptor() as interfaceDesc:
+			interfaceDesc.bInterfaceNumber = 0
+			interfaceDesc.bAlternateSetting = 0
+			interfaceDesc.bInterfaceClass = AudioInterfaceClassCode.AUDIO
+			interfaceDesc.bInterfaceSubclass = AudioInterfaceSubclassCodes.AUDIO_CONTROL
+			interfaceDesc.bInterfaceProtocol = AudioInterfaceProtocolCodes.IP_VERSION_03_00
+			interfaceDesc.iInterface = 'Control interface'
+
+			with HeaderDescriptor(interfaceDesc) as headerDesc:
+				headerDesc.bCategory = AudioFunctionCategoryCodes.HEADPHONE
+				# Read-only latency control, which is reported through the output terminal
+				headerDesc.bmControls = 0x00000001
+
+				with InputTerminalDescriptor(headerDesc) as terminalDesc:
+					terminalDesc.bTerminalID = 1
+					terminalDesc.wTerminalType = USBTerminalTypes.USB_STREAMING
+					terminalDesc.bAssocTerminal = 0
+					terminalDesc.bCSourceID = 9
+					# No controls
+					terminalDesc.bmControls = 0x00000000
+					terminalDesc.wClusterDescrID = 2
+					terminalDesc.wExTerminalDescrID = 0
+					terminalDesc.wConnectorsDescrID = 0
+					terminalDesc.wTerminalDescrStr = 0
+
+				with OutputTerminalDescriptor(headerDesc) as terminalDesc:
+					terminalDesc.bTerminalID = 3
+					terminalDesc.wTerminalType = OutputTerminalTypes.HEADPHONES
+					terminalDesc.bAssocTerminal = 0
+					terminalDesc.bSourceID = 2
+					# No controls
+					terminalDesc.bmControls = 0x00000000
+					terminalDesc.bCSourceID = 9
+					terminalDesc.wExTerminalDescrID = 0
+					# The headphone jack, described by a high capability descriptor
+					terminalDesc.wConnectorsDescrID = 4
+					terminalDesc.wTerminalDescrStr = 0
+
+				with FeatureUnitDescriptor(headerDesc, AudioChannels.STEREO) as unitDesc:
+					unitDesc.bUnitID = 2
+					unitDesc.bSourceID = 1
+
+				with ClockSourceDescriptor(headerDesc) as clockDesc:
+					clockDesc.bClockID = 9
+					# Async internal clock
+					clockDesc.bmAttributes = 0x01
+					# With only a read-only frequency control, reporting the rate being played
+					clockDesc.bmControls = 0x00000001
+					# Which is not derived in any manner
+					clockDesc.bReferenceTerminal = 0
+					clockDesc.wCSourceDescrStr = 0
+
+				with PowerDomainDescriptor(headerDesc) as pdDesc:
+					pdDesc.bPowerDomainID = 10
+					# 30ms and 300ms expressed in 50µs increments
+					pdDesc.waRecoveryTime = [600, 6000]
+					pdDesc.bNrEntities = 2
+					pdDesc.baEntityID = [1, 3]
+					pdDesc.wPDomainDescrStr = 0
+
+			with interfaceDesc.EndpointDescriptor() as ep2In:
+				ep2In.bEndpointAddress = 0x82
+				ep2In.bmAttributes = USBTransferType.INTERRUPT
+				ep2In.wMaxPacketSize = notificationLength
+				ep2In.bInterval = 4 # Polled every 1ms, matching the rate notifications are limited to
+
+		with configDesc.InterfaceDescriptor() as interfaceDesc:
+			interfaceDesc.bInterfaceNumber = 1
+			interfaceDesc.bAlternateSetting = 0
+			interfaceDesc.bInterfaceClass = AudioInterfaceClassCode.AUDIO
+			interfaceDesc.bInterfaceSubclass = AudioInterfaceSubclassCodes.AUDIO_STREAMING
+			interfaceDesc.bInterfaceProtocol = AudioInterfaceProtocolCodes.IP_VERSION_03_00
+
+		with configDesc.InterfaceDescriptor() as interfaceDesc:
+			interfaceDesc.bInterfaceNumber = 1
+			interfaceDesc.bAlternateSetting = 1
+			interfaceDesc.bInterfaceClass = AudioInterfaceClassCode.AUDIO
+			interfaceDesc.bInterfaceSubclass = AudioInterfaceSubclassCodes.AUDIO_STREAMING
+			interfaceDesc.bInterfaceProtocol = AudioInterfaceProtocolCodes.IP_VERSION_03_00
+			interfaceDesc.iInterface = 'Output stream interface'
+
+			with ClassSpecificAudioStreamingInterfaceDescriptor(interfaceDesc) as streamDesc:
+				streamDesc.bTerminalLink = 1
+				# No controls
+				streamDesc.bmControls = 0x00000000
+				streamDesc.wClusterDescrID = 2
+				streamDesc.bmFormats = AudioDataFormats.PCM
+				# 16-bit PCM audio here please
+				streamDesc.bSubslotSize = 2
+				streamDesc.bBitResolution = 16
+				streamDesc.bmAuxProtocols = 0x0000
+				streamDesc.bControlSize = 0
+
+			with interfaceDesc.EndpointDescriptor() as ep1Out:
+				ep1Out.bEndpointAddress = 0x01
+				ep1Out.bmAttributes = USBTransferType.ISOCHRONOUS | USBSynchronizationType.ASYNC | USBUsageType.DATA
+				ep1Out.wMaxPacketSize = 196
+				ep1Out.bInterval = 4 # Spec requires we support a 1ms interval here.
+
+		with configDesc.InterfaceDescriptor() as interfaceDesc:
+			interfaceDesc.bInterfaceNumber = 1
+			interfaceDesc.bAlternateSetting = 2
+			interfaceDesc.bInterfaceClass = AudioInterfaceClassCode.AUDIO
+			interfaceDesc.bInterfaceSubclass = AudioInterfaceSubclassCodes.AUDIO_STREAMING
+			interfaceDesc.bInterfaceProtocol = AudioInterfaceProtocolCodes.IP_VERSION_03_00
+			interfaceDesc.iInterface = 'Low latency output stream interface'
+
+			with ClassSpecificAudioStreamingInterfaceDescriptor(interfaceDesc) as streamDesc:
+				streamDesc.bTerminalLink = 1
+				# No controls
+				streamDesc.bmControls = 0x00000000
+				streamDesc.wClusterDescrID = 2
+				streamDesc.bmFormats = AudioDataFormats.PCM
+				# 16-bit PCM audio here please
+				streamDesc.bSubslotSize = 2
+				streamDesc.bBitResolution = 16
+				streamDesc.bmAuxProtocols = 0x0000
+				streamDesc.bControlSize = 0
+
+			with interfaceDesc.EndpointDescriptor() as ep1Out:
+				ep1Out.bEndpointAddress = 0x01
+				ep1Out.bmAttributes = USBTransferType.ISOCHRONOUS | USBSynchronizationType.ASYNC | USBUsageType.DATA
+				# 6 samples a microframe, with room for one more as our clock drifts against the host's
+				ep1Out.wMaxPacketSize = 28
+				ep1Out.bInterval = 1 # Every microframe, for monitoring with as little latency as possible
+
+		with configDesc.InterfaceAssociationDescriptor() as ifaceAssocDesc:
+			ifaceAssocDesc.bFirstInterface = 2
+			ifaceAssocDesc.bInterfaceCount = 1
+			ifaceAssocDesc.bFunctionClass = InterfaceClassCodes.APPLICATION
+			ifaceAssocDesc.bFunctionSubclass = ApplicationSubclassCodes.DFU
+			ifaceAssocDesc.bFunctionProtocol = DFUProtocolCodes.APPLICATION
+			ifaceAssocDesc.iFunction = 'Gateware DFU interface'
+
+		with configDesc.InterfaceDescriptor() as interfaceDesc:
+			interfaceDesc.bInterfaceNumber = 2
+			interfaceDesc.bAlternateSetting = 0
+			interfaceDesc.bInterfaceClass = InterfaceClassCodes.APPLICATION
+			interfaceDesc.bInterfaceSubclass = ApplicationSubclassCodes.DFU
+			interfaceDesc.bInterfaceProtocol = DFUProtocolCodes.APPLICATION
+			interfaceDesc.iInterface = 'Audio interface device gateware upgrade interface'
+
+			with FunctionalDescriptor(interfaceDesc) as functionalDesc:
+				functionalDesc.bmAttributes = (
+					DFUWillDetach.YES | DFUManifestationTolerant.NO | DFUCanUpload.YES | DFUCanDownload.YES
+				)
+				functionalDesc.wDetachTimeOut = 1000
+				# Downloads go a flash page at a time
+				functionalDesc.wTransferSize = transferSize
+
+	platformDescriptors = PlatformDescriptorCollection()
+	with descriptors.BOSDescriptor() as bos:
+		with PlatformDescriptor(bos, platform_collection = platformDescriptors) as platformDesc:
+			with platformDesc.DescriptorSetInformation() as descSetInfo:
+				descSetInfo.bMS_VendorCode = 1
+
+				with descSetInfo.SetHeaderDescriptor() as setHeader:
+					with setHeader.SubsetHeaderConfiguration() as subsetConfig:
+						subsetConfig.bConfigurationValue = 1
+
+						with subsetConfig.SubsetHeaderFunction() as subsetFunc:
+							subsetFunc.bFirstInterface = 2
+
+							with subsetFunc.FeatureCompatibleID() as compatID:
+								compatID.CompatibleID = 'WINUSB'
+								compatID.SubCompatibleID = ''
+
+	descriptors.add_language_descriptor((LanguageIDs.ENGLISH_US, ))
+
+	# The UAC3 high capability descriptors, which the host fetches with HIGH_CAPABILITY_DESCRIPTOR requests by ID
+	clusterDesc = ConstructEmitter(StereoClusterDescriptor)
+	clusterDesc.wDescriptorID = 2
+
+	connectorDesc = ConnectorDescriptorEmitter()
+	connectorDesc.wDescriptorID = 4
+	connectorDesc.bNrConnectors = 1
+	connectorDesc.bConID = 1
+	connectorDesc.wClusterDescrID = 2
+	connectorDesc.bConType = ConnectorTypes.PHONE_CONNECTOR_3_5_MM
+	# There's no insertion detection to report through a connector control
+	connectorDesc.bmConAttributes = ConnectorAttributes.FEMALE
+	connectorDesc.dwConColor = ConnectorColour(colour = 0x000000)
+
+	highCapabilityDescriptors = {
+		desc.wDescriptorID: desc.emit() for desc in (clusterDesc, connectorDesc)
+	}
+	return descriptors, platformDescriptors, highCapabilityDescriptors
+
 class USBInterface(Elaboratable):
-	def __init__(self, *, resource):
+	def __init__(self, *, resource, flash : SPIPort, golden = False):
 		self.audioRequestHandler = AudioRequestHandler(configuration = 1, interfaces = (0, 1))
+		self.vendorRequestHandler = VendorRequestHandler(configuration = 1, interface = 0)
+		self.counterRequestHandler = CounterRequestHandler(configuration = 1, interface = 0)
+		self.notificationEndpoint = NotificationEndpoint(2, interface = 0)
+		self.dfuRequestHandler = DFURequestHandler(configuration = 1, interface = 2, flash = flash, golden = golden)
 
 		self._ulpiResource = resource
 		self._endpoints = []
@@ -34,187 +279,27 @@ class USBInterface(Elaboratable):
 		self.ulpiInterface = platform.request(*self._ulpiResource)
 		m.submodules.device = device = USBDevice(bus = self.ulpiInterface, handle_clocking = True)
 
-		descriptors = DeviceDescriptorCollection()
-		with descriptors.DeviceDescriptor() as deviceDesc:
-			deviceDesc.bcdUSB = 2.01
-			deviceDesc.bDeviceClass = DeviceClassCodes.MISCELLANEOUS
-			deviceDesc.bDeviceSubclass = MiscellaneousSubclassCodes.MULTIFUNCTION
-			deviceDesc.bDeviceProtocol = MultifunctionProtocolCodes.INTERFACE_ASSOCIATION
-			deviceDesc.idVendor = 0x1209
-			deviceDesc.idProduct = 0xBADC
-			deviceDesc.bcdDevice = 1.01
-			deviceDesc.iManufacturer = 'bad_alloc Heavy Industries'
-			deviceDesc.iProduct = 'Headphone Amp+DAC Audio Interface'
-			#deviceDesc.iSerialNumber
-			deviceDesc.bNumConfigurations = 1
-
-		with descriptors.ConfigurationDescriptor() as configDesc:
-			configDesc.bConfigurationValue = 1
-			configDesc.iConfiguration = 'PCM audio interface'
-			# Bus powered with no remote wakeup support
-			configDesc.bmAttributes = 0x80
-			# 50mA max.
-			configDesc.bMaxPower = 25
-
-			with configDesc.InterfaceAssociationDescriptor() as ifaceAssocDesc:
-				ifaceAssocDesc.bFirstInterface = 0
-				ifaceAssocDesc.bInterfaceCount = 2
-				ifaceAssocDesc.bFunctionClass = AudioFunctionClassCode.AUDIO_FUNCTION
-				ifaceAssocDesc.bFunctionSubclass = AudioFunctionSubclassCodes.HEADPHONE
-				ifaceAssocDesc.bFunctionProtocol = AudioFunctionProtocolCodes.AF_VERSION_03_00
-				ifaceAssocDesc.iFunction = 'PCM audio interface'
-
-			with configDesc.InterfaceDescriptor() as interfaceDesc:
-				interfaceDesc.bInterfaceNumber = 0
-				interfaceDesc.bAlternateSetting = 0
-				interfaceDesc.bInterfaceClass = AudioInterfaceClassCode.AUDIO
-				interfaceDesc.bInterfaceSubclass = AudioInterfaceSubclassCodes.AUDIO_CONTROL
-				interfaceDesc.bInterfaceProtocol = AudioInterfaceProtocolCodes.IP_VERSION_03_00
-				interfaceDesc.iInterface = 'Control interface'
-
-				with HeaderDescriptor(interfaceDesc) as headerDesc:
-					headerDesc.bCategory = AudioFunctionCategoryCodes.HEADPHONE
-					# Read-only latency control
-					headerDesc.bmControls = 0x00000001
-
-					with InputTerminalDescriptor(headerDesc) as terminalDesc:
-						terminalDesc.bTerminalID = 1
-						terminalDesc.wTerminalType = USBTerminalTypes.USB_STREAMING
-						terminalDesc.bAssocTerminal = 0
-						terminalDesc.bCSourceID = 9
-						# No controls
-						terminalDesc.bmControls = 0x00000000
-						terminalDesc.wClusterDescrID = 2
-						terminalDesc.wExTerminalDescrID = 0
-						terminalDesc.wConnectorsDescrID = 0
-						terminalDesc.wTerminalDescrStr = 0
-
-					with OutputTerminalDescriptor(headerDesc) as terminalDesc:
-						terminalDesc.bTerminalID = 3
-						terminalDesc.wTerminalType = OutputTerminalTypes.HEADPHONES
-						terminalDesc.bAssocTerminal = 0
-						terminalDesc.bSourceID = 2
-						# No controls
-						terminalDesc.bmControls = 0x00000000
-						terminalDesc.bCSourceID = 9
-						terminalDesc.wExTerminalDescrID = 0
-						terminalDesc.wConnectorsDescrID = 0
-						terminalDesc.wTerminalDescrStr = 0
-
-					with FeatureUnitDescriptor(headerDesc, AudioChannels.STEREO) as unitDesc:
-						unitDesc.bUnitID = 2
-						unitDesc.bSourceID = 1
-
-					with ClockSourceDescriptor(headerDesc) as clockDesc:
-						clockDesc.bClockID = 9
-						# Async internal clock
-						clockDesc.bmAttributes = 0x01
-						# With only read-only frequency control (hah)
-						clockDesc.bmControls = 0x00000001
-						# Which is not derived in any manner
-						clockDesc.bReferenceTerminal = 0
-						clockDesc.wCSourceDescrStr = 0
-
-					with PowerDomainDescriptor(headerDesc) as pdDesc:
-						pdDesc.bPowerDomainID = 10
-						# 30ms and 300ms expressed in 50µs increments
-						pdDesc.waRecoveryTime = [600, 6000]
-						pdDesc.bNrEntities = 2
-						pdDesc.baEntityID = [1, 3]
-						pdDesc.wPDomainDescrStr = 0
-
-					# This is actually a "High Capability" descriptor that's returned another way.
-					# with ConnectorsDescriptor(headerDesc) as connectorDesc:
-					# 	connectorDesc.wDescriptorID = 4
-					# 	connectorDesc.bNrConnectors = 1
-					# 	connectorDesc.bConnID = 1
-					# 	connectorDesc.waClusterDescrID = 2
-					# 	connectorDesc.baConType = ConnectorTypes.PHONE_CONNECTOR_3_5_MM
-					# 	connectorDesc.bmaConAttributes = ConnectorAttributes.FEMALE | ConnectorAttributes.INSERTION_DETECTION
-					# 	connectorDesc.daConColor = ConnectorColour(colour = 0x000000)
-
-			with configDesc.InterfaceDescriptor() as interfaceDesc:
-				interfaceDesc.bInterfaceNumber = 1
-				interfaceDesc.bAlternateSetting = 0
-				interfaceDesc.bInterfaceClass = AudioInterfaceClassCode.AUDIO
-				interfaceDesc.bInterfaceSubclass = AudioInterfaceSubclassCodes.AUDIO_STREAMING
-				interfaceDesc.bInterfaceProtocol = AudioInterfaceProtocolCodes.IP_VERSION_03_00
-
-			with configDesc.InterfaceDescriptor() as interfaceDesc:
-				interfaceDesc.bInterfaceNumber = 1
-				interfaceDesc.bAlternateSetting = 1
-				interfaceDesc.bInterfaceClass = AudioInterfaceClassCode.AUDIO
-				interfaceDesc.bInterfaceSubclass = AudioInterfaceSubclassCodes.AUDIO_STREAMING
-				interfaceDesc.bInterfaceProtocol = AudioInterfaceProtocolCodes.IP_VERSION_03_00
-				interfaceDesc.iInterface = 'Output stream interface'
-
-				with ClassSpecificAudioStreamingInterfaceDescriptor(interfaceDesc) as streamDesc:
-					streamDesc.bTerminalLink = 1
-					# No controls
-					streamDesc.bmControls = 0x00000000
-					streamDesc.wClusterDescrID = 2
-					streamDesc.bmFormats = AudioDataFormats.PCM
-					# 16-bit PCM audio here please
-					streamDesc.bSubslotSize = 2
-					streamDesc.bBitResolution = 16
-					streamDesc.bmAuxProtocols = 0x0000
-					streamDesc.bControlSize = 0
-
-				with interfaceDesc.EndpointDescriptor() as ep1Out:
-					ep1Out.bEndpointAddress = 0x01
-					ep1Out.bmAttributes = USBTransferType.ISOCHRONOUS | USBSynchronizationType.ASYNC | USBUsageType.DATA
-					ep1Out.wMaxPacketSize = 196
-					ep1Out.bInterval = 4 # Spec requires we support a 1ms interval here.
-
-			with configDesc.InterfaceAssociationDescriptor() as ifaceAssocDesc:
-				ifaceAssocDesc.bFirstInterface = 2
-				ifaceAssocDesc.bInterfaceCount = 1
-				ifaceAssocDesc.bFunctionClass = InterfaceClassCodes.APPLICATION
-				ifaceAssocDesc.bFunctionSubclass = ApplicationSubclassCodes.DFU
-				ifaceAssocDesc.bFunctionProtocol = DFUProtocolCodes.APPLICATION
-				ifaceAssocDesc.iFunction = 'Gateware DFU interface'
-
-			with configDesc.InterfaceDescriptor() as interfaceDesc:
-				interfaceDesc.bInterfaceNumber = 2
-				interfaceDesc.bAlternateSetting = 0
-				interfaceDesc.bInterfaceClass = InterfaceClassCodes.APPLICATION
-				interfaceDesc.bInterfaceSubclass = ApplicationSubclassCodes.DFU
-				interfaceDesc.bInterfaceProtocol = DFUProtocolCodes.APPLICATION
-				interfaceDesc.iInterface = 'Audio interface device gateware upgrade interface'
-
-				with FunctionalDescriptor(interfaceDesc) as functionalDesc:
-					functionalDesc.bmAttributes = (
-						DFUWillDetach.YES | DFUManifestationTolerant.NO | DFUCanUpload.NO | DFUCanDownload.YES
-					)
-					functionalDesc.wDetachTimeOut = 1000
-					functionalDesc.wTransferSize = 4096
-
-		platformDescriptors = PlatformDescriptorCollection()
-		with descriptors.BOSDescriptor() as bos:
-			with PlatformDescriptor(bos, platform_collection = platformDescriptors) as platformDesc:
-				with platformDesc.DescriptorSetInformation() as descSetInfo:
-					descSetInfo.bMS_VendorCode = 1
-
-					with descSetInfo.SetHeaderDescriptor() as setHeader:
-						with setHeader.SubsetHeaderConfiguration() as subsetConfig:
-							subsetConfig.bConfigurationValue = 1
-
-							with subsetConfig.SubsetHeaderFunction() as subsetFunc:
-								subsetFunc.bFirstInterface = 2
-
-								with subsetFunc.FeatureCompatibleID() as compatID:
-									compatID.CompatibleID = 'WINUSB'
-									compatID.SubCompatibleID = ''
-
-		descriptors.add_language_descriptor((LanguageIDs.ENGLISH_US, ))
-		ep0 = device.add_standard_control_endpoint(descriptors)
-
+		# All the descriptors go in the one ROM, with a port for each handler that serves them. Emitting them
+		# is only redone when their definitions change, otherwise they come out of the cache from last time
+		m.submodules.descriptorROM = rom = DescriptorROM(*cachedDescriptors(), ports = 3)
+		ep0 = device.add_control_endpoint()
+		ep0.add_request_handler(StandardRequestHandler(rom, rom.ports[0]))
 		ep0.add_request_handler(self.audioRequestHandler)
-		ep0.add_request_handler(DFURequestHandler(configuration = 1, interface = 2))
-		ep0.add_request_handler(WindowsRequestHandler(platformDescriptors))
+		ep0.add_request_handler(self.vendorRequestHandler)
+		ep0.add_request_handler(self.counterRequestHandler)
+		ep0.add_request_handler(self.dfuRequestHandler)
+		ep0.add_request_handler(WindowsRequestHandler(rom, rom.ports[1]))
+		ep0.add_request_handler(HighCapabilityRequestHandler(rom, rom.ports[2], configuration = 1, interface = 0))
 
 		for endpoint in self._endpoints:
 			device.add_endpoint(endpoint)
+		device.add_endpoint(self.notificationEndpoint)
+
+		# Tell the host about changes to the controls it can read back
+		m.d.comb += [
+			self.notificationEndpoint.sampleRate.eq(self.audioRequestHandler.sampleRate),
+			self.notificationEndpoint.powerState.eq(self.audioRequestHandler.powerState),
+		]
 
 		# Signal that we always want LUNA to try connecting
 		m.d.comb += [
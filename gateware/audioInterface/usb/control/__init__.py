@@ -1,3 +1,7 @@
 from .request import *
 from .dfu import *
+from .vendor import *
+from .counters import *
 from .windows import *
+from .standard import *
+from .highCapability import *
@@ -0,0 +1,161 @@
+from torii.hdl import Module, Signal, Mux
+from usb_construct.types import USBRequestType, USBRequestRecipient
+from torii_usb.usb.usb2.request import USBRequestHandler, SetupPacket, USBInStreamInterface
+from torii_usb.stream.generator import StreamSerializer
+from enum import IntEnum, unique
+
+from .vendor import VendorRequests
+
+__all__ = (
+	'CounterRequestHandler',
+	'PerformanceCounters',
+)
+
+@unique
+class PerformanceCounters(IntEnum):
+	# Samples the audio processing wanted but found the FIFO empty for, and samples that found it full
+	fifoUnderruns = 0
+	fifoOverruns = 1
+	# The lowest and highest the FIFO fill level got, in sample pairs
+	fifoMinFill = 2
+	fifoMaxFill = 3
+	# Isochronous audio packets received, and thrown away as invalid
+	packetsReceived = 4
+	packetsRejected = 5
+	# S/PDIF blocks played, and dropped for each of the reasons they can be
+	blocksAccepted = 6
+	blocksDroppedParity = 7
+	blocksDroppedInvalid = 8
+	blocksDroppedFormat = 9
+	blocksDroppedLength = 10
+	# Times the S/PDIF timing logic lost the signal and had to go back to hunting for it
+	spdifResyncs = 11
+
+class CounterRequestHandler(USBRequestHandler):
+	'''
+	This keeps a bank of 16-bit saturating performance counters, so what the gateware is doing can be
+	seen in the field, and returns them all in one go when the host makes the READ_COUNTERS vendor
+	request to the audio control interface.
+
+	The counters are returned little endian, in the order of PerformanceCounters, and every counter
+	(including the FIFO fill level extremes) covers the time since the last time they were read. The
+	counters are snapshotted and cleared together when a request that reads them arrives, so no events
+	are lost, and a request that gets stalled (not an IN, or asking for no data) leaves them alone. If
+	no audio moved through the FIFO since the last read, the minimum fill reads as 0xffff. Each event
+	input counts once per cycle it is high, and all of them are in the usb domain.
+	'''
+
+	counterWidth = 16
+
+	def __init__(self, *, configuration : int, interface : int, fifoDepth = 256):
+		super().__init__()
+		self.events = {
+			counter: Signal(name = f'{counter.name}Event') for counter in PerformanceCounters
+			if counter not in (PerformanceCounters.fifoMinFill, PerformanceCounters.fifoMaxFill)
+		}
+		self.fillLevel = Signal(range(fifoDepth + 1))
+		# Only track the fill level while there's audio moving through the FIFO
+		self.fillLevelValid = Signal()
+
+		self._configuration = configuration
+		self._interface = interface
+
+	def elaborate(self, platform):
+		m = Module()
+		interface = self.interface
+		setup = interface.setup
+		counterBytes = self.counterWidth // 8
+		counterMax = (1 << self.counterWidth) - 1
+		snapshotLength = len(PerformanceCounters) * counterBytes
+
+		m.submodules.transmitter = transmitter = StreamSerializer(
+			data_length = snapshotLength, domain = 'usb', stream_type = USBInStreamInterface, max_length_width = 8
+		)
+
+		counters = {
+			counter: Signal(
+				self.counterWidth, name = counter.name,
+				reset = counterMax if counter == PerformanceCounters.fifoMinFill else 0
+			)
+			for counter in PerformanceCounters
+		}
+		snapshot = {
+			counter: Signal(self.counterWidth, name = f'{counter.name}Snapshot') for counter in PerformanceCounters
+		}
+		minFill = counters[PerformanceCounters.fifoMinFill]
+		maxFill = counters[PerformanceCounters.fifoMaxFill]
+		requested = Signal()
+		snapshotting = Signal()
+
+		# Only a request that's going to return the counters clears them
+		m.d.comb += [
+			requested.eq(setup.received & self.handler_condition(setup)),
+			snapshotting.eq(requested & setup.is_in_request & (setup.length != 0)),
+		]
+		for counter, event in self.events.items():
+			value = counters[counter]
+			# Clear the counter when snapshotting it, keeping any event that happens at the same time
+			with m.If(snapshotting):
+				m.d.usb += value.eq(event)
+			with m.Elif(event & (value != counterMax)):
+				m.d.usb += value.eq(value + 1)
+
+		# The fill level extremes go back to the opposite extreme when cleared, so the next fill level seen sets them
+		with m.If(snapshotting):
+			m.d.usb += [
+				minFill.eq(counterMax),
+				maxFill.eq(0),
+			]
+		with m.Elif(self.fillLevelValid):
+			with m.If(self.fillLevel < minFill):
+				m.d.usb += minFill.eq(self.fillLevel)
+			with m.If(self.fillLevel > maxFill):
+				m.d.usb += maxFill.eq(self.fillLevel)
+
+		with m.If(snapshotting):
+			m.d.usb += [snapshot[counter].eq(counters[counter]) for counter in PerformanceCounters]
+		for counter in PerformanceCounters:
+			for byte in range(counterBytes):
+				m.d.comb += transmitter.data[counter * counterBytes + byte].eq(snapshot[counter].word_select(byte, 8))
+
+		with m.FSM(domain = 'usb', name = 'counters'):
+			# IDLE -- no active request being handled
+			with m.State('IDLE'):
+				with m.If(snapshotting):
+					m.next = 'READ_COUNTERS'
+				with m.Elif(requested):
+					m.next = 'UNHANDLED'
+
+			# READ_COUNTERS -- The host is reading the counters out
+			with m.State('READ_COUNTERS'):
+				# Hook up the transmitter ...
+				m.d.comb += [
+					transmitter.stream.attach(interface.tx),
+					transmitter.max_length.eq(Mux(setup.length < snapshotLength, setup.length, snapshotLength)),
+				]
+
+				# ... then trigger it when requested, sending as much as the host asked for ...
+				with m.If(interface.data_requested):
+					m.d.comb += transmitter.start.eq(1)
+
+				# ... and ACK our status stage.
+				with m.If(interface.status_requested):
+					m.d.comb += interface.handshakes_out.ack.eq(1)
+					m.next = 'IDLE'
+
+			# UNHANDLED -- we've received a request we don't know how to handle
+			with m.State('UNHANDLED'):
+				with m.If(interface.data_requested | interface.status_requested):
+					m.d.comb += interface.handshakes_out.stall.eq(1)
+					m.next = 'IDLE'
+
+		return m
+
+	def handler_condition(self, setup : SetupPacket):
+		return (
+			(self.interface.active_config == self._configuration) &
+			(setup.type == USBRequestType.VENDOR) &
+			(setup.recipient == USBRequestRecipient.INTERFACE) &
+			(setup.index[0:8] == self._interface) &
+			(setup.request == VendorRequests.READ_COUNTERS)
+		)
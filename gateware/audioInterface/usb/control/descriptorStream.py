@@ -0,0 +1,190 @@
+from torii.hdl import Elaboratable, Module, Signal, Mux, DomainRenamer
+from torii_usb.usb.stream import USBInStreamInterface
+
+from ..rom import DescriptorROM, DescriptorROMPort
+
+__all__ = (
+	'DescriptorStreamer',
+	'handleDescriptorRequest',
+)
+
+class DescriptorStreamer(Elaboratable):
+	'''
+	This streams descriptors out of the descriptor ROM through a port on it, a packet at a time.
+
+	Set slot to the ROM table entry of the descriptor to send, and present to whether there is such a
+	descriptor at all, then hold active high for as long as the request for it is being handled. Each
+	time the host asks for a packet, pulse start with startPosition set to how far into the descriptor
+	that packet begins. The descriptor is cut short to length, the host's wLength, and packets are cut to
+	maxPacketSize. If there's nothing left to send, a ZLP goes out, and if there's no descriptor present,
+	stall pulses instead.
+
+	The descriptor is looked up in the ROM's table as soon as active goes high, rather than when the host
+	first asks for data. From then on the ROM read pipeline is kept a word ahead of what's being sent:
+	between packets, the word the next packet starts in is read over and over against startPosition, so
+	a packet's first byte is on tx the cycle after start, and while sending, the address is worked out
+	for the byte after the one on tx, so every byte after that goes out as fast as tx takes them. Nothing
+	is looked up again for a packet the host asks for again, as it does when a packet goes missing.
+	'''
+
+	def __init__(self, port : DescriptorROMPort, *, maxPacketSize = 64, domain = 'usb'):
+		self._port = port
+		self._maxPacketSize = maxPacketSize
+		self._domain = domain
+
+		self.slot = Signal.like(port.addr)
+		self.present = Signal()
+		self.length = Signal(16)
+		self.active = Signal()
+
+		self.start = Signal()
+		self.startPosition = Signal(16)
+
+		self.tx = USBInStreamInterface()
+		self.stall = Signal()
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		port = self._port
+		wordBits = (DescriptorROM.wordSize - 1).bit_length()
+
+		descriptorLength = Signal(16)
+		descriptorAddress = Signal(16)
+		# The number of bytes of the descriptor the host is allowed to see
+		available = Mux(descriptorLength < self.length, descriptorLength, self.length)
+		remaining = Mux(available > self.startPosition, available - self.startPosition, 0)
+
+		# If the host's asked for data before the lookup's done, the first packet goes out as soon as it is
+		startPending = Signal()
+		address = Signal(16)
+		bytesLeft = Signal(range(self._maxPacketSize + 1))
+		first = Signal()
+		last = bytesLeft == 1
+		# Words are big endian, so the first byte is in the top bits
+		byteInWord = ~address[0:wordBits]
+
+		def preparePacket(descriptorAddress):
+			''' Work out where the next packet starts and how long it is, and read the word it starts in '''
+			packetAddress = descriptorAddress + self.startPosition
+			m.d.comb += [
+				port.select.eq(1),
+				port.addr.eq(packetAddress[wordBits:16]),
+			]
+			m.d.sync += [
+				address.eq(packetAddress),
+				bytesLeft.eq(Mux(remaining > self._maxPacketSize, self._maxPacketSize, remaining)),
+			]
+
+		with m.FSM():
+			with m.State('IDLE'):
+				m.d.comb += port.addr.eq(self.slot * DescriptorROM.entrySize)
+				with m.If(self.active & self.present):
+					m.d.comb += port.select.eq(1)
+					m.next = 'LOOKUP_LENGTH'
+				with m.Elif(self.start):
+					m.d.comb += self.stall.eq(1)
+
+			# The table entry's length is now on the port, and the next word holds where the descriptor starts
+			with m.State('LOOKUP_LENGTH'):
+				m.d.comb += [
+					port.select.eq(1),
+					port.addr.eq(self.slot * DescriptorROM.entrySize + 1),
+				]
+				m.d.sync += [
+					descriptorLength.eq(port.data),
+					startPending.eq(self.start),
+				]
+				m.next = 'LOOKUP_ADDRESS'
+
+			with m.State('LOOKUP_ADDRESS'):
+				m.d.sync += [
+					descriptorAddress.eq(port.data),
+					startPending.eq(startPending | self.start),
+				]
+				preparePacket(port.data)
+				m.next = 'READY'
+
+			# Keep the next packet ready to go, following startPosition as the host ACKs each packet
+			with m.State('READY'):
+				preparePacket(descriptorAddress)
+				m.d.sync += [
+					first.eq(1),
+					startPending.eq(0),
+				]
+				with m.If(~self.active):
+					m.next = 'IDLE'
+				with m.Elif(self.start | startPending):
+					with m.If(bytesLeft == 0):
+						m.next = 'SEND_ZLP'
+					with m.Else():
+						m.next = 'SEND'
+
+			with m.State('SEND'):
+				m.d.comb += [
+					port.select.eq(1),
+					port.addr.eq(address[wordBits:16]),
+					self.tx.valid.eq(1),
+					self.tx.data.eq(port.data.word_select(byteInWord, 8)),
+					self.tx.first.eq(first),
+					self.tx.last.eq(last),
+				]
+
+				with m.If(self.tx.ready):
+					m.d.sync += first.eq(0)
+					with m.If(~last):
+						m.d.comb += port.addr.eq((address + 1)[wordBits:16])
+						m.d.sync += [
+							address.eq(address + 1),
+							bytesLeft.eq(bytesLeft - 1),
+						]
+					with m.Else():
+						m.next = 'READY'
+				with m.If(~self.active):
+					m.next = 'IDLE'
+
+			# The descriptor ended on a packet boundary or the host asked for none of it, so end with a ZLP
+			with m.State('SEND_ZLP'):
+				m.d.comb += [
+					self.tx.valid.eq(1),
+					self.tx.last.eq(1),
+				]
+				m.next = 'READY'
+
+		if self._domain != 'sync':
+			m = DomainRenamer(sync = self._domain)(m)
+		return m
+
+def handleDescriptorRequest(m : Module, interface, streamer, *, maxPacketSize = 64):
+	'''
+	This handles the data and status stages of a request for a descriptor from within the FSM state of a
+	control request handler serving it, going back to IDLE once the request is done or stalled. The
+	streamer is a DescriptorStreamer, or anything with the same active, start, startPosition, tx and stall
+	signals, already pointed at the descriptor asked for. Each ACK of a packet moves startPosition on by
+	maxPacketSize and toggles the data PID, so IDLE must put both back for the next request.
+	'''
+	expectingAck = Signal()
+
+	m.d.comb += [
+		streamer.active.eq(1),
+		streamer.tx.attach(interface.tx),
+		interface.handshakes_out.stall.eq(streamer.stall),
+	]
+
+	with m.If(interface.data_requested):
+		m.d.comb += streamer.start.eq(1)
+		m.d.usb += expectingAck.eq(1)
+
+	# Each ACK moves us on to the next packet's worth of the descriptor
+	with m.If(interface.handshakes_in.ack & expectingAck):
+		m.d.usb += [
+			streamer.startPosition.eq(streamer.startPosition + maxPacketSize),
+			interface.tx_data_pid.eq(~interface.tx_data_pid),
+			expectingAck.eq(0),
+		]
+
+	with m.If(interface.status_requested):
+		m.d.comb += interface.handshakes_out.ack.eq(1)
+		m.next = 'IDLE'
+	with m.Elif(streamer.stall):
+		m.d.usb += expectingAck.eq(0)
+		m.next = 'IDLE'
@@ -1,4 +1,4 @@
-from torii.hdl import Module, Signal, Instance, Cat
+from torii.hdl import Module, Signal, Instance, Array, Memory, Cat, Mux
 from usb_construct.types import USBRequestType, USBRequestRecipient, USBStandardRequests
 from usb_construct.types.descriptors.dfu import DFURequests
 from torii_usb.usb.usb2.request import USBRequestHandler
@@ -7,6 +7,11 @@ from torii_usb.usb.stream import USBInStreamInterface
 from torii_usb.stream.generator import StreamSerializer
 from enum import IntEnum, unique
 
+from ...spi import SPIPort
+from ...flash import SPIFlash, FlashLayout
+from ...crc import CRC32
+from .vendor import VendorRequests
+
 __all__ = (
 	'DFURequestHandler',
 )
@@ -14,42 +19,475 @@ __all__ = (
 @unique
 class DFUState(IntEnum):
 	appIdle = 0
+	appDetach = 1
+	dfuIdle = 2
+	dnloadSync = 3
+	dnBusy = 4
+	dnloadIdle = 5
+	manifestSync = 6
+	manifest = 7
+	manifestWaitReset = 8
+	uploadIdle = 9
+	error = 10
 
 @unique
 class DFUStatus(IntEnum):
 	ok = 0
+	errTarget = 1
+	errFile = 2
+	errWrite = 3
+	errErase = 4
+	errCheckErased = 5
+	errProg = 6
+	errVerify = 7
+	errAddress = 8
+	errNotDone = 9
+	errFirmware = 10
+	errVendor = 11
+	errUSBR = 12
+	errPOR = 13
+	errUnknown = 14
+	errStalledPkt = 15
+
+@unique
+class ImageVerifyStatus(IntEnum):
+	# Nothing's been downloaded to check, it's being checked, or it has been and matched or didn't
+	none = 0
+	verifying = 1
+	passed = 2
+	failed = 3
 
 class DFURequestHandler(USBRequestHandler):
-	def __init__(self, *, configuration : int, interface : int):
+	'''
+	This implements DFU for the gateware in the configuration flash, which sits on the flash port of the
+	configuration SPI bus.
+
+	Downloads are taken a flash page (transferSize bytes) per block, with the block number picking the
+	page to program relative to imageBase. The blocks are received into one half of a double buffer while
+	the other half is programmed, so the host only has to wait on the flash when it gets two blocks ahead,
+	and GET_STATUS reports how long for based on what the flash is doing. Sectors are erased as the first
+	page in them is reached. A zero length download ends things, and once the last block is programmed
+	the device reboots into the new gateware.
+
+	Uploads read the imageSize bytes of the image back out of the flash, a block at a time. The flash is
+	read into another double buffer with fast reads, and the next block is read ahead while the host is
+	busy with the current one, so the host only ever gets NAK'd waiting on the flash for the first block.
+	The block taking the image's end comes back short, which tells the host that's all there is.
+
+	A CRC-32 is kept of the bytes as they're programmed, and once the last block is, the region of the
+	flash the download covered is read back with the fast read engine and its CRC-32 checked against
+	that. Only if they match does GET_STATUS go on to manifestWaitReset and the reboot; if not, it
+	reports errVerify and the device stays in the gateware it's running. The IMAGE_CRC vendor request
+	to the DFU interface reads out where things are up to: the ImageVerifyStatus, then the length
+	programmed (3 bytes), the CRC of what was programmed and the CRC of what was read back (4 bytes
+	each), all little endian. The region read back runs on from the first block for as many bytes as were
+	programmed, which is where a host sending the image in order, a full block at a time but for the last,
+	puts them.
+
+	The flash holds two images, as laid out by FlashLayout: the golden image the FPGA powers up into,
+	which is never written over USB, and the update slot the downloads go to. Which of them gets run is
+	down to the boot record - a byte each for whether the update slot holds an image that passed its
+	checks (installedMagic), whether that image has ever made it as far as being configured by a host
+	(confirmedMagic), and a bit per boot attempt it has left. The record's sector is erased before the
+	first block of a download is programmed, so an interrupted download leaves nothing to boot, and
+	installed is written once it's been read back and verified.
+
+	The golden image (golden = True) reads the record on start up and warm boots into the update slot if
+	it's been confirmed, or if it hasn't but has attempts left, after using one up. The update image
+	confirms itself once a host configures it, and reboots back into the golden image if it isn't
+	configured within confirmTimeout usb cycles, so an update that can't get going is run bootAttempts
+	times at most before the device settles back on the golden image. Rebooting after a download or a
+	DETACH always goes to the golden image, to make that decision afresh. The ROLLBACK vendor request to
+	the DFU interface undoes an update: it clears installed and reboots into the golden image.
+	'''
+
+	transferSize = SPIFlash.pageSize
+	maxPacketSize = 64
+	imageCRCLength = 12
+	installedMagic = 0xa5
+	confirmedMagic = 0x5a
+	recordLength = 3
+	bootAttempts = 3
+
+	# confirmTimeout defaults to 5s
+	def __init__(
+		self, *, configuration : int, interface : int, flash : SPIPort, golden = False,
+		imageBase = FlashLayout.updateImage, imageSize = FlashLayout.imageSize, bootRecord = FlashLayout.bootRecord,
+		confirmTimeout = 300_000_000
+	):
 		super().__init__()
 
 		self._configuration = configuration
 		self._interface = interface
+		self._flash = flash
+		self._golden = golden
+		self._imageBase = imageBase
+		self._imageSize = imageSize
+		self._bootRecord = bootRecord
+		self._confirmTimeout = confirmTimeout
 		self._triggerReboot = Signal(name = "triggerReboot")
+		self._warmbootSelect = Signal(2, name = "warmbootSelect")
 
 	def elaborate(self, platform) -> Module:
 		m = Module()
 		interface = self.interface
 		setup = interface.setup
+		transferSize = self.transferSize
+		pageBits = (transferSize - 1).bit_length()
 
 		m.submodules.transmitter = transmitter = StreamSerializer(
-			data_length = 6, domain = 'usb', stream_type = USBInStreamInterface, max_length_width = 3
+			data_length = self.imageCRCLength, domain = 'usb', stream_type = USBInStreamInterface, max_length_width = 4
 		)
+		m.submodules.flash = flash = SPIFlash(self._flash)
+		m.submodules.programCRC = programCRC = CRC32()
+		m.submodules.verifyCRC = verifyCRC = CRC32()
 
 		triggerReboot = self._triggerReboot
-		warmbootSelect = Signal(2)
+		warmbootSelect = self._warmbootSelect
+
+		state = Signal(DFUState)
+		status = Signal(DFUStatus)
+		# What to report for the GET_STATUS in progress, and the state to move to when it completes
+		reportState = Signal(DFUState)
+		reportStatus = Signal(DFUStatus)
+		pollTimeout = Signal(24)
+		manifested = Signal()
+
+		# The download double buffer - one half is filled from the host while the other is programmed
+		buffer = Memory(width = 8, depth = transferSize * 2)
+		m.submodules.bufferWrite = writePort = buffer.write_port(domain = 'usb')
+		m.submodules.bufferRead = readPort = buffer.read_port(domain = 'usb', transparent = False)
+		fillBank = Signal()
+		programBank = Signal()
+		bankFull = Array(Signal(name = f'bankFull{bank}') for bank in range(2))
+		bankAddress = Array(Signal(24, name = f'bankAddress{bank}') for bank in range(2))
+		bankLength = Array(Signal(range(transferSize + 1), name = f'bankLength{bank}') for bank in range(2))
+		byteCount = Signal(range(transferSize + 1))
+		packetStart = Signal.like(byteCount)
+		programming = Signal()
+		erasePending = Signal()
+
+		# The upload double buffer - the host is sent blocks out of one half while the next is read into the other
+		uploadBuffer = Memory(width = 8, depth = transferSize * 2)
+		m.submodules.uploadWrite = uploadWrite = uploadBuffer.write_port(domain = 'usb')
+		m.submodules.uploadRead = uploadRead = uploadBuffer.read_port(domain = 'usb', transparent = False)
+		# Which part of the flash each half holds, and how much of it has been read in so far
+		cachedValid = Array(Signal(name = f'cachedValid{bank}') for bank in range(2))
+		cachedAddress = Array(Signal(24, name = f'cachedAddress{bank}') for bank in range(2))
+		cachedCount = Array(Signal(range(transferSize + 1), name = f'cachedCount{bank}') for bank in range(2))
+		fetchPending = Signal()
+		fetchBank = Signal()
+		fetchAddress = Signal(24)
+		fetchLength = Signal(range(transferSize + 1))
+		reading = Signal()
+
+		# The part of the flash the download has programmed, which is read back to check it once it's all in
+		regionStart = Signal(24)
+		programmedLength = Signal(24)
+		regionEnd = regionStart + programmedLength
+		verifyStatus = Signal(ImageVerifyStatus)
+		verifyAddress = Signal(24)
+
+		# The boot record as it was read in, and the byte of it to write next and what to write there
+		recordInstalled = Signal()
+		recordConfirmed = Signal()
+		recordAttempts = Signal(8)
+		recordOffset = Signal(range(self.recordLength))
+		recordValue = Signal(8)
+		recordErasePending = Signal()
+		installPending = Signal()
+		rollbackPending = Signal()
+		rebootPending = Signal()
+		# Whether the boot record wants the flash, and whether it has it
+		bootWants = Signal()
+		bootFlash = Signal()
+		watchdog = Signal(range(self._confirmTimeout + 1), reset = self._confirmTimeout)
+		watchdogDisarmed = Signal()
+
+		# Program the banks in the order they're filled, erasing a sector on reaching its first page
+		m.d.comb += [
+			flash.address.eq(
+				Mux(bootFlash, self._bootRecord + recordOffset, Mux(reading, fetchAddress, bankAddress[programBank]))
+			),
+			flash.length.eq(
+				Mux(bootFlash, Mux(flash.read, self.recordLength, 1), Mux(reading, fetchLength, bankLength[programBank]))
+			),
+			readPort.addr.eq(Cat(flash.bufferAddress, programBank)),
+			flash.bufferData.eq(Mux(bootFlash, recordValue, readPort.data)),
+			erasePending.eq(bankFull[programBank] & (bankAddress[programBank][0:12] == 0)),
+			programming.eq(bankFull[0] | bankFull[1]),
+		]
+
+		with m.FSM(domain = 'usb', name = 'dfuProgram') as programFSM:
+			with m.State('IDLE'):
+				# Nothing can be programmed until the boot record's been erased, so the slot's never booted half written.
+				# The boot record keeps the flash up to and including the cycle its operation is done in
+				with m.If(bankFull[programBank] & ~flash.busy & ~bootFlash & ~recordErasePending):
+					with m.If(erasePending):
+						m.d.comb += flash.erase.eq(1)
+						m.next = 'ERASE'
+					with m.Else():
+						m.d.comb += flash.program.eq(1)
+						m.next = 'PROGRAM'
+
+			with m.State('ERASE'):
+				with m.If(flash.done):
+					m.next = 'ERASE-DONE'
+
+			with m.State('ERASE-DONE'):
+				m.d.comb += flash.program.eq(1)
+				m.next = 'PROGRAM'
+
+			with m.State('PROGRAM'):
+				with m.If(flash.done):
+					m.d.usb += [
+						bankFull[programBank].eq(0),
+						programBank.eq(~programBank),
+					]
+					m.next = 'IDLE'
+
+		# Read blocks into the upload buffer as they're asked for, so long as there's no programming to do
+		m.d.comb += [
+			uploadWrite.addr.eq(Cat(cachedCount[fetchBank][0:pageBits], fetchBank)),
+			uploadWrite.data.eq(flash.readData),
+			uploadWrite.en.eq(flash.readValid & reading),
+		]
+		with m.If(flash.readValid & reading):
+			m.d.usb += cachedCount[fetchBank].eq(cachedCount[fetchBank] + 1)
+
+		with m.FSM(domain = 'usb', name = 'dfuFetch') as fetchFSM:
+			with m.State('IDLE'):
+				with m.If(
+					fetchPending & ~flash.busy & programFSM.ongoing('IDLE') & ~bankFull[programBank] & ~bootWants &
+					~bootFlash
+				):
+					m.d.comb += flash.read.eq(1)
+					m.next = 'READ'
+
+			with m.State('READ'):
+				with m.If(flash.done):
+					m.d.usb += fetchPending.eq(0)
+					m.next = 'IDLE'
+
+		m.d.comb += reading.eq(flash.read | fetchFSM.ongoing('READ'))
+
+		imageEnd = self._imageBase + self._imageSize
+		lastBlock = (self._imageSize - 1) // transferSize
+		lastBlockLength = self._imageSize - (lastBlock * transferSize)
+
+		def fetch(bank, address, end, *, cache = True):
+			# Have a block read into a half of the upload buffer, up to end. Only whole blocks get kept for uploads
+			m.d.usb += [
+				cachedValid[bank].eq(cache),
+				cachedAddress[bank].eq(address),
+				cachedCount[bank].eq(0),
+				fetchBank.eq(bank),
+				fetchAddress.eq(address),
+				fetchLength.eq(Mux(address + transferSize > end, end - address, transferSize)),
+				fetchPending.eq(1),
+			]
+
+		# Keep a CRC of what gets programmed, and once it's all in, read it back through the fetch engine to check it
+		m.d.comb += [
+			programCRC.data.eq(flash.writeData),
+			programCRC.valid.eq(flash.writeValid & ~bootFlash),
+			verifyCRC.data.eq(flash.readData),
+		]
+		with m.If(flash.writeValid & ~bootFlash):
+			m.d.usb += programmedLength.eq(programmedLength + 1)
+
+		with m.FSM(domain = 'usb', name = 'dfuVerify') as verifyFSM:
+			with m.State('IDLE'):
+				verifyReady = ~programming & programFSM.ongoing('IDLE') & ~fetchPending
+				with m.If((verifyStatus == ImageVerifyStatus.verifying) & verifyReady):
+					m.d.comb += verifyCRC.reset.eq(1)
+					m.d.usb += verifyAddress.eq(regionStart)
+					m.next = 'READ'
+
+			with m.State('READ'):
+				m.d.comb += verifyCRC.valid.eq(flash.readValid & reading)
+				with m.If(~fetchPending):
+					with m.If(verifyAddress == regionEnd):
+						m.next = 'CHECK'
+					with m.Else():
+						fetch(~fetchBank, verifyAddress, regionEnd, cache = False)
+						with m.If(verifyAddress + transferSize > regionEnd):
+							m.d.usb += verifyAddress.eq(regionEnd)
+						with m.Else():
+							m.d.usb += verifyAddress.eq(verifyAddress + transferSize)
+
+			with m.State('CHECK'):
+				with m.If(verifyCRC.value == programCRC.value):
+					m.d.usb += [
+						verifyStatus.eq(ImageVerifyStatus.passed),
+						installPending.eq(1),
+					]
+				with m.Else():
+					m.d.usb += verifyStatus.eq(ImageVerifyStatus.failed)
+				m.next = 'IDLE'
+
+		# The boot record gets the flash ahead of uploads, but only between programming blocks - unless the
+		# block waiting to be programmed is itself waiting on the boot record being erased
+		flashFree = (
+			~flash.busy & programFSM.ongoing('IDLE') & fetchFSM.ongoing('IDLE') &
+			(~bankFull[programBank] | recordErasePending)
+		)
+		configured = interface.active_config == self._configuration
+
+		def recordOperation(name, operation, nextState):
+			# Carry out an erase, program or read of the boot record, then move on to nextState
+			with m.State(name):
+				m.d.comb += bootWants.eq(1)
+				with m.If(flashFree):
+					m.d.comb += [
+						bootFlash.eq(1),
+						operation.eq(1),
+					]
+					m.next = f'{name}-WAIT'
+			with m.State(f'{name}-WAIT'):
+				m.d.comb += bootFlash.eq(1)
+				with m.If(flash.done):
+					m.next = nextState
+
+		# An update that hasn't been confirmed gets so long to be configured by a host before it's given up on
+		if not self._golden:
+			with m.If(configured | recordConfirmed):
+				m.d.usb += watchdogDisarmed.eq(1)
+			with m.Elif(watchdog != 0):
+				m.d.usb += watchdog.eq(watchdog - 1)
+
+		with m.FSM(domain = 'usb', name = 'dfuBoot') as bootFSM:
+			recordOperation('READ-RECORD', flash.read, 'DECIDE' if self._golden else 'RUN')
+
+			# DECIDE -- the golden image is deciding whether to boot the update slot instead
+			with m.State('DECIDE'):
+				attemptsLeft = recordAttempts[0:self.bootAttempts] != 0
+				with m.If(recordInstalled & recordConfirmed):
+					m.next = 'BOOT-UPDATE'
+				# If the update's not been known to work yet, use one of its attempts up trying it
+				with m.Elif(recordInstalled & attemptsLeft):
+					m.d.usb += [
+						recordOffset.eq(2),
+						recordValue.eq(recordAttempts & (recordAttempts - 1)),
+					]
+					m.next = 'USE-ATTEMPT'
+				with m.Else():
+					m.next = 'RUN'
+			recordOperation('USE-ATTEMPT', flash.program, 'BOOT-UPDATE')
+
+			# RUN -- keep the boot record up to date with what the downloads and the host get up to
+			with m.State('RUN'):
+				with m.If(recordErasePending):
+					m.next = 'ERASE-RECORD'
+				with m.Elif(installPending):
+					m.d.usb += [
+						recordOffset.eq(0),
+						recordValue.eq(self.installedMagic),
+					]
+					m.next = 'INSTALL'
+				with m.Elif(rollbackPending):
+					m.d.usb += [
+						recordOffset.eq(0),
+						recordValue.eq(0),
+					]
+					m.next = 'ROLLBACK'
+				with m.Elif(rebootPending & flashFree):
+					m.next = 'BOOT-GOLDEN'
+				if not self._golden:
+					with m.Elif(configured & recordInstalled & ~recordConfirmed):
+						m.d.usb += [
+							recordOffset.eq(1),
+							recordValue.eq(self.confirmedMagic),
+						]
+						m.next = 'CONFIRM'
+					with m.Elif(~watchdogDisarmed & (watchdog == 0)):
+						m.next = 'BOOT-GOLDEN'
+
+			recordOperation('ERASE-RECORD', flash.erase, 'ERASE-DONE')
+			with m.State('ERASE-DONE'):
+				m.d.usb += [
+					recordErasePending.eq(0),
+					recordInstalled.eq(0),
+					recordConfirmed.eq(0),
+				]
+				m.next = 'RUN'
+			recordOperation('INSTALL', flash.program, 'INSTALL-DONE')
+			# The image just installed confirms itself once it's booted, it's not for the one running to do
+			with m.State('INSTALL-DONE'):
+				m.d.usb += installPending.eq(0)
+				m.next = 'RUN'
+			recordOperation('CONFIRM', flash.program, 'CONFIRM-DONE')
+			with m.State('CONFIRM-DONE'):
+				m.d.usb += recordConfirmed.eq(1)
+				m.next = 'RUN'
+			recordOperation('ROLLBACK', flash.program, 'BOOT-GOLDEN')
+
+			with m.State('BOOT-GOLDEN'):
+				m.d.usb += [
+					warmbootSelect.eq(FlashLayout.goldenWarmboot),
+					triggerReboot.eq(1),
+				]
+			with m.State('BOOT-UPDATE'):
+				m.d.usb += [
+					warmbootSelect.eq(FlashLayout.updateWarmboot),
+					triggerReboot.eq(1),
+				]
+
+		with m.If(bootFSM.ongoing('READ-RECORD-WAIT') & flash.readValid):
+			with m.Switch(recordOffset):
+				with m.Case(0):
+					m.d.usb += recordInstalled.eq(flash.readData == self.installedMagic)
+				with m.Case(1):
+					m.d.usb += recordConfirmed.eq(flash.readData == self.confirmedMagic)
+				with m.Case(2):
+					m.d.usb += recordAttempts.eq(flash.readData)
+			m.d.usb += recordOffset.eq(recordOffset + 1)
+
+		uploadBank = Signal()
+		uploadAddress = Signal(24)
+		uploadLength = Signal(range(transferSize + 1))
+		# How much of the block the host has ACK'd, and how much has been sent
+		uploadPosition = Signal(range(transferSize + 1))
+		sendPosition = Signal(range(transferSize + 1))
+		packetEnd = Signal(range(transferSize + 1))
+		expectingAck = Signal()
+
+		with m.If(uploadLength - uploadPosition > self.maxPacketSize):
+			m.d.comb += packetEnd.eq(uploadPosition + self.maxPacketSize)
+		with m.Else():
+			m.d.comb += packetEnd.eq(uploadLength)
+
+		# Work out how long before the host can next expect the flash to have done something useful, in ms
+		with m.If(programFSM.ongoing('ERASE') | (programFSM.ongoing('IDLE') & erasePending)):
+			m.d.comb += pollTimeout.eq(SPIFlash.sectorEraseTime + SPIFlash.pageProgramTime)
+		with m.Else():
+			m.d.comb += pollTimeout.eq(SPIFlash.pageProgramTime)
 
 		with m.FSM(domain = 'usb', name = 'dfu'):
 			with m.State('IDLE'):
+				m.d.usb += [
+					byteCount.eq(0),
+					expectingAck.eq(0),
+					# Always start our responses with DATA1 PIDs
+					interface.tx_data_pid.eq(1),
+				]
 				with m.If(setup.received & self.handler_condition(setup)):
 					with m.If(setup.type == USBRequestType.CLASS):
 						with m.Switch(setup.request):
 							with m.Case(DFURequests.DETACH):
 								m.next = 'HANDLE_DETACH'
+							with m.Case(DFURequests.DOWNLOAD):
+								m.next = 'HANDLE_DOWNLOAD'
+							with m.Case(DFURequests.UPLOAD):
+								m.next = 'HANDLE_UPLOAD'
 							with m.Case(DFURequests.GET_STATUS):
 								m.next = 'HANDLE_GET_STATUS'
+							with m.Case(DFURequests.CLR_STATUS):
+								m.next = 'HANDLE_CLR_STATUS'
 							with m.Case(DFURequests.GET_STATE):
 								m.next = 'HANDLE_GET_STATE'
+							with m.Case(DFURequests.ABORT):
+								m.next = 'HANDLE_ABORT'
 							with m.Default():
 								m.next = 'UNHANDLED'
 					with m.Elif(setup.type == USBRequestType.STANDARD):
@@ -60,24 +498,224 @@ class DFURequestHandler(USBRequestHandler):
 								m.next = 'SET_INTERFACE'
 							with m.Default():
 								m.next = 'UNHANDLED'
+					# The only vendor requests we take are IMAGE_CRC and ROLLBACK
+					with m.Elif(setup.type == USBRequestType.VENDOR):
+						with m.If(setup.request == VendorRequests.IMAGE_CRC):
+							m.next = 'GET_IMAGE_CRC'
+						with m.Else():
+							m.next = 'ROLLBACK'
 
 			with m.State('HANDLE_DETACH'):
 				with m.If(interface.status_requested):
 					m.d.comb += self.send_zlp()
 
 				with m.If(interface.handshakes_in.ack):
-					m.d.usb += triggerReboot.eq(1)
+					m.d.usb += rebootPending.eq(1)
+
+			with m.State('HANDLE_DOWNLOAD'):
+				downloadable = (
+					(state == DFUState.appIdle) | (state == DFUState.dfuIdle) | (state == DFUState.dnloadIdle)
+				)
+				# A zero length download marks the end of the image, and the rest follows on from GET_STATUS
+				with m.If(setup.length == 0):
+					with m.If(state != DFUState.dnloadIdle):
+						m.next = 'TRANSFER_ERROR'
+					with m.Else():
+						with m.If(interface.status_requested):
+							m.d.comb += self.send_zlp()
+						with m.If(interface.handshakes_in.ack):
+							m.d.usb += [
+								state.eq(DFUState.manifestSync),
+								verifyStatus.eq(ImageVerifyStatus.verifying),
+							]
+							m.next = 'IDLE'
+				# Only take a block if it's within the update slot and there's somewhere to put it
+				with m.Elif(
+					setup.is_in_request | (setup.length > transferSize) | (setup.value > lastBlock) | ~downloadable |
+					bankFull[fillBank]
+				):
+					m.next = 'TRANSFER_ERROR'
+				with m.Else():
+					m.d.comb += [
+						writePort.addr.eq(Cat(byteCount[0:pageBits], fillBank)),
+						writePort.data.eq(interface.rx.data),
+					]
+					with m.If(interface.rx.valid & interface.rx.next & (byteCount != setup.length)):
+						m.d.comb += writePort.en.eq(1)
+						m.d.usb += byteCount.eq(byteCount + 1)
+
+					# If a packet is bad the host will send it again, so go back to where it started
+					with m.If(interface.rx_invalid):
+						m.d.usb += byteCount.eq(packetStart)
+					with m.If(interface.rx_ready_for_response):
+						m.d.comb += interface.handshakes_out.ack.eq(1)
+						m.d.usb += packetStart.eq(byteCount)
+
+					with m.If(interface.status_requested):
+						m.d.comb += self.send_zlp()
+					# Once the host's happy the block's landed, queue it for programming
+					with m.If(interface.handshakes_in.ack):
+						m.d.usb += [
+							bankFull[fillBank].eq(1),
+							bankAddress[fillBank].eq(self._imageBase + (setup.value << pageBits)),
+							bankLength[fillBank].eq(byteCount),
+							fillBank.eq(~fillBank),
+							packetStart.eq(0),
+							state.eq(DFUState.dnloadSync),
+							# Anything read out for uploads may be about to be out of date
+							cachedValid[0].eq(0),
+							cachedValid[1].eq(0),
+						]
+						# The first block of a download starts the region to check afresh, and stops the slot being booted
+						with m.If(state != DFUState.dnloadIdle):
+							m.d.comb += programCRC.reset.eq(1)
+							m.d.usb += [
+								regionStart.eq(self._imageBase + (setup.value << pageBits)),
+								programmedLength.eq(0),
+								verifyStatus.eq(ImageVerifyStatus.none),
+								recordErasePending.eq(1),
+								installPending.eq(0),
+							]
+						m.next = 'IDLE'
+
+			with m.State('HANDLE_UPLOAD'):
+				uploadable = (
+					(state == DFUState.appIdle) | (state == DFUState.dfuIdle) | (state == DFUState.uploadIdle)
+				)
+				with m.If(~setup.is_in_request | (setup.length > transferSize) | ~uploadable):
+					m.next = 'TRANSFER_ERROR'
+				with m.Else():
+					m.d.usb += [
+						uploadAddress.eq(self._imageBase + (setup.value << pageBits)),
+						uploadPosition.eq(0),
+						sendPosition.eq(0),
+					]
+					# Only send what's left of the image
+					with m.If(setup.value < lastBlock):
+						m.d.usb += uploadLength.eq(setup.length)
+					with m.Elif(setup.value == lastBlock):
+						m.d.usb += uploadLength.eq(Mux(setup.length < lastBlockLength, setup.length, lastBlockLength))
+					with m.Else():
+						m.d.usb += uploadLength.eq(0)
+					m.next = 'UPLOAD_FIND'
+
+			# UPLOAD_FIND -- find the block in the upload buffer, or have it read in if it's not there yet
+			with m.State('UPLOAD_FIND'):
+				with m.If(interface.data_requested):
+					m.d.comb += interface.handshakes_out.nak.eq(1)
+
+				with m.If(uploadLength == 0):
+					m.next = 'UPLOAD'
+				with m.Elif(cachedValid[0] & (cachedAddress[0] == uploadAddress)):
+					m.d.usb += uploadBank.eq(0)
+					m.next = 'UPLOAD'
+				with m.Elif(cachedValid[1] & (cachedAddress[1] == uploadAddress)):
+					m.d.usb += uploadBank.eq(1)
+					m.next = 'UPLOAD'
+				with m.Elif(~fetchPending):
+					fetch(~uploadBank, uploadAddress, imageEnd)
+					m.d.usb += uploadBank.eq(~uploadBank)
+					m.next = 'UPLOAD'
+
+			# UPLOAD -- send the block a packet at a time, as fast as it comes in from the flash
+			with m.State('UPLOAD'):
+				nextAddress = uploadAddress + transferSize
+				nextCached = cachedValid[~uploadBank] & (cachedAddress[~uploadBank] == nextAddress)
+				# Read the next block ahead while the host's busy with this one
+				with m.If((uploadLength != 0) & ~fetchPending & (nextAddress < imageEnd) & ~nextCached):
+					fetch(~uploadBank, nextAddress, imageEnd)
+
+				with m.If(interface.data_requested):
+					with m.If(uploadLength == 0):
+						m.d.comb += self.send_zlp()
+						m.d.usb += expectingAck.eq(1)
+					with m.Elif(cachedCount[uploadBank] >= packetEnd):
+						m.d.comb += uploadRead.addr.eq(Cat(uploadPosition[0:pageBits], uploadBank))
+						m.d.usb += sendPosition.eq(uploadPosition)
+						m.next = 'UPLOAD_PACKET'
+					with m.Else():
+						m.d.comb += interface.handshakes_out.nak.eq(1)
+
+				# If the host doesn't ACK a packet, it'll ask for it again and it gets resent from uploadPosition
+				with m.If(interface.handshakes_in.ack & expectingAck):
+					m.d.usb += [
+						uploadPosition.eq(sendPosition),
+						interface.tx_data_pid.eq(~interface.tx_data_pid),
+						expectingAck.eq(0),
+					]
+
+				# A short block means the upload's over
+				with m.If(interface.status_requested):
+					m.d.comb += interface.handshakes_out.ack.eq(1)
+					with m.If(uploadLength < setup.length):
+						m.d.usb += state.eq(DFUState.appIdle)
+					with m.Else():
+						m.d.usb += state.eq(DFUState.uploadIdle)
+					m.next = 'IDLE'
+
+			with m.State('UPLOAD_PACKET'):
+				lastByte = sendPosition + 1 == packetEnd
+				m.d.comb += [
+					interface.tx.valid.eq(1),
+					interface.tx.data.eq(uploadRead.data),
+					interface.tx.first.eq(sendPosition == uploadPosition),
+					interface.tx.last.eq(lastByte),
+					uploadRead.addr.eq(Cat(sendPosition[0:pageBits], uploadBank)),
+				]
+
+				with m.If(interface.tx.ready):
+					m.d.comb += uploadRead.addr.eq(Cat((sendPosition + 1)[0:pageBits], uploadBank))
+					m.d.usb += sendPosition.eq(sendPosition + 1)
+					with m.If(lastByte):
+						m.d.usb += expectingAck.eq(1)
+						m.next = 'UPLOAD'
+
+			# TRANSFER_ERROR -- a download or upload request arrived that we can't take, so stall it and note why
+			with m.State('TRANSFER_ERROR'):
+				with m.If(interface.data_requested | interface.status_requested):
+					m.d.comb += interface.handshakes_out.stall.eq(1)
+					m.d.usb += [
+						state.eq(DFUState.error),
+						status.eq(DFUStatus.errStalledPkt),
+						packetStart.eq(0),
+					]
+					m.next = 'IDLE'
 
 			with m.State('HANDLE_GET_STATUS'):
 				m.d.comb += [
+					reportState.eq(state),
+					reportStatus.eq(status),
 					transmitter.stream.attach(interface.tx),
 					transmitter.max_length.eq(6),
-					transmitter.data[0].eq(DFUStatus.ok),
-					Cat(transmitter.data[1:4]).eq(0),
-					transmitter.data[4].eq(DFUState.appIdle),
+					transmitter.data[0].eq(reportStatus),
+					transmitter.data[4].eq(reportState),
 					transmitter.data[5].eq(0),
 				]
 
+				with m.Switch(state):
+					# Mid download, the host can send the next block as soon as there's a free half of the buffer
+					with m.Case(DFUState.dnloadSync, DFUState.dnBusy):
+						with m.If(bankFull[fillBank]):
+							m.d.comb += [
+								reportState.eq(DFUState.dnBusy),
+								Cat(transmitter.data[1:4]).eq(pollTimeout),
+							]
+						with m.Else():
+							m.d.comb += reportState.eq(DFUState.dnloadIdle)
+					# And once the download's over, the rest of it has to be programmed and checked before rebooting
+					with m.Case(DFUState.manifestSync, DFUState.manifest):
+						m.d.comb += reportState.eq(DFUState.manifest)
+						with m.If(programming | (verifyStatus == ImageVerifyStatus.verifying) | installPending):
+							m.d.comb += Cat(transmitter.data[1:4]).eq(pollTimeout)
+						# If what's in the flash isn't what was sent, don't boot it
+						with m.Elif(verifyStatus == ImageVerifyStatus.failed):
+							m.d.comb += [
+								reportState.eq(DFUState.error),
+								reportStatus.eq(DFUStatus.errVerify),
+							]
+						with m.Else():
+							m.d.comb += reportState.eq(DFUState.manifestWaitReset)
+
 				with m.If(interface.data_requested):
 					with m.If(setup.length == 6):
 						m.d.comb += transmitter.start.eq(1)
@@ -87,13 +725,30 @@ class DFURequestHandler(USBRequestHandler):
 
 				with m.If(interface.status_requested):
 					m.d.comb += interface.handshakes_out.ack.eq(1)
+					m.d.usb += [
+						state.eq(reportState),
+						status.eq(reportStatus),
+						manifested.eq(reportState == DFUState.manifestWaitReset),
+					]
+					m.next = 'IDLE'
+
+			with m.State('HANDLE_CLR_STATUS'):
+				with m.If(interface.status_requested):
+					m.d.comb += self.send_zlp()
+
+				with m.If(interface.handshakes_in.ack):
+					with m.If(state == DFUState.error):
+						m.d.usb += [
+							state.eq(DFUState.appIdle),
+							status.eq(DFUStatus.ok),
+						]
 					m.next = 'IDLE'
 
 			with m.State('HANDLE_GET_STATE'):
 				m.d.comb += [
 					transmitter.stream.attach(interface.tx),
 					transmitter.max_length.eq(1),
-					transmitter.data[0].eq(DFUState.appIdle),
+					transmitter.data[0].eq(state),
 				]
 
 				with m.If(interface.data_requested):
@@ -107,6 +762,15 @@ class DFURequestHandler(USBRequestHandler):
 					m.d.comb += interface.handshakes_out.ack.eq(1)
 					m.next = 'IDLE'
 
+			with m.State('HANDLE_ABORT'):
+				with m.If(interface.status_requested):
+					m.d.comb += self.send_zlp()
+
+				with m.If(interface.handshakes_in.ack):
+					with m.If((state == DFUState.dnloadIdle) | (state == DFUState.uploadIdle)):
+						m.d.usb += state.eq(DFUState.appIdle)
+					m.next = 'IDLE'
+
 			with m.State('GET_INTERFACE'):
 				m.d.comb += [
 					transmitter.stream.attach(interface.tx),
@@ -132,24 +796,69 @@ class DFURequestHandler(USBRequestHandler):
 				with m.If(interface.handshakes_in.ack):
 					m.next = 'IDLE'
 
+			# GET_IMAGE_CRC -- the host wants to know how checking the last download against the flash went
+			with m.State('GET_IMAGE_CRC'):
+				with m.If(~setup.is_in_request | (setup.length == 0)):
+					m.next = 'UNHANDLED'
+				with m.Else():
+					m.d.comb += [
+						transmitter.stream.attach(interface.tx),
+						transmitter.max_length.eq(Mux(setup.length < self.imageCRCLength, setup.length, self.imageCRCLength)),
+						transmitter.data[0].eq(verifyStatus),
+					]
+					for byte in range(3):
+						m.d.comb += transmitter.data[1 + byte].eq(programmedLength.word_select(byte, 8))
+					for byte in range(4):
+						m.d.comb += [
+							transmitter.data[4 + byte].eq(programCRC.value.word_select(byte, 8)),
+							transmitter.data[8 + byte].eq(verifyCRC.value.word_select(byte, 8)),
+						]
+
+					with m.If(interface.data_requested):
+						m.d.comb += transmitter.start.eq(1)
+
+					with m.If(interface.status_requested):
+						m.d.comb += interface.handshakes_out.ack.eq(1)
+						m.next = 'IDLE'
+
+			# ROLLBACK -- the host wants the update slot's image gone, and the golden image back
+			with m.State('ROLLBACK'):
+				with m.If(setup.is_in_request | (setup.length != 0)):
+					m.next = 'UNHANDLED'
+				with m.Else():
+					with m.If(interface.status_requested):
+						m.d.comb += self.send_zlp()
+					with m.If(interface.handshakes_in.ack):
+						m.d.usb += rollbackPending.eq(1)
+						m.next = 'IDLE'
+
 			with m.State('UNHANDLED'):
 				with m.If(interface.data_requested | interface.status_requested):
 					m.d.comb += interface.handshakes_out.stall.eq(1)
 					m.next = 'IDLE'
 
+		# With the new gateware in place, reboot so the golden image can start it once the host's been told
+		with m.If(manifested):
+			m.d.usb += rebootPending.eq(1)
+
 		m.submodules += Instance(
 			'SB_WARMBOOT',
 			i_BOOT = triggerReboot,
 			i_S0 = warmbootSelect[0],
 			i_S1 = warmbootSelect[1],
 		)
-		m.d.comb += warmbootSelect.eq(0b00)
 		return m
 
 	def handler_condition(self, setup : SetupPacket):
 		return (
 			(self.interface.active_config == self._configuration) &
-			((setup.type == USBRequestType.CLASS) | (setup.type == USBRequestType.STANDARD)) &
+			(
+				(setup.type == USBRequestType.CLASS) | (setup.type == USBRequestType.STANDARD) |
+				(
+					(setup.type == USBRequestType.VENDOR) &
+					((setup.request == VendorRequests.IMAGE_CRC) | (setup.request == VendorRequests.ROLLBACK))
+				)
+			) &
 			(setup.recipient == USBRequestRecipient.INTERFACE) &
 			(setup.index == self._interface)
 		)
@@ -0,0 +1,85 @@
+from torii.hdl import Module
+from usb_construct.types import USBRequestType, USBRequestRecipient
+from usb_construct.types.descriptors.uac3 import AudioClassSpecificRequestCodes
+from torii_usb.usb.request.control import ControlRequestHandler
+from torii_usb.usb.usb2.request import SetupPacket
+
+from ..rom import DescriptorROM, DescriptorROMPort
+from .descriptorStream import DescriptorStreamer, handleDescriptorRequest
+
+__all__ = (
+	'HighCapabilityRequestHandler',
+)
+
+class HighCapabilityRequestHandler(ControlRequestHandler):
+	'''
+	This handles UAC3's HIGH_CAPABILITY_DESCRIPTOR requests to the audio control interface, serving the
+	cluster and connectors descriptors the other descriptors refer to by ID through a port on the
+	descriptor ROM. wValue holds the ID of the descriptor the host wants, and any ID that's not in the
+	ROM is stalled, as is anything other than a read addressed to the interface itself (entity 0).
+	'''
+
+	def __init__(self, rom : DescriptorROM, port : DescriptorROMPort, *, configuration : int, interface : int,
+		maxPacketSize = 64
+	):
+		self._rom = rom
+		self._port = port
+		self._configuration = configuration
+		self._interface = interface
+		self._maxPacketSize = maxPacketSize
+		super().__init__()
+
+	def elaborate(self, platform):
+		m = Module()
+		interface = self.interface
+		setup = interface.setup
+
+		m.submodules.descriptorStreamer = streamer = DescriptorStreamer(
+			self._port, maxPacketSize = self._maxPacketSize
+		)
+
+		# Work out which of the ROM's descriptors, if any, is being asked for
+		m.d.comb += streamer.length.eq(setup.length)
+		with m.Switch(setup.value):
+			for descriptorID, slot in self._rom.highCapabilitySlots.items():
+				with m.Case(descriptorID):
+					m.d.comb += [
+						streamer.slot.eq(slot),
+						streamer.present.eq(1),
+					]
+
+		with m.FSM(domain = 'usb', name = 'highCapability'):
+			# IDLE -- no active request being handled
+			with m.State('IDLE'):
+				m.d.usb += [
+					streamer.startPosition.eq(0),
+					# Responses always start with a DATA1 PID
+					interface.tx_data_pid.eq(1),
+				]
+				with m.If(setup.received & self.handler_condition(setup)):
+					with m.If(setup.is_in_request & (setup.index[8:16] == 0)):
+						m.next = 'GET_DESCRIPTOR'
+					with m.Else():
+						m.next = 'UNHANDLED'
+
+			# GET_DESCRIPTOR -- The host is reading a descriptor, which may take several packets
+			with m.State('GET_DESCRIPTOR'):
+				handleDescriptorRequest(m, interface, streamer, maxPacketSize = self._maxPacketSize)
+
+			# UNHANDLED -- we've received a request we're not prepared to handle
+			with m.State('UNHANDLED'):
+				# When we next have an opportunity to stall, do so and then return to idle
+				with m.If(interface.data_requested | interface.status_requested):
+					m.d.comb += interface.handshakes_out.stall.eq(1)
+					m.next = 'IDLE'
+
+		return m
+
+	def handler_condition(self, setup : SetupPacket):
+		return (
+			(self.interface.active_config == self._configuration) &
+			(setup.type == USBRequestType.CLASS) &
+			(setup.recipient == USBRequestRecipient.INTERFACE) &
+			(setup.index[0:8] == self._interface) &
+			(setup.request == AudioClassSpecificRequestCodes.HIGH_CAPABILITY_DESCRIPTOR)
+		)
@@ -2,7 +2,7 @@ from torii.hdl import Module, Signal, Array, Cat
 from usb_construct.types import USBRequestType, USBRequestRecipient, USBStandardRequests
 from usb_construct.types.descriptors.uac3 import (
 	AudioClassSpecificRequestCodes, AudioControlInterfaceControlSelectors, FeatureUnitControlSelectors,
-	Layout2RangeBlock
+	TerminalControlSelectors, ClockSourceControlSelectors, Layout2RangeBlock
 )
 from torii_usb.usb.usb2.request import (
 	USBRequestHandler, SetupPacket, StallOnlyRequestHandler, USBInStreamInterface, USBOutStreamInterface
@@ -10,6 +10,7 @@ from torii_usb.usb.usb2.request import (
 from torii_usb.stream.generator import StreamSerializer
 from torii_usb.usb.usb2.deserializer import StreamDeserializer
 from typing import Iterable
+from struct import pack
 
 __all__ = (
 	'AudioRequestHandler',
@@ -27,6 +28,10 @@ class AudioRequestHandler(USBRequestHandler):
 		self.muteStates = Array(Signal(1, name = f'mute{i}') for i in range(3))
 		# Volume levels for the various channels
 		self.volumeStates = Array(Signal(16, name = f'volume{i}') for i in range(3))
+		# The latency from USB through to the DAC in ns, for the output terminal's read-only latency control
+		self.latency = Signal(32)
+		# The sample rate currently being played, for the clock source's read-only frequency control
+		self.sampleRate = Signal(range(192001))
 		# Which configuration we should be active in
 		self._configuration = configuration
 		# Alt-mode settings to propegate to the rest of the gateware
@@ -39,11 +44,15 @@ class AudioRequestHandler(USBRequestHandler):
 				{'wMin': -120, 'wMax': 0, 'wRes': 1},
 			]
 		})
+		# The sample rates we support over USB, as a layout 3 parameter block. That's only 48kHz for now
+		self.sampleRatesRange = pack('<H', 1) + pack('<III', 48000, 48000, 0)
 
 		# Internals
 		self._powerSelect = Signal()
 		self._muteSelect = Signal()
 		self._volumeSelect = Signal()
+		self._latencySelect = Signal()
+		self._sampleRateSelect = Signal()
 
 	def elaborate(self, platform):
 		m = Module()
@@ -53,7 +62,7 @@ class AudioRequestHandler(USBRequestHandler):
 		rxTriggered = Signal()
 
 		m.submodules.transmitter = transmitter = StreamSerializer(
-			data_length = 8, domain = 'usb', stream_type = USBInStreamInterface, max_length_width = 4
+			data_length = self.rangeLength, domain = 'usb', stream_type = USBInStreamInterface, max_length_width = 4
 		)
 		m.submodules.receiver = receiver = StreamDeserializer(
 			dataLength = 8, domain = 'usb', streamType = USBOutStreamInterface, maxLengthWidth = 4
@@ -71,7 +80,15 @@ class AudioRequestHandler(USBRequestHandler):
 			self._volumeSelect.eq(
 				(setup.index[0:8] == 0) & (setup.index[8:16] == 2) & (setup.value[0:8] >= 0) &
 				(setup.value[0:8] <= 2) & (setup.value[8:16] == FeatureUnitControlSelectors.FU_VOLUME_CONTROL)
-			)
+			),
+			self._latencySelect.eq(
+				(setup.index[0:8] == 0) & (setup.index[8:16] == 3) & (setup.value[0:8] == 0) &
+				(setup.value[8:16] == TerminalControlSelectors.TE_LATENCY_CONTROL)
+			),
+			self._sampleRateSelect.eq(
+				(setup.index[0:8] == 0) & (setup.index[8:16] == 9) & (setup.value[0:8] == 0) &
+				(setup.value[8:16] == ClockSourceControlSelectors.CS_SAM_FREQ_CONTROL)
+			),
 		]
 
 		with m.If(self.handler_condition(setup)):
@@ -166,6 +183,10 @@ class AudioRequestHandler(USBRequestHandler):
 							m.d.comb += interface.handshakes_out.ack.eq(1)
 							m.next = 'IDLE'
 
+					# The latency and sample rate controls are read-only, so tell the host no if it tries to set them
+					with m.Elif(self._latencySelect | self._sampleRateSelect):
+						m.next = 'UNHANDLED'
+
 					# Else this is a SET request
 					with m.Else():
 						# Pull the length for the setting
@@ -246,11 +267,21 @@ class AudioRequestHandler(USBRequestHandler):
 			(self.interface.active_config == self._configuration) &
 			((setup.type == USBRequestType.CLASS) | (setup.type == USBRequestType.STANDARD)) &
 			(setup.recipient == USBRequestRecipient.INTERFACE) &
-			(Cat(setup.index[0:8] == interface for interface in self.interfaces) != 0)
+			(Cat(setup.index[0:8] == interface for interface in self.interfaces) != 0) &
+			# High capability descriptors are served out of the descriptor ROM by HighCapabilityRequestHandler
+			~(
+				(setup.type == USBRequestType.CLASS) &
+				(setup.request == AudioClassSpecificRequestCodes.HIGH_CAPABILITY_DESCRIPTOR)
+			)
 		)
 
+	@property
+	def rangeLength(self):
+		''' The length of the longest range parameter block we can return '''
+		return max(len(self.volumesRange), len(self.sampleRatesRange))
+
 	def lengthForCurrent(self, m : Module, setup : SetupPacket):
-		length = Signal(2)
+		length = Signal(3)
 		m.d.comb += length.eq(0)
 
 		# If the request is for the power domain, return the length of the power state setting
@@ -262,6 +293,12 @@ class AudioRequestHandler(USBRequestHandler):
 		# If the request is for the functional unit volume controls, return the length of a volume setting
 		with m.Elif(self._volumeSelect):
 			m.d.comb += length.eq(2)
+		# If the request is for the output terminal latency control, return the length of the latency
+		with m.Elif(self._latencySelect):
+			m.d.comb += length.eq(4)
+		# If the request is for the clock source frequency control, return the length of a sample rate
+		with m.Elif(self._sampleRateSelect):
+			m.d.comb += length.eq(4)
 		return length
 
 	def lengthForRange(self, m : Module, setup : SetupPacket):
@@ -271,11 +308,14 @@ class AudioRequestHandler(USBRequestHandler):
 		# Power Domains don't support this request, so length being 0 as a result works in our favour
 		# If the request is for the mixer (volume) controls, return the length of the volume settings
 		with m.If(self._volumeSelect):
-			m.d.comb += length.eq(8)
+			m.d.comb += length.eq(len(self.volumesRange))
+		# If the request is for the clock source frequency control, return the length of the sample rate ranges
+		with m.Elif(self._sampleRateSelect):
+			m.d.comb += length.eq(len(self.sampleRatesRange))
 		return length
 
 	def settingForCurrent(self, m : Module, setup : SetupPacket):
-		setting = Signal(16)
+		setting = Signal(32)
 		m.d.comb += setting.eq(0)
 
 		# If the request is for the power domain, return the power state setting
@@ -286,18 +326,28 @@ class AudioRequestHandler(USBRequestHandler):
 			m.d.comb += setting[0].eq(self.muteStates[setup.value[0:8]])
 		# If the request is for one the functional unit volume controls, return the volume setting
 		with m.Elif(self._volumeSelect):
-			m.d.comb += setting.eq(self.volumeStates[setup.value[0:8]])
+			m.d.comb += setting[0:16].eq(self.volumeStates[setup.value[0:8]])
+		# If the request is for the output terminal latency control, return the current latency
+		with m.Elif(self._latencySelect):
+			m.d.comb += setting.eq(self.latency)
+		# If the request is for the clock source frequency control, return the sample rate being played
+		with m.Elif(self._sampleRateSelect):
+			m.d.comb += setting.eq(self.sampleRate)
 
 		return setting, self.lengthForCurrent(m, setup)
 
 	def settingForRange(self, m : Module, setup : SetupPacket):
-		setting = Array(Signal(8) for _ in range(8))
+		setting = Array(Signal(8) for _ in range(self.rangeLength))
 		m.d.comb += Cat(setting).eq(0)
 
-		# If the request is for the functional unit volume controls, return the length of a volume setting
+		# If the request is for the functional unit volume controls, return the volume range
 		with m.If(self._volumeSelect):
-			for idx, value in enumerate(setting):
-				m.d.comb += value.eq(self.volumesRange[idx])
+			for idx, value in enumerate(self.volumesRange):
+				m.d.comb += setting[idx].eq(value)
+		# If the request is for the clock source frequency control, return the sample rates supported
+		with m.Elif(self._sampleRateSelect):
+			for idx, value in enumerate(self.sampleRatesRange):
+				m.d.comb += setting[idx].eq(value)
 
 		return setting, self.lengthForRange(m, setup)
 
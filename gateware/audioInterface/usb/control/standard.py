@@ -0,0 +1,106 @@
+from torii.hdl import Module
+from usb_construct.types import USBRequestType, USBRequestRecipient, USBStandardRequests
+from torii_usb.usb.request.control import ControlRequestHandler
+from torii_usb.usb.usb2.request import SetupPacket, USBInStreamInterface
+from torii_usb.stream.generator import StreamSerializer
+
+from ..rom import DescriptorROM, DescriptorROMPort
+from .descriptorStream import DescriptorStreamer, handleDescriptorRequest
+
+__all__ = (
+	'StandardRequestHandler',
+)
+
+class StandardRequestHandler(ControlRequestHandler):
+	'''
+	This handles the standard requests needed for enumeration, in place of the one LUNA adds with a
+	standard control endpoint. It serves GET_DESCRIPTOR through a port on our descriptor ROM rather than
+	building a ROM of its own, so the descriptors sit in block RAM laid out in a way that can be patched
+	after the fact, and shared with the other descriptor handlers.
+	'''
+
+	def __init__(self, rom : DescriptorROM, port : DescriptorROMPort, *, maxPacketSize = 64):
+		self._rom = rom
+		self._port = port
+		self._maxPacketSize = maxPacketSize
+		super().__init__()
+
+	def elaborate(self, platform):
+		m = Module()
+		interface = self.interface
+		setup = interface.setup
+
+		m.submodules.descriptorStreamer = streamer = DescriptorStreamer(
+			self._port, maxPacketSize = self._maxPacketSize
+		)
+		m.submodules.transmitter = transmitter = StreamSerializer(
+			data_length = 2, domain = 'usb', stream_type = USBInStreamInterface, max_length_width = 2
+		)
+
+		# Work out which of the ROM's descriptors, if any, is being asked for
+		m.d.comb += streamer.length.eq(setup.length)
+		with m.Switch(setup.value):
+			for (number, index), slot in self._rom.standardSlots.items():
+				with m.Case((number << 8) | index):
+					m.d.comb += [
+						streamer.slot.eq(slot),
+						streamer.present.eq(1),
+					]
+
+		with m.FSM(domain = 'usb', name = 'standard'):
+			# IDLE -- no active request being handled
+			with m.State('IDLE'):
+				m.d.usb += [
+					streamer.startPosition.eq(0),
+					# Responses always start with a DATA1 PID
+					interface.tx_data_pid.eq(1),
+				]
+				with m.If(setup.received & self.handler_condition(setup)):
+					with m.Switch(setup.request):
+						with m.Case(USBStandardRequests.GET_STATUS):
+							m.next = 'GET_STATUS'
+						with m.Case(USBStandardRequests.SET_ADDRESS):
+							m.next = 'SET_ADDRESS'
+						with m.Case(USBStandardRequests.SET_CONFIGURATION):
+							m.next = 'SET_CONFIGURATION'
+						with m.Case(USBStandardRequests.GET_DESCRIPTOR):
+							m.next = 'GET_DESCRIPTOR'
+						with m.Case(USBStandardRequests.GET_CONFIGURATION):
+							m.next = 'GET_CONFIGURATION'
+						with m.Default():
+							m.next = 'UNHANDLED'
+
+			# GET_STATUS -- We're bus powered and have no remote wakeup, so the status is always 0
+			with m.State('GET_STATUS'):
+				self.handle_simple_data_request(m, transmitter, 0, length = 2)
+
+			# SET_ADDRESS -- The host is giving us an address
+			with m.State('SET_ADDRESS'):
+				self.handle_register_write_request(m, interface.new_address, interface.address_changed)
+
+			# SET_CONFIGURATION -- The host is picking a configuration
+			with m.State('SET_CONFIGURATION'):
+				self.handle_register_write_request(m, interface.new_config, interface.config_changed)
+
+			# GET_DESCRIPTOR -- The host is reading a descriptor, which may take several packets
+			with m.State('GET_DESCRIPTOR'):
+				handleDescriptorRequest(m, interface, streamer, maxPacketSize = self._maxPacketSize)
+
+			# GET_CONFIGURATION -- The host wants to know which configuration is active
+			with m.State('GET_CONFIGURATION'):
+				self.handle_simple_data_request(m, transmitter, interface.active_config)
+
+			# UNHANDLED -- we've received a request we're not prepared to handle
+			with m.State('UNHANDLED'):
+				# When we next have an opportunity to stall, do so and then return to idle
+				with m.If(interface.data_requested | interface.status_requested):
+					m.d.comb += interface.handshakes_out.stall.eq(1)
+					m.next = 'IDLE'
+
+		return m
+
+	def handler_condition(self, setup : SetupPacket):
+		return (
+			(setup.type == USBRequestType.STANDARD) &
+			(setup.recipient == USBRequestRecipient.DEVICE)
+		)
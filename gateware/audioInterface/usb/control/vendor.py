@@ -0,0 +1,314 @@
+from torii.hdl import Module, Signal, Array, Cat, Const
+from usb_construct.types import USBRequestType, USBRequestRecipient
+from torii_usb.usb.usb2.request import USBRequestHandler, SetupPacket, USBInStreamInterface, USBOutStreamInterface
+from torii_usb.stream.generator import StreamSerializer
+from torii_usb.usb.usb2.deserializer import StreamDeserializer
+from enum import IntEnum, unique
+
+__all__ = (
+	'VendorRequestHandler',
+	'VendorRequests',
+)
+
+@unique
+class VendorRequests(IntEnum):
+	# Get/set the playback requantiser's configuration: bit 0 enables TPDF dither, bits 1-2 the noise shaping order
+	DITHER_CONFIG = 0x01
+	# Write one band's biquad coefficients (wValue) into the equaliser's inactive bank. The data is b0, b1, b2,
+	# a1, a2 as 3 byte little endian signed Q2.16 values
+	EQ_COEFFICIENTS = 0x02
+	# Set whether the equaliser is enabled from bit 0 of wValue, and swap its coefficient banks over if bit 1 is
+	# set. The inactive bank still holds the coefficients from the bank before last, so before a swap the host
+	# must have written every band's coefficients with EQ_COEFFICIENTS since the previous one, not just those
+	# that changed. Reading this back returns bit 0 as the enable, bit 1 as the active bank, and the number of
+	# bands in bits 4-7
+	EQ_COMMIT = 0x03
+	# Get/set how the playback source is picked: bits 0-1 are the policy and bit 2 the source to play when the host
+	# picks. Reading this back also returns the source picked in bit 4, and whether it is playing in bit 5
+	SOURCE_CONFIG = 0x04
+	# Read out (and clear) the performance counters. This one is handled by the CounterRequestHandler
+	READ_COUNTERS = 0x05
+	# Read how checking the last DFU download against the flash went. This one is made to the DFU interface, and
+	# handled by the DFURequestHandler
+	IMAGE_CRC = 0x06
+	# Mark the image in the update slot as not to be booted, and reboot into the golden image. This one is also
+	# made to the DFU interface
+	ROLLBACK = 0x07
+
+class VendorRequestHandler(USBRequestHandler):
+	'''
+	This handles our vendor-specific requests, which are addressed to the audio control interface
+	so they can't be confused with the Microsoft OS descriptor vendor requests made to the device.
+	'''
+
+	def __init__(self, *, configuration : int, interface : int, eqBands = 5):
+		super().__init__()
+		# Whether to dither when reducing the word length of the playback samples
+		self.dither = Signal(reset = 1)
+		# The order of the noise shaping to apply when doing so
+		self.noiseShaping = Signal(2)
+		# The equaliser's enable and active coefficient bank
+		self.eqBands = eqBands
+		self.eqEnable = Signal()
+		self.eqBank = Signal()
+		# Coefficient writes for the equaliser's inactive bank
+		self.eqWriteBand = Signal(range(eqBands))
+		self.eqWriteIndex = Signal(range(5))
+		self.eqWriteData = Signal(18)
+		self.eqWrite = Signal()
+		# The policy for picking the playback source, and the source the host wants if it's doing the picking
+		self.sourcePolicy = Signal(2)
+		self.hostSource = Signal()
+		# The source that's been picked, and whether it's playing
+		self.source = Signal()
+		self.sourceActive = Signal()
+
+		self._configuration = configuration
+		self._interface = interface
+
+	def elaborate(self, platform):
+		m = Module()
+		interface = self.interface
+		setup = interface.setup
+
+		rxTriggered = Signal()
+		coefficientsPending = Signal()
+
+		m.submodules.transmitter = transmitter = StreamSerializer(
+			data_length = 1, domain = 'usb', stream_type = USBInStreamInterface, max_length_width = 1
+		)
+		m.submodules.receiver = receiver = StreamDeserializer(
+			dataLength = 15, domain = 'usb', streamType = USBOutStreamInterface, maxLengthWidth = 4
+		)
+
+		# Once a band's coefficients have been received, write them into the equaliser one at a time
+		coefficients = Array(Cat(receiver.data[idx * 3:(idx + 1) * 3])[0:18] for idx in range(5))
+		m.d.comb += [
+			self.eqWriteData.eq(coefficients[self.eqWriteIndex]),
+			self.eqWrite.eq(coefficientsPending),
+		]
+		with m.If(coefficientsPending):
+			m.d.usb += self.eqWriteIndex.eq(self.eqWriteIndex + 1)
+			with m.If(self.eqWriteIndex == 4):
+				m.d.usb += coefficientsPending.eq(0)
+
+		with m.FSM(domain = 'usb', name = 'vendor'):
+			# IDLE -- no active request being handled
+			with m.State('IDLE'):
+				with m.If(setup.received & self.handler_condition(setup)):
+					with m.Switch(setup.request):
+						with m.Case(VendorRequests.DITHER_CONFIG):
+							m.next = 'DITHER_CONFIG'
+						with m.Case(VendorRequests.EQ_COEFFICIENTS):
+							m.next = 'EQ_COEFFICIENTS'
+						with m.Case(VendorRequests.EQ_COMMIT):
+							m.next = 'EQ_COMMIT'
+						with m.Case(VendorRequests.SOURCE_CONFIG):
+							m.next = 'SOURCE_CONFIG'
+						with m.Default():
+							m.next = 'UNHANDLED'
+				# Make sure that we reset the rx trigger state
+				m.d.usb += rxTriggered.eq(0)
+
+			# DITHER_CONFIG -- The host is asking about or changing the requantiser configuration
+			with m.State('DITHER_CONFIG'):
+				with m.If(setup.is_in_request):
+					# Hook up the transmitter ...
+					m.d.comb += [
+						transmitter.stream.attach(interface.tx),
+						transmitter.data[0].eq(Cat(self.dither, self.noiseShaping)),
+						transmitter.max_length.eq(1),
+					]
+
+					# ... then trigger it when requested if the lengths match ...
+					with m.If(interface.data_requested):
+						with m.If(setup.length == 1):
+							m.d.comb += transmitter.start.eq(1)
+						with m.Else():
+							m.d.comb += interface.handshakes_out.stall.eq(1)
+							m.next = 'IDLE'
+
+					# ... and ACK our status stage.
+					with m.If(interface.status_requested):
+						m.d.comb += interface.handshakes_out.ack.eq(1)
+						m.next = 'IDLE'
+
+				with m.Else():
+					# Hook up the receiver ...
+					m.d.comb += [
+						interface.rx.connect(receiver.stream),
+						receiver.maxLength.eq(1),
+					]
+					# ... trigger the receiver if it isn't yet triggered ...
+					with m.If(~rxTriggered):
+						with m.If(setup.length == 1):
+							m.d.comb += receiver.start.eq(1)
+							m.d.usb += rxTriggered.eq(1)
+						with m.Else():
+							m.d.comb += interface.handshakes_out.stall.eq(1)
+							m.next = 'IDLE'
+					# ... then when the receiver finishes, update the configuration, ignoring shaping orders we don't do
+					with m.Elif(receiver.done):
+						setting = receiver.data[0]
+						m.d.usb += self.dither.eq(setting[0])
+						with m.If(setting[1:3] != 3):
+							m.d.usb += self.noiseShaping.eq(setting[1:3])
+
+					# If the current out packet is complete and the host is waiting for an ACK, make it
+					with m.If(interface.rx_ready_for_response):
+						m.d.comb += interface.handshakes_out.ack.eq(1)
+
+					# If we're in the status phase, send a ZLP
+					with m.If(interface.status_requested):
+						m.d.comb += self.send_zlp()
+					# And then deal with the relevant ACK so we can go back to idle
+					with m.If(interface.handshakes_in.ack):
+						m.next = 'IDLE'
+
+			# EQ_COEFFICIENTS -- The host is loading a band's coefficients into the equaliser
+			with m.State('EQ_COEFFICIENTS'):
+				with m.If(setup.is_in_request | (setup.value >= self.eqBands)):
+					m.next = 'UNHANDLED'
+				with m.Else():
+					# Hook up the receiver ...
+					m.d.comb += [
+						interface.rx.connect(receiver.stream),
+						receiver.maxLength.eq(15),
+					]
+					# ... trigger the receiver if it isn't yet triggered ...
+					with m.If(~rxTriggered):
+						with m.If(setup.length == 15):
+							m.d.comb += receiver.start.eq(1)
+							m.d.usb += rxTriggered.eq(1)
+						with m.Else():
+							m.d.comb += interface.handshakes_out.stall.eq(1)
+							m.next = 'IDLE'
+					# ... then when the receiver finishes, write the coefficients out
+					with m.Elif(receiver.done):
+						m.d.usb += [
+							self.eqWriteBand.eq(setup.value),
+							self.eqWriteIndex.eq(0),
+							coefficientsPending.eq(1),
+						]
+
+					# If the current out packet is complete and the host is waiting for an ACK, make it
+					with m.If(interface.rx_ready_for_response):
+						m.d.comb += interface.handshakes_out.ack.eq(1)
+
+					# If we're in the status phase, send a ZLP
+					with m.If(interface.status_requested):
+						m.d.comb += self.send_zlp()
+					# And then deal with the relevant ACK so we can go back to idle
+					with m.If(interface.handshakes_in.ack):
+						m.next = 'IDLE'
+
+			# EQ_COMMIT -- The host is enabling the equaliser or swapping it over to the coefficients it loaded
+			with m.State('EQ_COMMIT'):
+				with m.If(setup.is_in_request):
+					# Hook up the transmitter ...
+					m.d.comb += [
+						transmitter.stream.attach(interface.tx),
+						transmitter.data[0].eq(Cat(self.eqEnable, self.eqBank, Const(0, 2), Const(self.eqBands, 4))),
+						transmitter.max_length.eq(1),
+					]
+
+					# ... then trigger it when requested if the lengths match ...
+					with m.If(interface.data_requested):
+						with m.If(setup.length == 1):
+							m.d.comb += transmitter.start.eq(1)
+						with m.Else():
+							m.d.comb += interface.handshakes_out.stall.eq(1)
+							m.next = 'IDLE'
+
+					# ... and ACK our status stage.
+					with m.If(interface.status_requested):
+						m.d.comb += interface.handshakes_out.ack.eq(1)
+						m.next = 'IDLE'
+
+				with m.Elif(setup.length != 0):
+					m.next = 'UNHANDLED'
+
+				with m.Else():
+					# Provide a response to the status stage
+					with m.If(interface.status_requested):
+						m.d.comb += self.send_zlp()
+					# And apply the settings once we get back an ACK from the ZLP, only swapping banks if asked to
+					with m.If(interface.handshakes_in.ack):
+						m.d.usb += self.eqEnable.eq(setup.value[0])
+						with m.If(setup.value[1]):
+							m.d.usb += self.eqBank.eq(~self.eqBank)
+						m.next = 'IDLE'
+
+			# SOURCE_CONFIG -- The host is asking about or changing how the playback source is picked
+			with m.State('SOURCE_CONFIG'):
+				with m.If(setup.is_in_request):
+					# Hook up the transmitter ...
+					m.d.comb += [
+						transmitter.stream.attach(interface.tx),
+						transmitter.data[0].eq(
+							Cat(self.sourcePolicy, self.hostSource, Const(0, 1), self.source, self.sourceActive)
+						),
+						transmitter.max_length.eq(1),
+					]
+
+					# ... then trigger it when requested if the lengths match ...
+					with m.If(interface.data_requested):
+						with m.If(setup.length == 1):
+							m.d.comb += transmitter.start.eq(1)
+						with m.Else():
+							m.d.comb += interface.handshakes_out.stall.eq(1)
+							m.next = 'IDLE'
+
+					# ... and ACK our status stage.
+					with m.If(interface.status_requested):
+						m.d.comb += interface.handshakes_out.ack.eq(1)
+						m.next = 'IDLE'
+
+				with m.Else():
+					# Hook up the receiver ...
+					m.d.comb += [
+						interface.rx.connect(receiver.stream),
+						receiver.maxLength.eq(1),
+					]
+					# ... trigger the receiver if it isn't yet triggered ...
+					with m.If(~rxTriggered):
+						with m.If(setup.length == 1):
+							m.d.comb += receiver.start.eq(1)
+							m.d.usb += rxTriggered.eq(1)
+						with m.Else():
+							m.d.comb += interface.handshakes_out.stall.eq(1)
+							m.next = 'IDLE'
+					# ... then when the receiver finishes, update the configuration, ignoring policies we don't have
+					with m.Elif(receiver.done):
+						setting = receiver.data[0]
+						m.d.usb += self.hostSource.eq(setting[2])
+						with m.If(setting[0:2] != 3):
+							m.d.usb += self.sourcePolicy.eq(setting[0:2])
+
+					# If the current out packet is complete and the host is waiting for an ACK, make it
+					with m.If(interface.rx_ready_for_response):
+						m.d.comb += interface.handshakes_out.ack.eq(1)
+
+					# If we're in the status phase, send a ZLP
+					with m.If(interface.status_requested):
+						m.d.comb += self.send_zlp()
+					# And then deal with the relevant ACK so we can go back to idle
+					with m.If(interface.handshakes_in.ack):
+						m.next = 'IDLE'
+
+			# UNHANDLED -- we've received a request we don't know how to handle
+			with m.State('UNHANDLED'):
+				with m.If(interface.data_requested | interface.status_requested):
+					m.d.comb += interface.handshakes_out.stall.eq(1)
+					m.next = 'IDLE'
+
+		return m
+
+	def handler_condition(self, setup : SetupPacket):
+		return (
+			(self.interface.active_config == self._configuration) &
+			(setup.type == USBRequestType.VENDOR) &
+			(setup.recipient == USBRequestRecipient.INTERFACE) &
+			(setup.index[0:8] == self._interface) &
+			(setup.request != VendorRequests.READ_COUNTERS)
+		)
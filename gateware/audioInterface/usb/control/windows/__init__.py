@@ -1,11 +1,12 @@
 # SPDX-License-Identifier: BSD-3-Clause
-from torii.hdl import Module, Signal
+from torii.hdl import Module
 from usb_construct.types import USBRequestType, USBRequestRecipient
 from usb_construct.types.descriptors.microsoft import MicrosoftRequests
-from usb_construct.emitters.descriptors.microsoft import PlatformDescriptorCollection
 from torii_usb.usb.usb2.request import USBRequestHandler
 from torii_usb.usb.request.interface import SetupPacket
 
+from ...rom import DescriptorROM, DescriptorROMPort
+from ..descriptorStream import handleDescriptorRequest
 from .descriptorSet import GetDescriptorSetHandler
 
 __all__ = (
@@ -13,8 +14,9 @@ __all__ = (
 )
 
 class WindowsRequestHandler(USBRequestHandler):
-	def __init__(self, descriptors : PlatformDescriptorCollection, maxPacketSize = 64):
-		self.descriptors = descriptors
+	def __init__(self, rom : DescriptorROM, port : DescriptorROMPort, maxPacketSize = 64):
+		self._rom = rom
+		self._port = port
 		self._maxPacketSize = maxPacketSize
 
 		super().__init__()
@@ -23,9 +25,10 @@ class WindowsRequestHandler(USBRequestHandler):
 		m = Module()
 		interface = self.interface
 		setup = interface.setup
-		tx = interface.tx
 
-		m.submodules.getDescriptorSet = descriptorSetHandler = GetDescriptorSetHandler(self.descriptors)
+		m.submodules.getDescriptorSet = descriptorSetHandler = GetDescriptorSetHandler(
+			self._rom, self._port, maxPacketLength = self._maxPacketSize
+		)
 		m.d.comb += [
 			descriptorSetHandler.request.eq(setup.request),
 			descriptorSetHandler.length.eq(setup.length),
@@ -34,6 +37,13 @@ class WindowsRequestHandler(USBRequestHandler):
 		with m.FSM(domain = 'usb'):
 			# IDLE -- not handling any active request
 			with m.State('IDLE'):
+				m.d.usb += [
+					# Each request starts from the beginning of the descriptor set ...
+					descriptorSetHandler.startPosition.eq(0),
+					# ... and responses always start with a DATA1 PID
+					interface.tx_data_pid.eq(1),
+				]
+
 				# If we've received a new setup packet, handle it.
 				with m.If(setup.received & self.handler_condition(setup)):
 					with m.Switch(setup.index):
@@ -51,30 +61,7 @@ class WindowsRequestHandler(USBRequestHandler):
 
 			# GET_DESCRIPTOR_SET -- The host is trying to request a platform-specific descriptor set
 			with m.State('GET_DESCRIPTOR_SET'):
-				expectingAck = Signal()
-
-				m.d.comb += [
-					descriptorSetHandler.tx.attach(tx),
-					interface.handshakes_out.stall.eq(descriptorSetHandler.stall),
-				]
-
-				with m.If(interface.data_requested):
-					m.d.comb += descriptorSetHandler.start.eq(1)
-					m.d.usb += expectingAck.eq(1)
-
-				with m.If(interface.handshakes_in.ack & expectingAck):
-					nextStartPosition = descriptorSetHandler.startPosition + self._maxPacketSize
-					m.d.usb += [
-						descriptorSetHandler.startPosition.eq(nextStartPosition),
-						self.interface.tx_data_pid.eq(~self.interface.tx_data_pid),
-						expectingAck.eq(0),
-					]
-
-				with m.If(interface.status_requested):
-					m.d.comb += interface.handshakes_out.ack.eq(1)
-					m.next = 'IDLE'
-				with m.Elif(descriptorSetHandler.stall):
-					m.next = 'IDLE'
+				handleDescriptorRequest(m, interface, descriptorSetHandler, maxPacketSize = self._maxPacketSize)
 
 			# UNHANDLED -- we've received a request we're not prepared to handle
 			with m.State('UNHANDLED'):
@@ -0,0 +1,77 @@
+from hashlib import sha256
+from importlib.metadata import version
+from inspect import signature
+from pathlib import Path
+from typing import Dict, List, Tuple
+import json
+import logging
+
+__all__ = (
+	'cachedDescriptors',
+	'descriptorCacheKey',
+)
+
+EmittedDescriptors = Tuple[List[Tuple[int, int, bytes]], Dict[int, bytes], Dict[int, bytes]]
+
+# The modules whose contents decide what buildDescriptors emits
+descriptorSources = ('__init__.py', 'descriptors.py', 'types.py')
+cacheFormat = 1
+
+def descriptorCacheKey(**kwargs) -> str:
+	'''
+	This hashes everything that goes into the descriptors: the source of the modules defining them, the
+	version of usb_construct emitting them, and every argument buildDescriptors is run with, defaults
+	included. The values the descriptors take from elsewhere in the gateware are all defaults of those
+	arguments, so changing them changes the key without their modules having to be hashed.
+	'''
+	from . import buildDescriptors
+	arguments = signature(buildDescriptors).bind(**kwargs)
+	arguments.apply_defaults()
+
+	key = sha256()
+	key.update(f'{cacheFormat}:{version("usb_construct")}:{sorted(arguments.arguments.items())!r}'.encode())
+	sourceDir = Path(__file__).parent
+	for source in descriptorSources:
+		key.update((sourceDir / source).read_bytes())
+	return key.hexdigest()
+
+def cachedDescriptors(*, cacheDir : Path = Path('build/cache'), **kwargs) -> EmittedDescriptors:
+	'''
+	This gets the emitted form of buildDescriptors(**kwargs) - the standard descriptors by type and index,
+	the Microsoft descriptor sets by vendor code, and the high capability descriptors by ID, all as bytes
+	and in the form DescriptorROM takes - from the cache on disk, only running the emitters to fill the
+	cache when what the descriptors are built from has changed since. A cache that can't be read or
+	written is treated as empty, so it never stops elaboration.
+	'''
+	cacheFile = cacheDir / f'descriptors-{descriptorCacheKey(**kwargs)}.json'
+	try:
+		cached = json.loads(cacheFile.read_text())
+		return (
+			[(number, index, bytes.fromhex(data)) for number, index, data in cached['standard']],
+			{int(vendorCode): bytes.fromhex(data) for vendorCode, data in cached['platform'].items()},
+			{int(descriptorID): bytes.fromhex(data) for descriptorID, data in cached['highCapability'].items()},
+		)
+	except (OSError, ValueError, KeyError, TypeError):
+		pass
+
+	from . import buildDescriptors
+	descriptors, platformDescriptors, highCapabilityDescriptors = buildDescriptors(**kwargs)
+	emitted = (
+		[(int(number), index, bytes(data)) for number, index, data in descriptors],
+		{vendorCode: bytes(data) for vendorCode, data in platformDescriptors.descriptors.items()},
+		{descriptorID: bytes(data) for descriptorID, data in highCapabilityDescriptors.items()},
+	)
+
+	try:
+		cacheDir.mkdir(parents = True, exist_ok = True)
+		# Write the cache entry in full before putting it in place, so a partly written one is never read
+		partialFile = cacheFile.with_suffix('.partial')
+		partialFile.write_text(json.dumps({
+			'standard': [(number, index, data.hex()) for number, index, data in emitted[0]],
+			'platform': {vendorCode: data.hex() for vendorCode, data in emitted[1].items()},
+			'highCapability': {descriptorID: data.hex() for descriptorID, data in emitted[2].items()},
+		}))
+		partialFile.replace(cacheFile)
+	except OSError as error:
+		logging.debug(f'Could not cache the emitted descriptors: {error}')
+	return emitted
@@ -1,15 +1,27 @@
 import construct
+from enum import IntEnum, unique
 
 from usb_construct.types.descriptor import DescriptorField, DescriptorNumber, DescriptorFormat
 from usb_construct.types.descriptors.uac3 import (
-	AudioClassSpecificDescriptorTypes, AudioClassSpecificACInterfaceDescriptorSubtypes,
+	AudioClassSpecificDescriptorTypes, AudioClassSpecificACInterfaceDescriptorSubtypes, ClusterDescriptorSubtypes,
+	ClusterDescriptorSegmentTypes, ChannelPurposeDefinitions,
 )
 
 __all__ = (
+	'ChannelRelationships',
 	'MonoFeatureUnitDescriptor',
-	'StereoFeatureUnitDescriptor'
+	'StereoFeatureUnitDescriptor',
+	'StereoClusterDescriptor',
 )
 
+@unique
+class ChannelRelationships(IntEnum):
+	# As defined in [Audio30], Table A-12
+	RELATIONSHIP_UNDEFINED = 0x00
+	MONO = 0x01
+	LEFT = 0x02
+	RIGHT = 0x03
+
 MonoFeatureUnitDescriptor = DescriptorFormat(
 	'bLength'             / construct.Const(15, construct.Int8ul),
 	'bDescriptorType'     / DescriptorNumber(AudioClassSpecificDescriptorTypes.CS_INTERFACE),
@@ -36,3 +48,34 @@ StereoFeatureUnitDescriptor = DescriptorFormat(
 		),
 	'wFeatureDescrStr'    / construct.Const(0, construct.Int16ul),
 )
+
+def ChannelInformationSegment(relationship : ChannelRelationships):
+	return construct.Sequence(
+		construct.Const(6, construct.Int16ul),
+		construct.Const(ClusterDescriptorSegmentTypes.CHANNEL_INFORMATION, construct.Int8ul),
+		construct.Const(ChannelPurposeDefinitions.GENERIC_AUDIO, construct.Int8ul),
+		construct.Const(relationship, construct.Int8ul),
+		# bChGroupID
+		construct.Const(0, construct.Int8ul),
+	)
+
+EndSegment = construct.Sequence(
+	construct.Const(3, construct.Int16ul),
+	construct.Const(ClusterDescriptorSegmentTypes.END_SEGMENT, construct.Int8ul),
+)
+
+# This is a high capability descriptor, so it's fetched with a HIGH_CAPABILITY_DESCRIPTOR request rather than
+# being part of the configuration descriptor. Each channel's segments are ended by an end segment
+StereoClusterDescriptor = DescriptorFormat(
+	'wLength'             / construct.Const(25, construct.Int16ul),
+	'bDescriptorType'     / DescriptorNumber(AudioClassSpecificDescriptorTypes.CS_CLUSTER),
+	'bDescriptorSubtype'  / DescriptorNumber(ClusterDescriptorSubtypes.SUBTYPE_UNDEFINED),
+	'wDescriptorID'       / DescriptorField(description = 'unique identifier for the cluster descriptor'),
+	'bNrChannels'         / construct.Const(2, construct.Int8ul),
+	'segments'            / construct.Sequence(
+			ChannelInformationSegment(ChannelRelationships.LEFT),
+			EndSegment,
+			ChannelInformationSegment(ChannelRelationships.RIGHT),
+			EndSegment,
+		),
+)
@@ -0,0 +1,142 @@
+from torii.hdl import Elaboratable, Module, Signal, Array, Const
+from torii.build import Platform
+from torii_usb.usb.usb2.endpoint import EndpointInterface
+from usb_construct.types.descriptors.uac3 import (
+	AudioClassSpecificRequestCodes, AudioControlInterfaceControlSelectors, TerminalControlSelectors,
+	ClockSourceControlSelectors
+)
+
+__all__ = (
+	'NotificationEndpoint',
+)
+
+class NotificationEndpoint(Elaboratable):
+	'''
+	This is the audio control interface's interrupt IN endpoint, which tells the host when something it
+	would otherwise have to poll for has changed, using UAC3 interrupt data messages.
+
+	Each watched signal has a notification pending against it from when it changes until the host has
+	ACK'd the message for it, so a signal that changes repeatedly only ever has one message outstanding.
+	Once a message has been ACK'd, no more are sent for holdoffCycles usb domain cycles, which rate
+	limits the endpoint to one message per service interval by default. The host is NAK'd whenever
+	there's nothing to send.
+
+	Every message is a CUR attribute change (bAttribute = CUR), meaning the host should re-read the
+	control the message names:
+	 * sampleRate changing names the clock source's sample rate control
+	 * powerState changing names the power domain's power state control
+	 * spdifAvailable changing names the output terminal's latency control, as S/PDIF locking or going
+	   away changes the path audio takes through the gateware
+	'''
+
+	messageLength = 6
+
+	def __init__(self, endpointNumber : int, *, interface : int = 0, holdoffCycles = 60000):
+		self._endpointNumber = endpointNumber
+		self._interface = interface
+		self._holdoffCycles = holdoffCycles
+
+		# LUNA required endpoint interface values
+		self.interface = EndpointInterface()
+		self.sampleRate = Signal(range(192001))
+		self.powerState = Signal(8)
+		self.spdifAvailable = Signal()
+
+	def elaborate(self, platform : Platform) -> Module:
+		m = Module()
+
+		interface = self.interface
+		tx = interface.tx
+		tokenizer = interface.tokenizer
+
+		# (signal, control selector, entity ID) for each of the things the host gets told about
+		notifications = (
+			(self.sampleRate, ClockSourceControlSelectors.CS_SAM_FREQ_CONTROL, 9),
+			(self.powerState, AudioControlInterfaceControlSelectors.AC_POWER_DOMAIN_CONTROL, 10),
+			(self.spdifAvailable, TerminalControlSelectors.TE_LATENCY_CONTROL, 3),
+		)
+
+		pending = Signal(len(notifications))
+		# Which notification the message being sent is for
+		selected = Signal(range(len(notifications)))
+		holdoff = Signal(range(self._holdoffCycles + 1))
+		byteIndex = Signal(range(self.messageLength))
+
+		# Build the messages - bInfo says this is a class-specific interface message, then come the
+		# attribute that changed, wValue (control number, control selector) and wIndex (interface, entity ID)
+		messages = Array(
+			Array(
+				Const(value, 8) for value in (
+					0x00, AudioClassSpecificRequestCodes.CUR, 0, selector, self._interface, entity
+				)
+			)
+			for _, selector, entity in notifications
+		)
+
+		packetRequested = (tokenizer.endpoint == self._endpointNumber) & tokenizer.is_in & tokenizer.ready_for_response
+		sent = Signal()
+
+		# Watch for each signal changing, and hold the notification for it pending until it's been sent
+		for idx, (signal, _, _) in enumerate(notifications):
+			lastValue = Signal.like(signal, name = f'{signal.name}Last')
+			m.d.usb += lastValue.eq(signal)
+			with m.If(signal != lastValue):
+				m.d.usb += pending[idx].eq(1)
+			with m.Elif(sent & (selected == idx)):
+				m.d.usb += pending[idx].eq(0)
+		# The host reads everything afresh when it configures us, so there's nothing to tell it until then
+		with m.If(interface.active_config == 0):
+			m.d.usb += pending.eq(0)
+
+		with m.If(holdoff != 0):
+			m.d.usb += holdoff.eq(holdoff - 1)
+
+		m.d.comb += tx.data.eq(messages[selected][byteIndex])
+
+		with m.FSM(domain = 'usb'):
+			# IDLE -- wait for the host to poll us, and NAK it if we've nothing to send (yet)
+			with m.State('IDLE'):
+				with m.If(packetRequested):
+					with m.If((pending != 0) & (holdoff == 0)):
+						# Pick the lowest numbered notification pending
+						for idx in reversed(range(len(notifications))):
+							with m.If(pending[idx]):
+								m.d.usb += selected.eq(idx)
+						m.d.usb += byteIndex.eq(0)
+						m.next = 'TRANSMIT'
+					with m.Else():
+						m.d.comb += interface.handshakes_out.nak.eq(1)
+
+			# TRANSMIT -- send the message
+			with m.State('TRANSMIT'):
+				lastByte = byteIndex == self.messageLength - 1
+				m.d.comb += [
+					tx.valid.eq(1),
+					tx.first.eq(byteIndex == 0),
+					tx.last.eq(lastByte),
+				]
+
+				with m.If(tx.ready):
+					m.d.usb += byteIndex.eq(byteIndex + 1)
+					with m.If(lastByte):
+						m.next = 'WAIT_ACK'
+
+			# WAIT_ACK -- wait for the host to ACK the message, sending it again if it doesn't
+			with m.State('WAIT_ACK'):
+				with m.If(interface.handshakes_in.ack):
+					m.d.comb += sent.eq(1)
+					m.d.usb += [
+						interface.tx_pid_toggle[0].eq(~interface.tx_pid_toggle[0]),
+						holdoff.eq(self._holdoffCycles),
+					]
+					m.next = 'IDLE'
+				with m.Elif(tokenizer.new_token):
+					m.next = 'RETRANSMIT'
+
+			# RETRANSMIT -- wait for the host to poll us again so we can resend the message
+			with m.State('RETRANSMIT'):
+				with m.If(packetRequested):
+					m.d.usb += byteIndex.eq(0)
+					m.next = 'TRANSMIT'
+
+		return m
@@ -0,0 +1,151 @@
+from torii.hdl import Elaboratable, Module, Signal, Memory, DomainRenamer
+from usb_construct.emitters.descriptors.standard import DeviceDescriptorCollection
+from usb_construct.emitters.descriptors.microsoft import PlatformDescriptorCollection
+from random import Random
+from struct import pack as structPack, unpack as structUnpack
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+__all__ = (
+	'DescriptorROM',
+	'DescriptorROMImage',
+	'DescriptorROMPort',
+)
+
+class DescriptorROMPort:
+	'''
+	One user's view of the descriptor ROM. Hold select high while reading through the port, and data
+	holds the word at addr the cycle after addr is set, as with a memory read port.
+	'''
+
+	def __init__(self, *, addrWidth : int, name : str):
+		self.select = Signal(name = f'{name}Select')
+		self.addr = Signal(addrWidth, name = f'{name}Addr')
+		self.data = Signal(DescriptorROMImage.wordSize * 8, name = f'{name}Data')
+
+class DescriptorROMImage:
+	'''
+	This packs all of the device's descriptors into the contents of the one ROM the descriptor request
+	handlers stream their descriptors out of.
+
+	The ROM is made of 16-bit big endian words. It starts with a table holding two words per descriptor,
+	the descriptor's length and then the byte address it starts at. Which entry holds which descriptor is
+	fixed by the layout of the descriptors, not by their contents, so the table's index is all the
+	gateware has to work out for itself. The standard descriptors get the first entries, then the
+	Microsoft descriptor sets by vendor code, then the UAC3 high capability descriptors by ID. The
+	descriptors follow the table back to back, with no padding between them. The ROM being 16 bits wide
+	means each EBR (256 x 16 bits) holds a part of it, so it takes no more EBRs than the descriptors need
+	bytes.
+
+	The descriptors can be given either as usb_construct builds them or already emitted, as bytes by type
+	and index, vendor code, and ID, as the descriptor cache holds them.
+
+	The ROM is then filled out to a whole number of EBRs with pseudo-random words that come out the same
+	on every build. This keeps the ROM in block RAM, and gives every bitstream the same known contents
+	for it, which icebram can find and swap a new ROM image in for. That is how the personalise action
+	gives each unit its own serial number without rebuilding the gateware, so depth can be given to build
+	a ROM image that has to fit an existing bitstream.
+	'''
+
+	wordSize = 2
+	entrySize = 2
+	ebrDepth = 256
+	fillerSeed = 0xbadc
+
+	def __init__(self, descriptors : Union[DeviceDescriptorCollection, Iterable[Tuple[int, int, bytes]]],
+		platformDescriptors : Union[PlatformDescriptorCollection, Dict[int, bytes], None] = None,
+		highCapabilityDescriptors : Optional[Dict[int, bytes]] = None, *, depth : Optional[int] = None
+	):
+		blobs : List[bytes] = []
+		# Map each (type, index) pair onto the table entry for that descriptor
+		self.standardSlots : Dict[Tuple[int, int], int] = {}
+		for number, index, descriptor in sorted(descriptors, key = lambda entry: entry[0:2]):
+			self.standardSlots[int(number), index] = len(blobs)
+			blobs.append(bytes(descriptor))
+		# And each vendor code onto the table entry for its descriptor set
+		self.platformSlots : Dict[int, int] = {}
+		if isinstance(platformDescriptors, PlatformDescriptorCollection):
+			platformDescriptors = platformDescriptors.descriptors
+		if platformDescriptors is not None:
+			for vendorCode, descriptorSet in sorted(platformDescriptors.items()):
+				self.platformSlots[vendorCode] = len(blobs)
+				blobs.append(bytes(descriptorSet))
+		# And each high capability descriptor ID onto the table entry for that descriptor
+		self.highCapabilitySlots : Dict[int, int] = {}
+		if highCapabilityDescriptors is not None:
+			for descriptorID, descriptor in sorted(highCapabilityDescriptors.items()):
+				self.highCapabilitySlots[descriptorID] = len(blobs)
+				blobs.append(bytes(descriptor))
+
+		self.entries = len(blobs)
+		self.maxLength = max(len(blob) for blob in blobs)
+		data = bytearray()
+		table = bytearray()
+		address = self.entries * self.entrySize * self.wordSize
+		for blob in blobs:
+			table += structPack('>HH', len(blob), address + len(data))
+			data += blob
+		rom = table + data
+		rom += bytes(-len(rom) % self.wordSize)
+		if len(rom) > 0xffff:
+			raise ValueError('Descriptors do not fit in the 64KiB a descriptor ROM can address')
+
+		words = [structUnpack('>H', rom[i:i + self.wordSize])[0] for i in range(0, len(rom), self.wordSize)]
+		if depth is None:
+			depth = -(-len(words) // self.ebrDepth) * self.ebrDepth
+		elif len(words) > depth:
+			raise ValueError(f'Descriptors need {len(words)} words of ROM, but only {depth} are available')
+		self.used = len(words)
+		self.depth = depth
+
+		filler = Random(self.fillerSeed)
+		self.words = words + [filler.getrandbits(self.wordSize * 8) for _ in range(depth - len(words))]
+
+	@property
+	def layout(self):
+		''' What decides which table entry is which, for checking two ROM images are interchangeable '''
+		return (self.standardSlots, self.platformSlots, self.highCapabilitySlots)
+
+	def hexImage(self) -> str:
+		''' The ROM's contents in the form icebram reads, a word per line '''
+		return ''.join(f'{word:04x}\n' for word in self.words)
+
+class DescriptorROM(Elaboratable):
+	'''
+	This is the ROM holding all of the device's descriptors, which the descriptor request handlers each
+	get a port on to stream their descriptors out of. Only one control request is ever handled at a time,
+	so the handlers never actually want the ROM at the same time - the lowest numbered port that's
+	selected gets it, just so that's well defined.
+	'''
+
+	wordSize = DescriptorROMImage.wordSize
+	entrySize = DescriptorROMImage.entrySize
+
+	def __init__(self, descriptors : Union[DeviceDescriptorCollection, Iterable[Tuple[int, int, bytes]]],
+		platformDescriptors : Union[PlatformDescriptorCollection, Dict[int, bytes], None] = None,
+		highCapabilityDescriptors : Optional[Dict[int, bytes]] = None, *, ports = 1, domain = 'usb'
+	):
+		self.image = DescriptorROMImage(descriptors, platformDescriptors, highCapabilityDescriptors)
+		self.standardSlots = self.image.standardSlots
+		self.platformSlots = self.image.platformSlots
+		self.highCapabilitySlots = self.image.highCapabilitySlots
+		self._domain = domain
+
+		addrWidth = (self.image.depth - 1).bit_length()
+		self.ports = tuple(DescriptorROMPort(addrWidth = addrWidth, name = f'port{idx}') for idx in range(ports))
+
+	def elaborate(self, platform) -> Module:
+		m = Module()
+		image = self.image
+		rom = Memory(width = image.wordSize * 8, depth = image.depth, init = image.words, name = 'descriptorROM')
+		m.submodules.readPort = readPort = rom.read_port(transparent = False)
+
+		# The lowest numbered port that's selected gets to drive the address
+		for port in reversed(self.ports):
+			with m.If(port.select):
+				m.d.comb += readPort.addr.eq(port.addr)
+		for port in self.ports:
+			m.d.comb += port.data.eq(readPort.data)
+
+		if self._domain != 'sync':
+			m = DomainRenamer(sync = self._domain)(m)
+		return m